@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from digitizer.digitization import get_correction_angle
+from digitizer.report_components.report import Report, DESKEW_FAST_MAX_SIZE
+
+def main(args):
+
+    report_ids = [
+        filename[:-len(".json")]
+        for filename in sorted(os.listdir(args.annotations_dir))
+        if filename.endswith(".json")
+        and os.path.exists(os.path.join(args.images_dir, filename[:-len(".json")] + ".jpg"))
+    ]
+
+    # None is the full resolution, against which the other sizes are compared
+    sizes = [None] + sorted(args.sizes, reverse=True)
+    times = { size: [] for size in sizes }
+    angles = { size: [] for size in sizes }
+    annotated_angles = []
+
+    for report_id in tqdm(report_ids):
+        audiograms = json.load(open(os.path.join(args.annotations_dir, f"{report_id}.json")))
+        for audiogram in audiograms:
+            bbox = audiogram["boundingBox"]
+            report = Report(filename=os.path.join(args.images_dir, f"{report_id}.jpg"))
+            report = report.crop(bbox["x"], bbox["y"], bbox["x"] + bbox["width"], bbox["y"] + bbox["height"])
+
+            # The angle of the annotated corners is the ground truth, when available
+            annotated_angles.append(
+                np.degrees(get_correction_angle(audiogram["corners"]))
+                if len(audiogram.get("corners", [])) == 4 else np.nan
+            )
+
+            for size in sizes:
+                start = time.perf_counter()
+                angles[size].append(report.estimate_correction_angle(max_size=size))
+                times[size].append(time.perf_counter() - start)
+
+    reference = np.array(angles[None])
+    annotated_angles = np.array(annotated_angles)
+    print(f"Audiograms: {len(reference)} ({np.sum(~np.isnan(annotated_angles))} with annotated corners)")
+    print(f"{'max size':>10} {'ms/audiogram':>14} {'speedup':>8} {'mean |Δ full|':>14} {'max |Δ full|':>13} {'mean |error|':>13} {'max |error|':>12}")
+    for size in sizes:
+        differences = np.abs(np.array(angles[size]) - reference)
+        errors = np.abs(np.array(angles[size]) - annotated_angles)
+        print((f"{size or 'full':>10} {1000 * np.mean(times[size]):>14.1f} "
+               f"{np.sum(times[None]) / np.sum(times[size]):>7.1f}x "
+               f"{np.mean(differences):>13.2f}° {np.max(differences):>12.2f}° "
+               f"{np.nanmean(errors):>12.2f}° {np.nanmax(errors):>11.2f}°"))
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=("Measures the latency and accuracy (relative to the full resolution "
+            "and to the annotated corners) of the correction angle estimated on downsampled audiograms."))
+    parser.add_argument("-a", "--annotations_dir", type=str, required=True, help="Directory containing the JSON annotations.")
+    parser.add_argument("-i", "--images_dir", type=str, required=True, help="Directory containing the report images (<report id>.jpg).")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[1024, DESKEW_FAST_MAX_SIZE, 256, 128],
+            help=f"The maximum sizes to evaluate (default: 1024 {DESKEW_FAST_MAX_SIZE} 256 128).")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+from argparse import ArgumentParser
+from typing import List
+import json
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from digitizer.report_components.line import Line
+from digitizer.report_components.report import Report
+
+def get_positions(lines: List[Line]) -> tuple:
+    """Returns the sorted x positions of the vertical lines and y positions
+    of the horizontal lines.
+
+    Parameters
+    ----------
+    lines : List[Line]
+    The lines detected in an audiogram.
+
+    Returns
+    -------
+    tuple
+    A tuple of the form (x positions, y positions).
+    """
+    xs = np.sort([line.get_x() for line in lines if line.is_vertical()])
+    ys = np.sort([line.get_y() for line in lines if line.is_horizontal()])
+    return xs, ys
+
+def matched_fraction(positions: np.ndarray, references: np.ndarray, tolerance: float) -> float:
+    """Returns the fraction of the positions that lie within `tolerance`
+    pixels of one of the reference positions.
+    """
+    if len(positions) == 0:
+        return np.nan
+    if len(references) == 0:
+        return 0.0
+    distances = np.abs(np.asarray(positions)[:, None] - np.asarray(references)[None, :]).min(axis=1)
+    return float(np.mean(distances <= tolerance))
+
+def main(args):
+
+    report_ids = [
+        filename[:-len(".json")]
+        for filename in sorted(os.listdir(args.annotations_dir))
+        if filename.endswith(".json")
+        and os.path.exists(os.path.join(args.images_dir, filename[:-len(".json")] + ".jpg"))
+    ]
+
+    hough_times, projection_times = [], []
+    hough_counts, projection_counts = [], []
+    raw_counts, clustered_counts = [], []
+    recalls, precisions = [], []
+
+    for report_id in tqdm(report_ids):
+        audiograms = json.load(open(os.path.join(args.annotations_dir, f"{report_id}.json")))
+        for audiogram in audiograms:
+            bbox = audiogram["boundingBox"]
+            report = Report(filename=os.path.join(args.images_dir, f"{report_id}.jpg"))
+            report = report.crop(bbox["x"], bbox["y"], bbox["x"] + bbox["width"], bbox["y"] + bbox["height"])
+
+            # Deskew the audiogram the same way `detect_components` does
+            report = report.rotate(report.estimate_correction_angle())
+
+            start = time.perf_counter()
+            hough_lines = report.detect_lines(threshold=args.threshold)
+            hough_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            projection_lines = report.detect_lines_projection(threshold=args.threshold)
+            projection_times.append(time.perf_counter() - start)
+
+            # The near-duplicate Hough lines are merged before `Grid` sees them
+            clustered_lines = report.detect_lines(threshold=args.threshold, cluster=True)
+            raw_counts.append(len(hough_lines))
+            clustered_counts.append(len(clustered_lines))
+
+            hough_lines = [line for line in hough_lines if line.is_vertical() or line.is_horizontal()]
+            hough_counts.append(len(hough_lines))
+            projection_counts.append(len(projection_lines))
+
+            # The Hough lines are the reference: a Hough line is recalled if a
+            # projection line lies within `tolerance` pixels of it, and
+            # conversely for the precision.
+            hough_xs, hough_ys = get_positions(hough_lines)
+            projection_xs, projection_ys = get_positions(projection_lines)
+            recalls += [
+                matched_fraction(hough_xs, projection_xs, args.tolerance),
+                matched_fraction(hough_ys, projection_ys, args.tolerance)
+            ]
+            precisions += [
+                matched_fraction(projection_xs, hough_xs, args.tolerance),
+                matched_fraction(projection_ys, hough_ys, args.tolerance)
+            ]
+
+    print(f"Audiograms: {len(hough_times)}")
+    print(f"Hough:      {1000 * np.mean(hough_times):.1f} ms/audiogram, {np.mean(hough_counts):.1f} lines/audiogram")
+    print(f"Projection: {1000 * np.mean(projection_times):.1f} ms/audiogram, {np.mean(projection_counts):.1f} lines/audiogram")
+    print(f"Speedup:    {np.sum(hough_times) / np.sum(projection_times):.1f}x")
+    print((f"Hough line clustering: {np.mean(raw_counts):.1f} -> {np.mean(clustered_counts):.1f} lines/audiogram "
+           f"({100 * (1 - np.sum(clustered_counts) / max(np.sum(raw_counts), 1)):.0f}% fewer)"))
+    print(f"Recall of the Hough lines (+/- {args.tolerance}px):     {np.nanmean(recalls):.3f}")
+    print(f"Precision against the Hough lines (+/- {args.tolerance}px): {np.nanmean(precisions):.3f}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=("Benchmarks the projection-profile grid line detector "
+            "against the Hough transform on a corpus of annotated reports."))
+    parser.add_argument("-a", "--annotations_dir", type=str, required=True, help="Directory containing the JSON annotations.")
+    parser.add_argument("-i", "--images_dir", type=str, required=True, help="Directory containing the report images (<report id>.jpg).")
+    parser.add_argument("-t", "--threshold", type=int, default=150, help="Line detection threshold passed to both detectors (default: 150).")
+    parser.add_argument("--tolerance", type=float, default=3, help="Distance (in pixels) below which two lines are considered the same (default: 3).")
+    args = parser.parse_args()
+    main(args)
@@ -11,7 +11,9 @@ import os
 
 from tqdm import tqdm
 
-from digitizer.digitization import generate_partial_annotation, extract_thresholds
+from digitizer.digitization import generate_partial_annotation, extract_thresholds, INFERENCE_SIZES
+from digitizer.report_components.report import DESKEW_MAX_SIZE, DESKEW_FAST_MAX_SIZE
+from digitizer.templates import TemplateCache
 
 if __name__ == "__main__":
     import argparse
@@ -25,32 +27,70 @@ if __name__ == "__main__":
             help="Whether the script should be run in `annotation mode`, i.e. return results similar in format to those of a human-made annotation. If not given, a list of thresholds is computed.")
     parser.add_argument("-g", "--gpu", action="store_true",
             help="Use the GPU.")
+    parser.add_argument("-l", "--line_detection", type=str, choices=["hough", "projection"], default="hough",
+            help="Method used to detect the grid lines: the Hough transform or the (faster) projection profiles of the deskewed audiogram (default: hough).")
+    parser.add_argument("-d", "--deskew_max_size", type=int, default=DESKEW_MAX_SIZE,
+            help=f"The correction angle of the audiograms is estimated on a copy downsampled to roughly this size (in pixels). Lower is faster, but less accurate, e.g. {DESKEW_FAST_MAX_SIZE}; 0 uses the full resolution (default: full resolution).")
+    parser.add_argument("-c", "--cache_dir", type=str, default=None,
+            help="Directory in which the detections (audiograms, correction angles, labels, symbols) and the grid lines of every report are cached.")
+    parser.add_argument("--from_cache", action="store_true",
+            help="Read the detections and lines from `--cache_dir` instead of running the object detectors, so that only the grid fitting and the threshold extraction are run.")
+    parser.add_argument("-t", "--template_cache", type=str, default=None,
+            help="JSON file caching the layout of the report templates seen so far. The audiograms of a report matching a known template are not detected, but taken from the template.")
+    parser.add_argument("-r", "--symbols_roi", action="store_true",
+            help="Calibrate the grid of each audiogram before detecting its symbols, and only run the symbol detector on the grid (plus a margin) rather than the whole audiogram.")
+    parser.add_argument("--symbols_tile_size", type=int, default=0,
+            help="Detect the symbols at native resolution on overlapping tiles of this size (in pixels), batched in the forward passes, instead of on the audiogram resized to its inference size (default: 0, no tiling).")
+    parser.add_argument("--inference_sizes", type=str, nargs="+", default=[],
+            help=("Inference sizes of the detectors, e.g. `symbols=320:1280 labels=640`: a fixed size, or the minimum and maximum between which the longest side of the input is kept "
+                  f"(default: {' '.join(f'{k}=' + (str(v) if isinstance(v, int) else f'{v[0]}:{v[1]}') for k, v in INFERENCE_SIZES.items())})."))
     args = parser.parse_args()
 
+    if args.from_cache and not args.cache_dir:
+        parser.error("--from_cache requires --cache_dir")
+
+    inference_sizes = {}
+    for inference_size in args.inference_sizes:
+        detector, _, size = inference_size.partition("=")
+        if detector not in INFERENCE_SIZES or not all(x.isdigit() for x in size.split(":")) or size.count(":") > 1:
+            parser.error(f"invalid inference size `{inference_size}`")
+        inference_sizes[detector] = tuple(int(x) for x in size.split(":")) if ":" in size else int(size)
+        if ":" in size and inference_sizes[detector][0] > inference_sizes[detector][1]:
+            parser.error(f"invalid inference size `{inference_size}`: the minimum exceeds the maximum")
+
+    template_cache = TemplateCache(args.template_cache) if args.template_cache else None
+
     input_files = []
     if os.path.isfile(args.input):
         input_files += [os.path.abspath(args.input)]
     else:
         input_files += [os.path.join(args.input, filename) for filename in os.listdir(args.input)]
 
-    with tqdm(total=len(input_files)) as pbar:
-        for input_file in input_files:
-            pbar.set_description(f"{os.path.basename(input_file)}")
+    try:
+        with tqdm(total=len(input_files)) as pbar:
+            for input_file in input_files:
+                pbar.set_description(f"{os.path.basename(input_file)}")
 
-            result = None
+                result = None
 
-            if args.annotation_mode:
-                result = generate_partial_annotation(input_file, gpu=args.gpu)
-            else:
-                result = extract_thresholds(input_file, gpu=args.gpu)
+                if args.annotation_mode:
+                    result = generate_partial_annotation(input_file, gpu=args.gpu, deskew_max_size=args.deskew_max_size,
+                            cache_dir=args.cache_dir, from_cache=args.from_cache, template_cache=template_cache, symbols_roi=args.symbols_roi, symbols_tile_size=args.symbols_tile_size, inference_sizes=inference_sizes)
+                else:
+                    result = extract_thresholds(input_file, gpu=args.gpu, line_detection=args.line_detection, deskew_max_size=args.deskew_max_size,
+                            cache_dir=args.cache_dir, from_cache=args.from_cache, template_cache=template_cache, symbols_roi=args.symbols_roi, symbols_tile_size=args.symbols_tile_size, inference_sizes=inference_sizes)
 
-            result_as_string = json.dumps(result, indent=4, separators=(',', ': '))
+                result_as_string = json.dumps(result, indent=4, separators=(',', ': '))
 
-            if args.output_dir:
-                predictions_filename = os.path.basename(input_file).split(".")[0] + ".json"
-                with open(os.path.join(args.output_dir, predictions_filename), "w") as ofile:
-                    ofile.write(result_as_string)
-            else:
-                print(result_as_string)
+                if args.output_dir:
+                    predictions_filename = os.path.basename(input_file).split(".")[0] + ".json"
+                    with open(os.path.join(args.output_dir, predictions_filename), "w") as ofile:
+                        ofile.write(result_as_string)
+                else:
+                    print(result_as_string)
 
-            pbar.update(1) # increment the progress bar
+                pbar.update(1) # increment the progress bar
+    finally:
+        # The template cache only writes its file every few changes
+        if template_cache is not None:
+            template_cache.save()
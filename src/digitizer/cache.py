@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+Cache of the outputs of `detect_components` (the audiograms, their correction
+angles, and the label and symbol detections) and of the Hough lines of each
+audiogram, so that the grid fitting and the threshold extraction can be re-run
+without the neural networks, nor even the images.
+"""
+
+from typing import List, Optional, Tuple
+import gzip
+import hashlib
+import json
+import os
+
+from interfaces import CachedComponentsDict
+from digitizer.report_components.calibration import GridCalibration
+from digitizer.report_components.hough import HoughAccumulator
+from digitizer.report_components.label import Label
+from digitizer.report_components.symbol import Symbol
+
+CACHE_VERSION = 3
+
+# Number of hexadecimal digits of the hash of the path of the image in the
+# name of its cache file
+CACHE_HASH_LENGTH = 12
+
+def get_cache_file(cache_dir: str, filepath: str) -> str:
+    """Returns the path of the cache file of a report.
+
+    Parameters
+    ----------
+    cache_dir : str
+    The cache directory.
+    filepath : str
+    Path to the image of the report.
+
+    Returns
+    -------
+    str
+    The path `<cache_dir>/<report id>.<hash>.json.gz`, where the report id
+    is the name of the image without its extension and the hash that of
+    its absolute path, so that the images of the same name in different
+    directories have different cache files.
+    """
+    report_id = os.path.splitext(os.path.basename(filepath))[0]
+    digest = hashlib.sha1(os.path.abspath(filepath).encode("utf-8")).hexdigest()[:CACHE_HASH_LENGTH]
+    return os.path.join(cache_dir, f"{report_id}.{digest}.json.gz")
+
+def get_report_id(cache_file: str) -> str:
+    """Returns the id of the report (the name of its image without its
+    extension) of a cache file named by `get_cache_file`.
+    """
+    return os.path.basename(cache_file)[:-len(".json.gz")].rsplit(".", 1)[0]
+
+def components_to_dicts(components: List, accumulators: Optional[List[Optional[HoughAccumulator]]] = None) -> List[CachedComponentsDict]:
+    """Serializes the components detected in a report.
+
+    Parameters
+    ----------
+    components : List
+    The components, as returned by `detect_components`.
+    accumulators : Optional[List[Optional[HoughAccumulator]]]
+    The Hough accumulator of each audiogram, if the lines are to be cached (default: None).
+
+    Returns
+    -------
+    List[CachedComponentsDict]
+    The serialized components.
+    """
+    accumulators = accumulators or [None] * len(components)
+    return [{
+        "audiogram": component["audiogram"],
+        "labels": [{
+            "boundingBox": { "x": label.x1, "y": label.y1, "width": label.width, "height": label.height },
+            "absoluteBoundingBox": label.absolute_bounding_box,
+            "text": label.text,
+            "confidence": label.confidence
+        } for label in component["labels"]] if component["labels"] is not None else None,
+        "symbols": [{
+            "boundingBox": { "x": symbol.x1, "y": symbol.y1, "width": symbol.width, "height": symbol.height },
+            "absoluteBoundingBox": symbol.absolute_bounding_box,
+            "measurementType": symbol.measurement_type,
+            "confidence": symbol.confidence
+        } for symbol in component["symbols"]],
+        "candidates": component.get("candidates"),
+        "lines": accumulator.to_dict() if accumulator is not None else None,
+        "calibration": component["calibration"].to_dict() if component.get("calibration") is not None else None
+    } for component, accumulator in zip(components, accumulators)]
+
+def dicts_to_components(component_dicts: List[CachedComponentsDict]) -> Tuple[List, List[Optional[HoughAccumulator]]]:
+    """Restores the components serialized with `components_to_dicts`.
+
+    Parameters
+    ----------
+    component_dicts : List[CachedComponentsDict]
+    The serialized components.
+
+    Returns
+    -------
+    Tuple[List, List[Optional[HoughAccumulator]]]
+    The components (as returned by `detect_components`) and the Hough
+    accumulator of each audiogram (None if its lines were not cached).
+    """
+    components, accumulators = [], []
+    for component_dict in component_dicts:
+        audiogram = component_dict["audiogram"]
+        audiogram_coordinates = { "x": audiogram["boundingBox"]["x"], "y": audiogram["boundingBox"]["y"] }
+        correction_angle = audiogram["correctionAngle"]
+        components.append({
+            "audiogram": audiogram,
+            "labels": [
+                Label(label, audiogram_coordinates, correction_angle, absolute_bounding_box=label["absoluteBoundingBox"])
+                for label in component_dict["labels"]
+            ] if component_dict["labels"] is not None else None,
+            "symbols": [
+                Symbol(symbol, audiogram_coordinates, correction_angle, absolute_bounding_box=symbol["absoluteBoundingBox"])
+                for symbol in component_dict["symbols"]
+            ],
+            "candidates": component_dict["candidates"],
+            "calibration": GridCalibration.from_dict(component_dict["calibration"]) if component_dict.get("calibration") else None
+        })
+        lines = component_dict.get("lines")
+        accumulators.append(HoughAccumulator.from_dict(lines) if lines is not None else None)
+    return components, accumulators
+
+def save_components(cache_file: str, components: List, accumulators: Optional[List[Optional[HoughAccumulator]]] = None,
+        settings: Optional[dict] = None):
+    """Writes the components detected in a report (and optionally the
+    Hough lines of its audiograms) to a gzipped JSON cache file.
+
+    Parameters
+    ----------
+    cache_file : str
+    Path to the cache file (see `get_cache_file`).
+    components : List
+    The components, as returned by `detect_components`.
+    accumulators : Optional[List[Optional[HoughAccumulator]]]
+    The Hough accumulator of each audiogram (default: None).
+    settings : Optional[dict]
+    The (JSON-serializable) settings with which the components were
+    detected, checked by `load_component_dicts` (default: None).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with gzip.open(cache_file, "wt") as ofile:
+        json.dump({
+            "version": CACHE_VERSION,
+            "settings": settings,
+            "components": components_to_dicts(components, accumulators)
+        }, ofile, separators=(",", ":"))
+
+def load_component_dicts(cache_file: str, settings: Optional[dict] = None) -> List[CachedComponentsDict]:
+    """Reads the serialized components cached with `save_components`,
+    without restoring them (see `dicts_to_components`).
+
+    Parameters
+    ----------
+    cache_file : str
+    Path to the cache file (see `get_cache_file`).
+    settings : Optional[dict]
+    If provided, the settings with which the components must have been
+    detected (default: None, i.e. any).
+
+    Returns
+    -------
+    List[CachedComponentsDict]
+    The serialized components.
+    """
+    with gzip.open(cache_file, "rt") as ifile:
+        cached = json.load(ifile)
+    if cached.get("version") != CACHE_VERSION:
+        raise ValueError(f"{cache_file} was written by an incompatible version of the cache (expected version {CACHE_VERSION}).")
+    # Compare the settings as they are stored (e.g. tuples become lists)
+    if settings is not None and cached.get("settings") != json.loads(json.dumps(settings)):
+        raise ValueError(f"{cache_file} was written with different settings ({cached.get('settings')}, expected {settings}).")
+    return cached["components"]
+
+def load_components(cache_file: str, settings: Optional[dict] = None) -> Tuple[List, List[Optional[HoughAccumulator]]]:
+    """Reads the components cached with `save_components`.
+
+    Parameters
+    ----------
+    cache_file : str
+    Path to the cache file (see `get_cache_file`).
+    settings : Optional[dict]
+    See `load_component_dicts` (default: None).
+
+    Returns
+    -------
+    Tuple[List, List[Optional[HoughAccumulator]]]
+    The components (as returned by `detect_components`) and the Hough
+    accumulator of each audiogram (None if its lines were not cached).
+    """
+    return dicts_to_components(load_component_dicts(cache_file, settings))
@@ -11,25 +11,142 @@ import json
 import os
 import subprocess as sp
 import tempfile
-from typing import List, Callable
+from typing import Dict, List, Callable, Optional, Tuple, Union
 
-from tqdm import tqdm
 import numpy as np
 
-from interfaces import AudiogramDict, AudiogramAnnotationDict, ThresholdDict
-from digitizer.report_components.grid import Grid
+from interfaces import AudiogramDict, AudiogramAnnotationDict, DetectionCandidatesDict, ThresholdDict, BoundingBox
+from digitizer.cache import get_cache_file, load_components, save_components
+from digitizer.report_components.grid import Grid, GRID_THRESHOLDS
+from digitizer.report_components.hough import HoughAccumulator
 from digitizer.report_components.label import Label
 from digitizer.report_components.symbol import Symbol
-from digitizer.report_components.report import Report
+from digitizer.report_components.report import Report, ROTATION_EPSILON, DESKEW_MAX_SIZE
+from digitizer.report_components.calibration import GridCalibration
+from digitizer.templates import TemplateCache, check_calibration
 import utils.audiology as Audiology
-from utils.geometry import compute_rotation_angle, apply_rotation
+from utils.geometry import apply_rotation, get_bounding_boxes_relative_to_original_report, non_max_suppression
 
 DIR = os.path.join(pathlib.Path(__file__).parent.absolute(), "..") # current directory
 
-def detect_audiograms(filepath: str, weights: str, device: str = "cpu") -> List[AudiogramDict]:
+# With `symbols_roi`, the symbols are only detected within the grid spanning
+# SYMBOLS_ROI_FREQUENCIES and SYMBOLS_ROI_THRESHOLDS (and the labels), enlarged
+# by SYMBOLS_ROI_MARGIN times its size on every side. The whole audiogram is
+# used if the region is smaller than SYMBOLS_ROI_MIN_FRACTION of the audiogram
+# along either axis.
+SYMBOLS_ROI_FREQUENCIES = (125, 16000)
+SYMBOLS_ROI_THRESHOLDS = (-10, 120)
+SYMBOLS_ROI_MARGIN = 0.1
+SYMBOLS_ROI_MIN_FRACTION = 0.25
+
+# Inference size (in pixels) of each detector: a fixed size to which its input
+# is resized, or the (minimum, maximum) between which the longest side of its
+# input is kept, so that small audiogram crops are not upsampled. A range is
+# rounded up to a multiple of the stride of the model, and the input is only
+# padded to such a multiple. The fixed sizes are those at which the models
+# were validated; a range changes the detections, so it must be passed
+# explicitly (see `--inference_sizes`).
+INFERENCE_SIZES = {
+    "audiograms": 640,
+    "labels": 640,
+    "symbols": 640
+}
+
+# Confidence and NMS IoU thresholds of the label and symbol detectors (the
+# defaults of `detect_labels.py` and `detect_symbols.py`), and the maximum
+# number of detections each keeps per image.
+DETECTION_CONF_THRESHOLD = 0.4
+DETECTION_IOU_THRESHOLD = 0.5
+MAX_DETECTIONS = {
+    "labels": 40,
+    "symbols": 100
+}
+
+# With a cache, the label and symbol detectors keep every candidate of their
+# NMS above this confidence, so that the detections can be selected again
+# with other (no lower) thresholds (see `select_detections`).
+CANDIDATES_CONF_THRESHOLD = 0.1
+
+def get_weights_path(detector: str) -> str:
+    """Returns the path to the weights of a detector ("audiograms", "labels"
+    or "symbols"): its fused inference export (see `yolov5/models/export.py`),
+    whose memory-mapped weights are loaded faster and shared by the processes
+    running the detector, if it exists and was exported from the current
+    training checkpoint (same size and modification time), and that
+    checkpoint otherwise.
+    """
+    weights = os.path.join(DIR, "..", f"models/{detector}/latest/weights/best.pt")
+    fused_weights = weights.replace(".pt", ".fused.json")
+    if not os.path.exists(fused_weights):
+        return weights
+    if not os.path.exists(weights):
+        return fused_weights
+    with open(fused_weights) as f:
+        source = json.load(f).get("source")
+    stat = os.stat(weights)
+    if source is None or (source["size"], source["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+        return weights
+    return fused_weights
+
+def get_inference_size_args(inference_size: Union[int, Tuple[int, int]]) -> List[str]:
+    """Returns the arguments of the detection scripts for an inference size
+    (see INFERENCE_SIZES).
+    """
+    if np.isscalar(inference_size):
+        return ["--img-size", str(inference_size)]
+    return ["--img-size-range", str(inference_size[0]), str(inference_size[1])]
+
+def get_cache_settings(deskew_max_size: Optional[int] = DESKEW_MAX_SIZE, symbols_roi: bool = False, symbols_tile_size: int = 0,
+        inference_sizes: Optional[Dict[str, Union[int, Tuple[int, int]]]] = None, rotation_epsilon: float = ROTATION_EPSILON) -> dict:
+    """Returns the settings of `detect_components` that change the components
+    it detects. They are stored with the cached components, which are only
+    read with the same settings (see `digitizer.cache`).
+    """
+    return {
+        "deskewMaxSize": deskew_max_size or None,
+        "rotationEpsilon": rotation_epsilon,
+        "symbolsRoi": symbols_roi,
+        "symbolsTileSize": symbols_tile_size,
+        "inferenceSizes": { **INFERENCE_SIZES, **(inference_sizes or {}) }
+    }
+
+def get_absolute_bounding_boxes(detections: List[dict], audiogram_coordinates: dict, correction_angle: float) -> List[BoundingBox]:
+    """Converts the bounding boxes of all the detections made in an audiogram
+    to bounding boxes relative to the top-left corner of the original report,
+    in a single vectorized operation.
+
+    Parameters
+    ----------
+    detections : List[dict]
+    The detections (labels or symbols) made in the audiogram.
+    audiogram_coordinates: dict
+    The coordinates of the audiogram { "x": int, "y": int }.
+    correction_angle: float
+    The correction angle in degrees that was applied to the audiogram.
+
+    Returns
+    -------
+    List[BoundingBox]
+    The bounding boxes relative to the top-left corner of the original report.
+    """
+    bounding_boxes = get_bounding_boxes_relative_to_original_report(
+        [[d["boundingBox"][key] for key in ("x", "y", "width", "height")] for d in detections],
+        audiogram_coordinates,
+        correction_angle
+    )
+    return [
+        { "x": x, "y": y, "width": width, "height": height }
+        for x, y, width, height in bounding_boxes.tolist()
+    ]
+
+def detect_audiograms(filepath: str, weights: str, device: str = "cpu",
+        inference_size: Union[int, Tuple[int, int]] = INFERENCE_SIZES["audiograms"]) -> List[AudiogramDict]:
     """Runs the audiogram detector.
 
-    The detector is run as a subprocess.
+    The detector is run as a subprocess. Since it only looks at the report
+    downsampled to its inference size, JPEG reports are decoded at a reduced
+    resolution (see `load_image_reduced` in `yolov5/utils/datasets.py`) and
+    the bounding boxes are scaled back to the full resolution.
 
     Parameters
     ----------
@@ -39,6 +156,8 @@ def detect_audiograms(filepath: str, weights: str, device: str = "cpu") -> List[
     Path to the file holding the weights of the neural network (detector).
     device : str
     "cpu" or "gpu"
+    inference_size : Union[int, Tuple[int, int]]
+    The inference size of the detector (see INFERENCE_SIZES).
 
     Returns
     -------
@@ -51,12 +170,13 @@ def detect_audiograms(filepath: str, weights: str, device: str = "cpu") -> List[
         "--source", f"{filepath}",
         "--weights", weights,
         "--device", device
-    ], stdout=sp.PIPE) # TODO timeout should be an environment variable
+    ] + get_inference_size_args(inference_size), stdout=sp.PIPE) # TODO timeout should be an environment variable
     output = subprocess.stdout.read().decode("utf-8")
     audiograms = json.loads(output.split("$$$")[1])
     return audiograms
 
-def detect_labels(filepath: str, weights: str, audiogram_coordinates: dict, correction_angle: float, device: str = "cpu") -> List[Label]:
+def detect_labels(filepath: str, weights: str, audiogram_coordinates: dict, correction_angle: float, device: str = "cpu",
+        inference_size: Union[int, Tuple[int, int]] = INFERENCE_SIZES["labels"]) -> List[Label]:
     """Runs the label detector.
 
     The detector is run as a subprocess.
@@ -76,26 +196,24 @@ def detect_labels(filepath: str, weights: str, audiogram_coordinates: dict, corr
     Path to the file holding the weights of the neural network (detector).
     device : str
     "cpu" or "gpu"
+    inference_size : Union[int, Tuple[int, int]]
+    The inference size of the detector (see INFERENCE_SIZES).
 
     Returns
     -------
     List[Label]
     A list of Label objects (NOT LabelDict).
     """
-    subprocess = sp.Popen([
-        "python3",
-        os.path.join(DIR, "digitizer/yolov5/detect_labels.py"),
+    detections = run_detector("detect_labels.py", [
         "--source", f"{filepath}",
         "--weights", weights,
         "--device", device
-    ], stdout=sp.PIPE)
-    output = subprocess.stdout.read().decode("utf-8")
-    parsed = json.loads(output.split("$$$")[1])
-    label_dicts = parsed
-    labels = [Label(label, audiogram_coordinates, correction_angle) for label in parsed]
-    return labels
+    ] + get_inference_size_args(inference_size))
+    return detections_to_labels(detections, audiogram_coordinates, correction_angle)
 
-def detect_symbols(filepath: str, weights: str, audiogram_coordinates: dict, correction_angle: float, device: str = "cpu") -> List[Symbol]:
+def detect_symbols(filepath: str, weights: str, audiogram_coordinates: dict, correction_angle: float, device: str = "cpu",
+        roi_coordinates: Optional[dict] = None, tile_size: int = 0,
+        inference_size: Union[int, Tuple[int, int]] = INFERENCE_SIZES["symbols"]) -> List[Symbol]:
     """Runs the symbol detector.
 
     The detector is run as a subprocess.
@@ -115,25 +233,196 @@ def detect_symbols(filepath: str, weights: str, audiogram_coordinates: dict, cor
     Path to the file holding the weights of the neural network (detector).
     device : str
     "cpu" or "gpu"
+    roi_coordinates : Optional[dict]
+    The coordinates { "x": int, "y": int } of the region of the audiogram
+    that the image is, if not the whole audiogram (see `get_symbols_roi`).
+    tile_size : int
+    If positive, the detector is run at native resolution on overlapping
+    tiles of this size (in pixels), rather than on the image resized to its
+    inference size (default: 0).
+    inference_size : Union[int, Tuple[int, int]]
+    The inference size of the detector, without tiling (see INFERENCE_SIZES).
 
     Returns
     -------
     List[Label]
     A list of Symbol objects (NOT SymbolDict).
     """
-    subprocess = sp.Popen([
-        "python3",
-        os.path.join(DIR, "digitizer/yolov5/detect_symbols.py"),
+    detections = run_detector("detect_symbols.py", [
         "--source", filepath,
         "--weights", weights,
-        "--device", device
-    ], stdout=sp.PIPE)
+        "--device", device,
+        "--tile-size", str(tile_size)
+    ] + get_inference_size_args(inference_size))
+    if roi_coordinates is not None:
+        for detection in detections:
+            detection["boundingBox"]["x"] += roi_coordinates["x"]
+            detection["boundingBox"]["y"] += roi_coordinates["y"]
+    return detections_to_symbols(detections, audiogram_coordinates, correction_angle)
+
+def run_detector(script: str, args: List[str]) -> list:
+    """Runs a detection script of `yolov5` as a subprocess and returns the
+    JSON it prints between "$$$" markers.
+    """
+    subprocess = sp.Popen(["python3", os.path.join(DIR, "digitizer/yolov5", script)] + args, stdout=sp.PIPE)
+    return json.loads(subprocess.stdout.read().decode("utf-8").split("$$$")[1])
+
+def detect_candidates(detector: str, filepath: str, weights: str, device: str = "cpu",
+        roi_coordinates: Optional[dict] = None, tile_size: int = 0,
+        inference_size: Optional[Union[int, Tuple[int, int]]] = None) -> DetectionCandidatesDict:
+    """Runs the label or symbol detector, but only up to the candidates of
+    its non-maximum suppression (above CANDIDATES_CONF_THRESHOLD), from which
+    its detections can be selected with `select_detections`.
+
+    Parameters
+    ----------
+    detector : str
+    "labels" or "symbols".
+    filepath : str
+    Path to the image on which the detector is to be run.
+    weights : str
+    Path to the file holding the weights of the neural network (detector).
+    device : str
+    "cpu" or "gpu"
+    roi_coordinates : Optional[dict]
+    See `detect_symbols` (default: None).
+    tile_size : int
+    See `detect_symbols` (default: 0).
+    inference_size : Optional[Union[int, Tuple[int, int]]]
+    The inference size of the detector, or None for INFERENCE_SIZES (default: None).
 
-    output = json.loads(subprocess.stdout.read().decode("utf-8").split("$$$")[1])
-    symbols = [Symbol(detection, audiogram_coordinates, correction_angle) for detection in output]
-    return symbols
+    Returns
+    -------
+    DetectionCandidatesDict
+    The candidates of the detector in the image.
+    """
+    args = ["--source", filepath, "--weights", weights, "--device", device,
+            "--conf-thres", str(CANDIDATES_CONF_THRESHOLD), "--candidates"]
+    if detector == "symbols":
+        args += ["--tile-size", str(tile_size)]
+    images = run_detector(f"detect_{detector}.py", args + get_inference_size_args(inference_size or INFERENCE_SIZES[detector]))
+    return {
+        "confThreshold": CANDIDATES_CONF_THRESHOLD,
+        "imageShape": images[0]["imageShape"],
+        "offset": { "x": roi_coordinates["x"], "y": roi_coordinates["y"] } if roi_coordinates is not None else { "x": 0, "y": 0 },
+        "candidates": images[0]["candidates"]
+    }
+
+def select_detections(candidates: DetectionCandidatesDict, class_key: str, conf_threshold: float = DETECTION_CONF_THRESHOLD,
+        iou_threshold: float = DETECTION_IOU_THRESHOLD, max_detections: int = MAX_DETECTIONS["symbols"]) -> List[dict]:
+    """Selects the detections of the label or symbol detector from the
+    candidates of its non-maximum suppression, as `non_max_suppression` of
+    `yolov5/utils/general.py` and the detection script would: the candidates
+    above `conf_threshold`, suppressed per class above `iou_threshold`, the
+    `max_detections` most confident kept, then clipped to the image and
+    rounded.
+
+    Parameters
+    ----------
+    candidates : DetectionCandidatesDict
+    The candidates (see `detect_candidates`).
+    class_key : str
+    The key holding the class of the detections ("text" or "measurementType").
+    conf_threshold : float
+    The confidence threshold, no lower than that of the candidates (default: DETECTION_CONF_THRESHOLD).
+    iou_threshold : float
+    The NMS IoU threshold (default: DETECTION_IOU_THRESHOLD).
+    max_detections : int
+    The maximum number of detections (default: MAX_DETECTIONS["symbols"]).
 
-def detect_components(filepath: str, gpu: bool = False) -> List:
+    Returns
+    -------
+    List[dict]
+    The detections, as printed by the detection script.
+    """
+    assert conf_threshold >= candidates["confThreshold"], \
+        f"The candidates were only kept above a confidence of {candidates['confThreshold']}, not {conf_threshold}."
+    rows = [row for row in candidates["candidates"] if row[4] > conf_threshold]
+    if len(rows) == 0:
+        return []
+    boxes = np.array([row[:4] for row in rows], dtype=float)
+    scores = np.array([row[4] for row in rows], dtype=float)
+    classes = np.array([row[5] for row in rows])
+
+    kept = []
+    for value in np.unique(classes):
+        indices = np.flatnonzero(classes == value)
+        kept += indices[non_max_suppression(np.column_stack([boxes[indices, :2], boxes[indices, 2:] - boxes[indices, :2]]),
+                scores[indices], iou_threshold)].tolist()
+    kept = sorted(kept, key=lambda i: -scores[i])[:max_detections]
+
+    height, width = candidates["imageShape"]
+    clipped = np.round(np.clip(boxes[kept], 0, [width, height, width, height]))
+    offset = candidates["offset"]
+    return [{
+        class_key: str(classes[i]),
+        "boundingBox": {
+            "x": int(x1) + offset["x"],
+            "y": int(y1) + offset["y"],
+            "width": int(x2 - x1),
+            "height": int(y2 - y1)
+        },
+        "confidence": float(scores[i])
+    } for i, (x1, y1, x2, y2) in reversed(list(zip(kept, clipped)))]
+
+def detections_to_labels(detections: List[dict], audiogram_coordinates: dict, correction_angle: float) -> List[Label]:
+    """Returns the Label objects of the detections of the label detector
+    (see `detect_labels`).
+    """
+    absolute_bounding_boxes = get_absolute_bounding_boxes(detections, audiogram_coordinates, correction_angle)
+    return [
+        Label(label, audiogram_coordinates, correction_angle, absolute_bounding_box=bounding_box)
+        for label, bounding_box in zip(detections, absolute_bounding_boxes)
+    ]
+
+def detections_to_symbols(detections: List[dict], audiogram_coordinates: dict, correction_angle: float) -> List[Symbol]:
+    """Returns the Symbol objects of the detections of the symbol detector
+    (see `detect_symbols`).
+    """
+    absolute_bounding_boxes = get_absolute_bounding_boxes(detections, audiogram_coordinates, correction_angle)
+    return [
+        Symbol(detection, audiogram_coordinates, correction_angle, absolute_bounding_box=bounding_box)
+        for detection, bounding_box in zip(detections, absolute_bounding_boxes)
+    ]
+
+def get_symbols_roi(calibration: GridCalibration, labels: List[Label], width: int, height: int, margin: float = SYMBOLS_ROI_MARGIN) -> Optional[BoundingBox]:
+    """Returns the region of an audiogram in which its symbols may be: its
+    grid, as located by the calibration, and its labels, plus a margin.
+
+    Parameters
+    ----------
+    calibration : GridCalibration
+    The calibration of the grid of the audiogram.
+    labels : List[Label]
+    The labels of the audiogram, which delimit its axes when they extend
+    beyond SYMBOLS_ROI_FREQUENCIES and SYMBOLS_ROI_THRESHOLDS.
+    width : int
+    The width of the (deskewed) audiogram.
+    height : int
+    The height of the (deskewed) audiogram.
+    margin : float
+    The margin, as a fraction of the size of the grid (default: SYMBOLS_ROI_MARGIN).
+
+    Returns
+    -------
+    Optional[BoundingBox]
+    The region, relative to the top-left corner of the audiogram, or None if
+    it is too small to be plausible (see SYMBOLS_ROI_MIN_FRACTION).
+    """
+    xs, ys = calibration.inverse(np.array(SYMBOLS_ROI_FREQUENCIES), np.array(SYMBOLS_ROI_THRESHOLDS))
+    x_margin, y_margin = margin * abs(xs[1] - xs[0]), margin * abs(ys[1] - ys[0])
+    xs = np.concatenate([xs] + [[label.x1, label.x2] for label in labels])
+    ys = np.concatenate([ys] + [[label.y1, label.y2] for label in labels])
+    x1, x2 = max(int(np.floor(xs.min() - x_margin)), 0), min(int(np.ceil(xs.max() + x_margin)), width)
+    y1, y2 = max(int(np.floor(ys.min() - y_margin)), 0), min(int(np.ceil(ys.max() + y_margin)), height)
+    if x2 - x1 < SYMBOLS_ROI_MIN_FRACTION * width or y2 - y1 < SYMBOLS_ROI_MIN_FRACTION * height:
+        return None
+    return { "x": x1, "y": y1, "width": x2 - x1, "height": y2 - y1 }
+
+def detect_components(filepath: str, gpu: bool = False, rotation_epsilon: float = ROTATION_EPSILON, deskew_max_size: Optional[int] = DESKEW_MAX_SIZE,
+        cache_dir: Optional[str] = None, template_cache: Optional[TemplateCache] = None, symbols_roi: bool = False,
+        symbols_tile_size: int = 0, inference_sizes: Optional[Dict[str, Union[int, Tuple[int, int]]]] = None,
+        need_labels: bool = True, keep_candidates: bool = False) -> List:
     """Invokes the object detectors.
 
     Parameters
@@ -142,6 +431,37 @@ def detect_components(filepath: str, gpu: bool = False) -> List:
     Path to the image.
     gpu : bool
     Whether the GPU should be used (default: False).
+    rotation_epsilon : float
+    Correction angles (in degrees) smaller than this are not applied to the
+    audiograms (default: ROTATION_EPSILON).
+    deskew_max_size : Optional[int]
+    Size (in pixels) down to which the audiograms are downsampled to estimate
+    their correction angle, or None for full resolution (default: DESKEW_MAX_SIZE).
+    cache_dir : Optional[str]
+    If provided, the components are also written to this directory (see
+    `digitizer.cache`) (default: None).
+    template_cache : Optional[TemplateCache]
+    If provided, the audiograms of a report matching a known template are
+    not detected: the bounding boxes and correction angles of the template
+    are used. The layouts of the other reports are added to the cache
+    (default: None).
+    symbols_roi : bool
+    Whether the grid of each audiogram is calibrated before its symbols are
+    detected, so that the symbol detector only processes the grid (see
+    `get_symbols_roi`) rather than the whole audiogram (default: False).
+    symbols_tile_size : int
+    If positive, the symbols are detected at native resolution on
+    overlapping tiles of this size (see `detect_symbols`) (default: 0).
+    inference_sizes : Optional[Dict[str, Union[int, Tuple[int, int]]]]
+    The inference size of the "audiograms", "labels" and "symbols" detectors
+    that differ from INFERENCE_SIZES (default: None).
+    need_labels : bool
+    Whether the labels are needed even when the grid is calibrated from a
+    template, e.g. for an annotation (default: True).
+    keep_candidates : bool
+    Whether the candidates of the NMS of the label and symbol detectors are
+    kept (see `detect_candidates`), as they are with a `cache_dir`, and the
+    labels and symbols selected from them (default: False).
     
     Returns
     -------
@@ -151,27 +471,60 @@ def detect_components(filepath: str, gpu: bool = False) -> List:
       { "audiogram": AudiogramDict, "labels": List[Label], "symbols": List[Symbol] }, # plot 1
       { "audiogram": AudiogramDict, "labels": List[Label], "symbols": List[Symbol] } # plot 2
     ]
+    With a `template_cache`, each component also holds its "templateAudiogram"
+    (TemplateAudiogramDict) and, when the cached grid calibration of the
+    template passes `check_calibration`, that "calibration" (GridCalibration).
+    The "labels" are then None (not detected) unless `need_labels`. The
+    "calibration" of the other audiograms is None: with `symbols_roi`, the
+    grid fitted to locate their symbols is not final, and their Hough
+    "accumulator" (HoughAccumulator) is kept so that the grid can be fitted
+    again (see `extract_thresholds`). With `keep_candidates`, each component
+    also holds the "candidates" (DetectionCandidatesDict) of the "labels"
+    (None when these are not detected) and "symbols" detectors.
     """
 
     components = []
-
-    # Detect audiograms within the report
-    audiogram_model_weights_path = os.path.join(DIR, "..", "models/audiograms/latest/weights/best.pt")
-    audiograms = detect_audiograms(f"{filepath}", audiogram_model_weights_path)
+    # The calibrations fitted to locate the symbols that are consistent
+    # with the grid lines (None otherwise), for the new templates
+    checked_calibrations = []
+    cache_settings = get_cache_settings(deskew_max_size, symbols_roi, symbols_tile_size, inference_sizes, rotation_epsilon)
+    inference_sizes = { **INFERENCE_SIZES, **(inference_sizes or {}) }
+    keep_candidates = keep_candidates or bool(cache_dir)
+
+    # Load the report once, in color, since the crops are fed to the
+    # label and symbol detectors. It is only needed before the audiograms
+    # are detected when the report may match a known template.
+    full_report = Report(filename=filepath, grayscale=False) if template_cache is not None else None
+    template = template_cache.match(full_report) if template_cache is not None else None
+
+    if template is not None:
+        # The audiograms of the template (with their correction angles) are
+        # where the template expects them
+        audiograms = [{
+            "boundingBox": dict(audiogram["boundingBox"]),
+            "confidence": audiogram["confidence"],
+            "correctionAngle": audiogram["correctionAngle"]
+        } for audiogram in template["audiograms"]]
+    else:
+        # Detect audiograms within the report
+        audiogram_model_weights_path = get_weights_path("audiograms")
+        audiograms = detect_audiograms(f"{filepath}", audiogram_model_weights_path, inference_size=inference_sizes["audiograms"])
 
     # If no audiogram is detected, return...
     if len(audiograms) == 0:
+        if cache_dir:
+            save_components(get_cache_file(cache_dir, filepath), components, settings=cache_settings)
         return components
 
+    if full_report is None:
+        full_report = Report(filename=filepath, grayscale=False)
+
     # Iterate through every audiogram in the report
     for i, audiogram in enumerate(audiograms):
         components.append({})
 
-        # Load the report
-        report = Report(filename=filepath)
-
-        # Generate a cropped version of the report around the detected audiogram
-        report = report.crop(
+        # Generate a cropped version (a view) of the report around the detected audiogram
+        report = full_report.crop(
             audiogram["boundingBox"]["x"],
             audiogram["boundingBox"]["y"],
             audiogram["boundingBox"]["x"] + audiogram["boundingBox"]["width"],
@@ -182,16 +535,13 @@ def detect_components(filepath: str, gpu: bool = False) -> List:
         cropped_file = tempfile.NamedTemporaryFile(suffix=".jpg")
 
         # Correct for rotation
-        lines = report.detect_lines(threshold=200)
-        perpendicular_lines = [
-            line for line in lines
-            if line.has_a_perpendicular_line(lines)
-            and (abs(line.get_angle() - 90) < 10
-            or  abs(line.get_angle()) < 10)
-        ]
-        correction_angle = compute_rotation_angle(perpendicular_lines)
+        if template is not None:
+            correction_angle = audiogram["correctionAngle"]
+        else:
+            correction_angle = report.estimate_correction_angle(max_size=deskew_max_size)
+        report = full_report.crop_rotated(audiogram["boundingBox"], correction_angle, epsilon=rotation_epsilon)
+        correction_angle = report.get_rotation_angle()
         audiogram["correctionAngle"] = correction_angle
-        report = report.rotate(correction_angle)
         report.save(cropped_file.name)
 
         audiogram_coordinates = {
@@ -201,14 +551,138 @@ def detect_components(filepath: str, gpu: bool = False) -> List:
 
         components[i]["audiogram"] = audiogram
 
-        labels_model_weights_path = os.path.join(DIR, "..", "models/labels/latest/weights/best.pt")
-        components[i]["labels"] = detect_labels(cropped_file.name, labels_model_weights_path, audiogram_coordinates, correction_angle)
-        symbols_model_weights_path = os.path.join(DIR, "..", "models/symbols/latest/weights/best.pt")
-        components[i]["symbols"] = detect_symbols(cropped_file.name, symbols_model_weights_path, audiogram_coordinates, correction_angle)
+        # The grid of an audiogram of a known template is calibrated like
+        # that of the template, if its grid lines are where expected
+        calibration = None
+        if template is not None:
+            template_audiogram = template["audiograms"][i]
+            components[i]["templateAudiogram"] = template_audiogram
+            if template_audiogram.get("calibration") is not None:
+                calibration = GridCalibration.from_dict(template_audiogram["calibration"])
+                if not check_calibration(report.get_grayscale(), calibration):
+                    calibration = None
+
+        if keep_candidates:
+            components[i]["candidates"] = { "labels": None, "symbols": None }
+        if calibration is None or need_labels:
+            labels_model_weights_path = get_weights_path("labels")
+            if keep_candidates:
+                candidates = detect_candidates("labels", cropped_file.name, labels_model_weights_path,
+                        inference_size=inference_sizes["labels"])
+                components[i]["candidates"]["labels"] = candidates
+                components[i]["labels"] = detections_to_labels(select_detections(candidates, "text", max_detections=MAX_DETECTIONS["labels"]),
+                        audiogram_coordinates, correction_angle)
+            else:
+                components[i]["labels"] = detect_labels(cropped_file.name, labels_model_weights_path, audiogram_coordinates, correction_angle,
+                        inference_size=inference_sizes["labels"])
+        else:
+            components[i]["labels"] = None
+
+        components[i]["calibration"] = calibration
+
+        # Calibrate the grid first, so that the symbols are only detected within it
+        roi = None
+        if symbols_roi:
+            roi_calibration = calibration
+            if calibration is None:
+                components[i]["accumulator"] = report.hough_accumulator(min_threshold=min(GRID_THRESHOLDS))
+                try:
+                    roi_calibration = Grid.from_accumulator(
+                        components[i]["accumulator"],
+                        components[i]["labels"],
+                        threshold=GRID_THRESHOLDS,
+                        rotation=correction_angle
+                    ).calibration
+                    checked = check_calibration(report.get_grayscale(), roi_calibration)
+                    checked_calibrations.append(roi_calibration if checked else None)
+                except Exception:
+                    checked_calibrations.append(None)
+            if roi_calibration is not None:
+                roi = get_symbols_roi(roi_calibration, components[i]["labels"] or [], report.width, report.height)
+
+        symbols_model_weights_path = get_weights_path("symbols")
+        if roi is not None:
+            report.crop(roi["x"], roi["y"], roi["x"] + roi["width"], roi["y"] + roi["height"]).save(cropped_file.name)
+        if keep_candidates:
+            candidates = detect_candidates("symbols", cropped_file.name, symbols_model_weights_path, roi_coordinates=roi,
+                    tile_size=symbols_tile_size, inference_size=inference_sizes["symbols"])
+            components[i]["candidates"]["symbols"] = candidates
+            components[i]["symbols"] = detections_to_symbols(select_detections(candidates, "measurementType"),
+                    audiogram_coordinates, correction_angle)
+        else:
+            components[i]["symbols"] = detect_symbols(cropped_file.name, symbols_model_weights_path, audiogram_coordinates, correction_angle,
+                    roi_coordinates=roi, tile_size=symbols_tile_size, inference_size=inference_sizes["symbols"])
+
+    # Learn the layout of the reports that did not match a known template,
+    # with the grid calibrations fitted above if they are consistent with
+    # the grid lines
+    if template_cache is not None and template is None:
+        template = template_cache.add(full_report, audiograms)
+        for component, template_audiogram, checked_calibration in zip(components, template["audiograms"],
+                checked_calibrations or [None] * len(components)):
+            component["templateAudiogram"] = template_audiogram
+            if checked_calibration is not None:
+                template_cache.set_calibration(template_audiogram, checked_calibration)
+
+    if cache_dir:
+        save_components(get_cache_file(cache_dir, filepath), components,
+                [component.get("accumulator") for component in components], settings=cache_settings)
 
     return components
 
-def generate_partial_annotation(filepath: str, gpu: bool = False) -> List[AudiogramAnnotationDict]:
+def load_or_detect_components(filepath: str, gpu: bool = False, deskew_max_size: Optional[int] = DESKEW_MAX_SIZE,
+        cache_dir: Optional[str] = None, from_cache: bool = False, template_cache: Optional[TemplateCache] = None,
+        symbols_roi: bool = False, symbols_tile_size: int = 0,
+        inference_sizes: Optional[Dict[str, Union[int, Tuple[int, int]]]] = None,
+        need_labels: bool = True) -> Tuple[List, List[Optional[HoughAccumulator]]]:
+    """Reads the components of the report from the cache if `from_cache` is
+    True, or runs the object detectors otherwise.
+
+    Parameters
+    ----------
+    filepath : str
+    Path to the image.
+    gpu : bool
+    Whether the GPU should be used (default: False).
+    deskew_max_size : Optional[int]
+    See `detect_components`.
+    cache_dir : Optional[str]
+    The cache directory, to which the caller writes the components: the
+    candidates of the detectors are then kept (default: None).
+    from_cache : bool
+    Whether the components are read from `cache_dir` (default: False). They
+    must have been detected with the same settings (see `get_cache_settings`).
+    template_cache : Optional[TemplateCache]
+    See `detect_components` (default: None).
+    symbols_roi : bool
+    See `detect_components` (default: False).
+    symbols_tile_size : int
+    See `detect_components` (default: 0).
+    inference_sizes : Optional[Dict[str, Union[int, Tuple[int, int]]]]
+    See `detect_components` (default: None).
+    need_labels : bool
+    See `detect_components` (default: True).
+
+    Returns
+    -------
+    Tuple[List, List[Optional[HoughAccumulator]]]
+    The components (see `detect_components`) and the cached (or, with
+    `symbols_roi`, computed) Hough accumulator of each audiogram (None
+    otherwise).
+    """
+    if from_cache:
+        assert cache_dir, "A cache directory is required to read the components from the cache."
+        return load_components(get_cache_file(cache_dir, filepath),
+                settings=get_cache_settings(deskew_max_size, symbols_roi, symbols_tile_size, inference_sizes))
+    components = detect_components(filepath, gpu=gpu, deskew_max_size=deskew_max_size, template_cache=template_cache,
+            symbols_roi=symbols_roi, symbols_tile_size=symbols_tile_size, inference_sizes=inference_sizes,
+            need_labels=need_labels, keep_candidates=bool(cache_dir))
+    return components, [component.pop("accumulator", None) for component in components]
+
+def generate_partial_annotation(filepath: str, gpu: bool = False, deskew_max_size: Optional[int] = DESKEW_MAX_SIZE,
+        cache_dir: Optional[str] = None, from_cache: bool = False, template_cache: Optional[TemplateCache] = None,
+        symbols_roi: bool = False, symbols_tile_size: int = 0,
+        inference_sizes: Optional[Dict[str, Union[int, Tuple[int, int]]]] = None) -> List[AudiogramAnnotationDict]:
     """Generates a seed annotation to be completed in the nihl portal.
 
     It is ``partial`` because it does not locate the corners of the audiogram.
@@ -219,15 +693,38 @@ def generate_partial_annotation(filepath: str, gpu: bool = False) -> List[Audiog
     Path to the file for which an initial annotation is to b
     gpu : bool
     Whether the gpu should be used.
+    deskew_max_size : Optional[int]
+    Size (in pixels) down to which the audiograms are downsampled to estimate
+    their correction angle, or None for full resolution (default: DESKEW_MAX_SIZE).
+    cache_dir : Optional[str]
+    Directory where the detected components are cached (default: None).
+    from_cache : bool
+    Whether the components are read from `cache_dir` instead of running the
+    object detectors (default: False).
+    template_cache : Optional[TemplateCache]
+    Cache of the known report templates (see `detect_components`) (default: None).
+    symbols_roi : bool
+    Whether the symbols are only detected within the grid (see `detect_components`) (default: False).
+    symbols_tile_size : int
+    Size of the tiles on which the symbols are detected, or 0 for no tiling (see `detect_components`) (default: 0).
+    inference_sizes : Optional[Dict[str, Union[int, Tuple[int, int]]]]
+    The inference sizes of the detectors that differ from INFERENCE_SIZES (see `detect_components`) (default: None).
 
     Returns
     -------
     List[AudiogramAnnotationDict]
     An Annotation dict.
     """
-    components = detect_components(filepath, gpu=gpu)
+    if from_cache:
+        components, _ = load_or_detect_components(filepath, deskew_max_size=deskew_max_size, cache_dir=cache_dir, from_cache=True,
+                symbols_roi=symbols_roi, symbols_tile_size=symbols_tile_size, inference_sizes=inference_sizes)
+    else:
+        components = detect_components(filepath, gpu=gpu, deskew_max_size=deskew_max_size, cache_dir=cache_dir, template_cache=template_cache,
+                symbols_roi=symbols_roi, symbols_tile_size=symbols_tile_size, inference_sizes=inference_sizes)
     audiograms = []
     for i in range(len(components)):
+        if components[i]["labels"] is None:
+            raise ValueError(f"The labels of {filepath} were not detected (see `extract_thresholds`): its components cannot be annotated.")
         audiogram = components[i]["audiogram"]
         audiogram["labels"] = [label.to_dict() for label in components[i]["labels"]]
         audiogram["symbols"] = [symbol.to_dict() for symbol in components[i]["symbols"]]
@@ -235,7 +732,10 @@ def generate_partial_annotation(filepath: str, gpu: bool = False) -> List[Audiog
         audiograms.append(audiogram)
     return audiograms
 
-def extract_thresholds(filepath: str, gpu: bool = False) -> List[ThresholdDict]:
+def extract_thresholds(filepath: str, gpu: bool = False, line_detection: str = "hough", deskew_max_size: Optional[int] = DESKEW_MAX_SIZE,
+        cache_dir: Optional[str] = None, from_cache: bool = False, template_cache: Optional[TemplateCache] = None,
+        symbols_roi: bool = False, symbols_tile_size: int = 0,
+        inference_sizes: Optional[Dict[str, Union[int, Tuple[int, int]]]] = None) -> List[ThresholdDict]:
     """Extracts the thresholds from the report.
 
     parameters
@@ -244,50 +744,117 @@ def extract_thresholds(filepath: str, gpu: bool = False) -> List[ThresholdDict]:
     Path to the file for which an initial annotation is to b
     gpu : bool
     Whether the gpu should be used.
+    line_detection : str
+    The method used to detect the grid lines, `hough` or `projection`
+    (default: `hough`).
+    deskew_max_size : Optional[int]
+    Size (in pixels) down to which the audiograms are downsampled to estimate
+    their correction angle, or None for full resolution (default: DESKEW_MAX_SIZE).
+    cache_dir : Optional[str]
+    Directory where the detected components and the Hough lines of the
+    audiograms are cached (default: None).
+    from_cache : bool
+    Whether the components and lines are read from `cache_dir`, in which case
+    only the grids are fitted, without the object detectors and, with the
+    Hough transform, without even the image (default: False).
+    template_cache : Optional[TemplateCache]
+    Cache of the known report templates (see `detect_components`). The grid
+    calibrations of the audiograms of new templates are added to it (default: None).
+    symbols_roi : bool
+    Whether the symbols are only detected within the grid (see
+    `detect_components`), in which case the grids are also fitted with the
+    Hough transform before the symbols are detected. Its lines are reused
+    to fit the grids again here (default: False).
+    symbols_tile_size : int
+    Size of the tiles on which the symbols are detected, or 0 for no tiling (see `detect_components`) (default: 0).
+    inference_sizes : Optional[Dict[str, Union[int, Tuple[int, int]]]]
+    The inference sizes of the detectors that differ from INFERENCE_SIZES (see `detect_components`) (default: None).
 
     Returns
     -------
     list[ThresholdDict]
     A list of thresholds.
     """
-    components = detect_components(filepath, gpu=gpu)
+    components, accumulators = load_or_detect_components(filepath, gpu=gpu, deskew_max_size=deskew_max_size,
+            cache_dir=cache_dir, from_cache=from_cache, template_cache=template_cache, symbols_roi=symbols_roi,
+            symbols_tile_size=symbols_tile_size, inference_sizes=inference_sizes, need_labels=False)
 
     thresholds = []
 
+    full_report = None
+
     # For each audiogram, extract the thresholds and append them to the
     # thresholds list
     for i in range(len(components)):
         audiogram = components[i]["audiogram"]
         labels = components[i]["labels"]
         symbols = components[i]["symbols"]
-
-        report = Report(filename=filepath)
-        report = report.crop(
-            audiogram["boundingBox"]["x"],
-            audiogram["boundingBox"]["y"],
-            audiogram["boundingBox"]["x"] + audiogram["boundingBox"]["width"],
-            audiogram["boundingBox"]["y"] + audiogram["boundingBox"]["height"]
-        )
-        report = report.rotate(audiogram["correctionAngle"])
+        calibration = components[i].get("calibration")
+        report = None
 
         try:
-            grid = Grid(report, labels)
+            if calibration is not None:
+                grid = Grid.from_calibration(calibration)
+            elif line_detection == "hough" and accumulators[i] is not None:
+                grid = Grid.from_accumulator(accumulators[i], labels, threshold=GRID_THRESHOLDS, rotation=audiogram["correctionAngle"])
+            else:
+                # The image is only needed when the lines are not cached
+                if full_report is None:
+                    full_report = Report(filename=filepath)
+                report = full_report.crop_rotated(audiogram["boundingBox"], audiogram["correctionAngle"])
+                if line_detection == "hough":
+                    accumulators[i] = report.hough_accumulator(min_threshold=min(GRID_THRESHOLDS))
+                    grid = Grid.from_accumulator(accumulators[i], labels, threshold=GRID_THRESHOLDS, rotation=report.get_rotation_angle())
+                else:
+                    grid = Grid(report, labels, threshold=GRID_THRESHOLDS, line_detection=line_detection)
         except Exception as e:
             continue
 
-        thresholds += [{
-            "ear": symbol.ear,
-            "conduction": symbol.conduction,
-            "masking": symbol.masking,
-            "measurementType": Audiology.stringify_measurement(symbol.to_dict()),
-            "frequency": grid.get_snapped_frequency(symbol),
-            "threshold": grid.get_snapped_threshold(symbol),
-            "response": True # IMPORTANT: assume that a response was obtain for measurements
-            }
-            for symbol in symbols
-        ]
+        # Remember the calibration of the grid of a new template, provided
+        # that it is consistent with its grid lines
+        template_audiogram = components[i].get("templateAudiogram")
+        if template_cache is not None and template_audiogram is not None and calibration is None \
+                and report is not None and check_calibration(report.get_grayscale(), grid.calibration):
+            template_cache.set_calibration(template_audiogram, grid.calibration)
+
+        thresholds += get_snapped_thresholds(grid, symbols)
+
+    if cache_dir and not from_cache:
+        save_components(get_cache_file(cache_dir, filepath), components, accumulators,
+                settings=get_cache_settings(deskew_max_size, symbols_roi, symbols_tile_size, inference_sizes))
+
     return thresholds
 
+def get_snapped_thresholds(grid: Grid, symbols: List[Symbol], epsilon: float = 0.15) -> List[ThresholdDict]:
+    """Snaps all the symbols of an audiogram to its grid at once.
+
+    Parameters
+    ----------
+    grid : Grid
+    The grid of the audiogram.
+    symbols : List[Symbol]
+    The symbols detected in the audiogram.
+    epsilon : float
+    See `Grid.get_snapped_values` (default: 0.15).
+
+    Returns
+    -------
+    List[ThresholdDict]
+    The threshold of each symbol.
+    """
+    frequencies, thresholds = grid.get_snapped_values(symbols, epsilon=epsilon)
+    return [{
+        "ear": symbol.ear,
+        "conduction": symbol.conduction,
+        "masking": symbol.masking,
+        "measurementType": Audiology.stringify_measurement(symbol.to_dict()),
+        "frequency": frequency,
+        "threshold": threshold,
+        "response": True # IMPORTANT: assume that a response was obtain for measurements
+        }
+        for symbol, frequency, threshold in zip(symbols, frequencies.tolist(), thresholds.tolist())
+    ]
+
 def get_correction_angle(corners: List[dict]) -> float:
     """Computes the rotation angle that must be applied based on
     corner coordinates to get an unrotated audiogram.
@@ -381,34 +948,42 @@ def annotation_to_thresholds(audiograms: dict) -> List[ThresholdDict]:
         corners = [apply_rotation(corner, correction_angle) for corner in audiogram["corners"]]
         frequency_map, threshold_map, inverse_frequency_map, inverse_threshold_map = get_conversion_maps(corners)
 
-        thresholds: List[ThresholdDict] = []
-        for symbol in audiogram["symbols"]:
-            symbol_center = {
-                "x": symbol["boundingBox"]["x"] + symbol["boundingBox"]["width"] / 2,
-                "y": symbol["boundingBox"]["y"] + symbol["boundingBox"]["height"] / 2,
+        symbols = audiogram["symbols"]
+        if len(symbols) == 0:
+            continue
+
+        # Rotate the centers of all the symbols at once and map them to
+        # frequencies and thresholds as arrays
+        bounding_boxes = np.array([
+            [s["boundingBox"][key] for key in ("x", "y", "width", "height")]
+            for s in symbols
+        ], dtype=float)
+        centers = apply_rotation(bounding_boxes[:, :2] + bounding_boxes[:, 2:] / 2, correction_angle)
+
+        measurement_types = [s["measurementType"].lower() for s in symbols]
+        ears = np.array(["left" if "left" in m else "right" for m in measurement_types])
+        air = np.array(["air" in m for m in measurement_types], dtype=bool)
+        masking = ["unmasked" not in m for m in measurement_types]
+
+        raw_frequencies = frequency_map(centers[:, 0])
+        frequencies = np.where(
+            air,
+            Audiology.round_frequencies(raw_frequencies),
+            Audiology.round_frequencies_bone(raw_frequencies, ears)
+        )
+        thresholds = Audiology.round_thresholds(threshold_map(centers[:, 1]))
+
+        combined_thresholds += [{
+            "ear": ear,
+            "conduction": "air" if is_air else "bone",
+            "masking": is_masked,
+            "frequency": frequency,
+            "threshold":  threshold,
+            "response": True, # IMPORTANT: assume that a response was measured for threshold
+            "measurementType": f"{'air' if is_air else 'bone'}_{'MASKED' if is_masked else 'UNMASKED'}_{ear}".upper()
             }
-            symbol = { **symbol, "boundingBox": symbol_center }
-            new_symbol = {**symbol, "boundingBox": apply_rotation(symbol["boundingBox"], correction_angle) }
-            bounding_box = new_symbol["boundingBox"]
-            ear = "left" if "left" in new_symbol["measurementType"].lower() else "right"
-            conduction = "air" if "air" in new_symbol["measurementType"].lower() else "bone"
-            masking = False if "unmasked" in new_symbol["measurementType"].lower() else True
-            if conduction == "air":
-                frequency = Audiology.round_frequency(frequency_map(bounding_box["x"]))
-            else:
-                frequency = Audiology.round_frequency_bone(frequency_map(bounding_box["x"]), ear)
-            threshold = Audiology.round_threshold(threshold_map(bounding_box["y"]))
-
-            thresholds.append({
-                "ear": ear,
-                "conduction": conduction,
-                "masking": masking,
-                "frequency": frequency,
-                "threshold":  threshold,
-                "response": True, # IMPORTANT: assume that a response was measured for threshold
-                "measurementType": f"{conduction}_{'MASKED' if masking else 'UNMASKED'}_{ear}".upper()
-            })
-
-        combined_thresholds += thresholds
+            for ear, is_air, is_masked, frequency, threshold
+            in zip(ears.tolist(), air.tolist(), masking, frequencies.tolist(), thresholds.tolist())
+        ]
 
     return combined_thresholds
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+from interfaces import GridCalibrationDict
+import utils.audiology as Audiology
+
+class GridCalibration(object):
+
+    __slots__ = ("octave_scale", "octave_offset", "threshold_scale", "threshold_offset", "rotation")
+
+    def __init__(self, octave_scale: float, octave_offset: float, threshold_scale: float, threshold_offset: float, rotation: float = 0):
+        """The affine calibration of an audiogram grid.
+
+        The x axis is linear in octaves (the frequency axis is logarithmic)
+        and the y axis is linear in dB:
+
+            octave = octave_scale * x + octave_offset
+            threshold = threshold_scale * y + threshold_offset
+
+        where (x, y) are pixel coordinates in the audiogram after the
+        `rotation` (in degrees) was applied to it.
+        """
+        self.octave_scale = float(octave_scale)
+        self.octave_offset = float(octave_offset)
+        self.threshold_scale = float(threshold_scale)
+        self.threshold_offset = float(threshold_offset)
+        self.rotation = float(rotation)
+
+    @classmethod
+    def from_points(cls, x_min: float, frequency_min: float, x_max: float, frequency_max: float,
+            y_min: float, threshold_min: float, y_max: float, threshold_max: float, rotation: float = 0) -> "GridCalibration":
+        """Creates the calibration by linear interpolation between two
+        points of each axis.
+
+        Parameters
+        ----------
+        x_min, x_max : float
+        The x pixel coordinates of two frequencies.
+        frequency_min, frequency_max : float
+        The frequencies (in Hz) at `x_min` and `x_max`.
+        y_min, y_max : float
+        The y pixel coordinates of two thresholds.
+        threshold_min, threshold_max : float
+        The thresholds (in dB) at `y_min` and `y_max`.
+        rotation : float
+        The rotation (in degrees) that was applied to the audiogram (default: 0).
+
+        Returns
+        -------
+        GridCalibration
+        The calibration passing through the points provided.
+        """
+        o_min = Audiology.frequency_to_octave(frequency_min)
+        o_max = Audiology.frequency_to_octave(frequency_max)
+        octave_scale = (o_max - o_min) / (x_max - x_min)
+        threshold_scale = (threshold_max - threshold_min) / (y_max - y_min)
+        return cls(
+            octave_scale,
+            o_min - octave_scale * x_min,
+            threshold_scale,
+            threshold_min - threshold_scale * y_min,
+            rotation
+        )
+
+    def pixel_to_frequency(self, x: np.ndarray) -> np.ndarray:
+        """Maps x pixel coordinates to frequencies (in Hz)."""
+        return Audiology.octave_to_frequency(self.octave_scale * np.asarray(x, dtype=float) + self.octave_offset)
+
+    def frequency_to_pixel(self, frequency: np.ndarray) -> np.ndarray:
+        """Maps frequencies (in Hz) to x pixel coordinates."""
+        return (Audiology.frequency_to_octave(np.asarray(frequency, dtype=float)) - self.octave_offset) / self.octave_scale
+
+    def pixel_to_threshold(self, y: np.ndarray) -> np.ndarray:
+        """Maps y pixel coordinates to thresholds (in dB)."""
+        return self.threshold_scale * np.asarray(y, dtype=float) + self.threshold_offset
+
+    def threshold_to_pixel(self, threshold: np.ndarray) -> np.ndarray:
+        """Maps thresholds (in dB) to y pixel coordinates."""
+        return (np.asarray(threshold, dtype=float) - self.threshold_offset) / self.threshold_scale
+
+    def forward(self, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps pixel coordinates to (frequencies, thresholds)."""
+        return self.pixel_to_frequency(xs), self.pixel_to_threshold(ys)
+
+    def inverse(self, frequencies: np.ndarray, thresholds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps (frequencies, thresholds) to pixel coordinates."""
+        return self.frequency_to_pixel(frequencies), self.threshold_to_pixel(thresholds)
+
+    def to_dict(self) -> GridCalibrationDict:
+        """Serializes the calibration to a dictionary.
+
+        Returns
+        -------
+        GridCalibrationDict
+        A (JSON-serializable) dictionary representing the calibration.
+        """
+        return {
+            "octaveScale": self.octave_scale,
+            "octaveOffset": self.octave_offset,
+            "thresholdScale": self.threshold_scale,
+            "thresholdOffset": self.threshold_offset,
+            "rotation": self.rotation
+        }
+
+    @classmethod
+    def from_dict(cls, calibration_dict: GridCalibrationDict) -> "GridCalibration":
+        """Creates a calibration from its dictionary representation.
+
+        Parameters
+        ----------
+        calibration_dict : GridCalibrationDict
+        A dictionary as returned by `to_dict`.
+
+        Returns
+        -------
+        GridCalibration
+        The calibration.
+        """
+        return cls(
+            calibration_dict["octaveScale"],
+            calibration_dict["octaveOffset"],
+            calibration_dict["thresholdScale"],
+            calibration_dict["thresholdOffset"],
+            calibration_dict.get("rotation", 0)
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, GridCalibration) and self.to_dict() == other.to_dict()
+
+    def __str__(self):
+        return (f"GridCalibration(octave={self.octave_scale:.5g}*x{self.octave_offset:+.5g}, "
+                f"threshold={self.threshold_scale:.5g}*y{self.threshold_offset:+.5g}, rotation={self.rotation:.2f})")
+
+    def __repr__(self):
+        return self.__str__()
@@ -6,65 +6,258 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import List
+from typing import Callable, List, Sequence, Tuple, Union
 from PIL import ImageDraw
-from digitizer.report_components.line import Line
+import numpy as np
+from interfaces import GridCalibrationDict
+from digitizer.report_components.calibration import GridCalibration
+from digitizer.report_components.hough import HoughAccumulator
+from digitizer.report_components.line import Line, LineIndex
 from digitizer.report_components.label import Label
 from digitizer.report_components.symbol import Symbol
 import utils.audiology as Audiology
-from utils.exceptions import InsufficientLinesException
+from utils.exceptions import InsufficientLabelsException, InsufficientLinesException
+
+LINE_DETECTION_METHODS = ("hough", "projection")
+
+# The thresholds tried in turn by `extract_thresholds` until a grid can be
+# fitted to the lines detected. The order is deliberate: the first is the
+# threshold at which the grid was always fitted (the 200 of the deskewing is a
+# separate step), and a retry only happens when too few lines were found, so
+# the next thresholds only decrease (each detects a superset of the lines of
+# the previous one).
+GRID_THRESHOLDS = (150, 120, 90)
 
 class Grid(object):
 
-    def __init__(self, report, labels, threshold=150):
-        lines = report.detect_lines(threshold=threshold)
-        lines = [line for line in lines if line.is_vertical() or line.is_horizontal()]
+    def __init__(self, report, labels, threshold: Union[int, Sequence[int]] = 150, line_detection="hough", line_tolerance: float = 1):
+        """Fits the grid of an audiogram to its lines and labels.
+
+        Parameters
+        ----------
+        report : Report
+        The (deskewed) audiogram.
+        labels : List[Label]
+        The labels of the audiogram.
+        threshold : Union[int, Sequence[int]]
+        The line detection threshold, or a sequence of thresholds tried in
+        turn until enough lines are detected to fit the grid (default: 150).
+        With the Hough Transform, the vote space is only computed once for
+        all the thresholds.
+        line_detection : str
+        The line detection method, one of `LINE_DETECTION_METHODS` (default: "hough").
+        line_tolerance : float
+        Lines deviating by up to `line_tolerance` degrees from the vertical or
+        horizontal are grid lines (default: 1).
+        """
+        assert line_detection in LINE_DETECTION_METHODS
+        thresholds = [threshold] if np.isscalar(threshold) else list(threshold)
+
+        if line_detection == "hough":
+            accumulator = report.hough_accumulator(min_threshold=min(thresholds))
+            get_lines = lambda t: accumulator.get_lines(t, cluster=True)
+        else:
+            get_lines = lambda t: report.detect_lines_projection(threshold=t)
+        self._fit_thresholds(get_lines, thresholds, labels, report.get_rotation_angle(), line_tolerance)
+
+    @classmethod
+    def from_accumulator(cls, accumulator: HoughAccumulator, labels: List[Label],
+            threshold: Union[int, Sequence[int]] = 150, rotation: float = 0, line_tolerance: float = 1) -> "Grid":
+        """Fits the grid to the lines of a precomputed (e.g. cached) Hough
+        accumulator, without the image of the audiogram.
+
+        Parameters
+        ----------
+        accumulator : HoughAccumulator
+        The Hough accumulator of the (deskewed) audiogram.
+        labels : List[Label]
+        The labels of the audiogram.
+        threshold : Union[int, Sequence[int]]
+        The line detection threshold, or a sequence of thresholds tried in turn (default: 150).
+        rotation : float
+        The rotation (in degrees) that was applied to the audiogram (default: 0).
+        line_tolerance : float
+        Lines deviating by up to `line_tolerance` degrees from the vertical or
+        horizontal are grid lines (default: 1).
+
+        Returns
+        -------
+        Grid
+        The grid.
+        """
+        thresholds = [threshold] if np.isscalar(threshold) else list(threshold)
+        grid = cls.__new__(cls)
+        grid._fit_thresholds(lambda t: accumulator.get_lines(t, cluster=True), thresholds, labels, rotation, line_tolerance)
+        return grid
+
+    def _fit_thresholds(self, get_lines: Callable[[int], List[Line]], thresholds: List[int], labels: List[Label], rotation: float, line_tolerance: float = 1):
+        assert len(thresholds) > 0
+
         frequency_labels = [label for label in labels if label.is_frequency()]
         threshold_labels = [label for label in labels if label.is_threshold()]
-
-        if len(lines) == 0 or \
-            all([line.is_vertical() for line in lines]) \
-            or all([line.is_horizontal() for line in lines]):
+        if len(frequency_labels) == 0 or len(threshold_labels) == 0:
+            raise InsufficientLabelsException()
+
+        for i, t in enumerate(thresholds):
+            try:
+                self._fit(LineIndex(get_lines(t), line_tolerance), frequency_labels, threshold_labels, rotation)
+                self.threshold = t
+                return
+            except InsufficientLinesException:
+                if i == len(thresholds) - 1:
+                    raise
+
+    def _fit(self, index: LineIndex, frequency_labels: List[Label], threshold_labels: List[Label], rotation: float):
+        if len(index.xs) == 0 or len(index.ys) == 0:
             raise InsufficientLinesException()
 
-        x_lines = [label.find_closest_line(lines) for label in frequency_labels]
-        x_pixels = [line[0].get_x() for line in x_lines]
+        # Resolve the closest line of all the labels in one lookup per axis
+        x_pixels, x_distances = index.find_closest_xs([label.get_center()["x"] for label in frequency_labels])
+        x_pixels = [int(x) for x in x_pixels]
         x_frequency = [label.get_value() for label in frequency_labels]
-        self.x_distances = [line[1] for line in x_lines]
+        self.x_distances = list(x_distances)
 
-        y_lines = [label.find_closest_line(lines) for label in threshold_labels]
-        y_pixels = [line[0].get_y() for line in y_lines]
+        y_pixels, y_distances = index.find_closest_ys([label.get_center()["y"] for label in threshold_labels])
+        y_pixels = list(y_pixels)
         y_threshold = [label.get_value() for label in threshold_labels]
-        self.y_distances = [line[1] for line in y_lines]
+        self.y_distances = list(y_distances)
 
         x_points = sorted(list(zip(x_pixels, x_frequency)), key=lambda p: p[0])
         y_points = sorted(list(zip(y_pixels, y_threshold)), key=lambda p: p[0])
 
         # Take the first and last points for the octaves (frequencies)
-        o_max = Audiology.frequency_to_octave(x_points[-1][1]) # max octave
-        x_max = x_points[-1][0] # max pixel value
-        o_min = Audiology.frequency_to_octave(x_points[0][1])
-        x_min = x_points[0][0]
+        x_max, frequency_max = x_points[-1] # max pixel value
+        x_min, frequency_min = x_points[0]
 
         # Take the first and last points for the thresholds
-        t_max = y_points[-1][1] # max threshold
-        y_max = y_points[-1][0] # max pixel value
-        t_min = y_points[0][1]
-        y_min = y_points[0][0]
+        y_max, t_max = y_points[-1] # max pixel value
+        y_min, t_min = y_points[0]
 
         if x_min == x_max or y_max == y_min:
             raise InsufficientLinesException()
 
-        # Derive the forward and reverse mapping functions via simple linear
-        # interpolation using the **OCTAVE SCALE** (which is linear), because
-        # the frequency scale is logarithmic.
-        self.pixel_freq_map = lambda p: Audiology.octave_to_frequency(o_min + (o_max - o_min)*(p - x_min)/(x_max - x_min))
-        self.freq_pixel_map = lambda f: x_min + (Audiology.frequency_to_octave(f) - o_min)*(x_max - x_min)/(o_max - o_min)
+        # Derive the calibration via simple linear interpolation using the
+        # **OCTAVE SCALE** (which is linear), because the frequency scale is
+        # logarithmic. Linear interpolation can be applied directly to the
+        # thresholds, because the threshold axis is linear.
+        self.calibration = GridCalibration.from_points(
+            x_min, frequency_min, x_max, frequency_max,
+            y_min, t_min, y_max, t_max,
+            rotation=rotation
+        )
+
+    @classmethod
+    def from_calibration(cls, calibration: GridCalibration) -> "Grid":
+        """Creates a grid from an existing calibration, without detecting
+        any line.
+
+        Parameters
+        ----------
+        calibration : GridCalibration
+        The calibration of the grid.
+
+        Returns
+        -------
+        Grid
+        The grid.
+        """
+        grid = cls.__new__(cls)
+        grid.calibration = calibration
+        grid.threshold = None
+        grid.x_distances = []
+        grid.y_distances = []
+        return grid
+
+    def to_dict(self) -> GridCalibrationDict:
+        """Serializes the calibration of the grid to a dictionary.
+
+        Returns
+        -------
+        GridCalibrationDict
+        The calibration of the grid.
+        """
+        return self.calibration.to_dict()
+
+    @classmethod
+    def from_dict(cls, calibration_dict: GridCalibrationDict) -> "Grid":
+        """Creates a grid from a serialized calibration (see `to_dict`).
 
-        # Linear interpolation can be applied directly to the thresholds,
-        # because the threshold axis is linear.
-        self.pixel_threshold_map = lambda p: t_min + (t_max - t_min)*(p - y_min)/(y_max - y_min)
-        self.threshold_pixel_map = lambda t: y_min + (t - t_min)*(y_max - y_min)/(t_max - t_min)
+        Parameters
+        ----------
+        calibration_dict : GridCalibrationDict
+        The calibration of the grid.
+
+        Returns
+        -------
+        Grid
+        The grid.
+        """
+        return cls.from_calibration(GridCalibration.from_dict(calibration_dict))
+
+    def pixel_freq_map(self, x: float) -> float:
+        return self.calibration.pixel_to_frequency(x)
+
+    def freq_pixel_map(self, frequency: float) -> float:
+        return self.calibration.frequency_to_pixel(frequency)
+
+    def pixel_threshold_map(self, y: float) -> float:
+        return self.calibration.pixel_to_threshold(y)
+
+    def threshold_pixel_map(self, threshold: float) -> float:
+        return self.calibration.threshold_to_pixel(threshold)
+
+    def map_pixels(self, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps arrays of pixel coordinates to frequencies and thresholds.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+        The x pixel coordinates.
+        ys : np.ndarray
+        The y pixel coordinates.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+        The frequencies (in Hz) corresponding to `xs` and the thresholds
+        (in dB) corresponding to `ys`.
+        """
+        return self.calibration.forward(xs, ys)
+
+    def get_snapped_values(self, symbols: List[Symbol], epsilon: float = 0.15) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the snapped frequencies and thresholds of all the symbols
+        at once (see `get_snapped_frequency` and `get_snapped_threshold`).
+
+        Parameters
+        ----------
+        symbols : List[Symbol]
+        The symbols whose frequencies and thresholds are to be extracted.
+
+        epsilon: float
+        Distance (in octaves) below which the bone threshold is snapped to
+        the nearest frequency as opposed to shifted to the nearest threshold
+        in the direction of the corresponding ear.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+        The `snapped-to-the-grid` frequencies (in Hz) and thresholds.
+        """
+        centers = [symbol.get_center() for symbol in symbols]
+        frequencies, thresholds = self.map_pixels(
+            [center["x"] for center in centers],
+            [center["y"] for center in centers]
+        )
+
+        air = np.array([symbol.conduction == "air" for symbol in symbols], dtype=bool)
+        ears = np.array([symbol.ear for symbol in symbols], dtype=str)
+        snapped_frequencies = np.where(
+            air,
+            Audiology.round_frequencies(frequencies),
+            Audiology.round_frequencies_bone(frequencies, ears, epsilon=epsilon)
+        )
+
+        return snapped_frequencies, Audiology.round_thresholds(thresholds)
 
     def get_x(self, frequency: float) -> int:
         """Given a frequency value, returns the x coordinate predicted by the
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+from typing import List, Optional
+
+import numpy as np
+import cv2
+
+from interfaces import HoughAccumulatorDict
+from .line import Line
+
+# Hough lines closer than these tolerances (in pixels and radians) are
+# detections of the same stroke and are merged by `cluster_polar_lines`
+CLUSTER_RHO_TOLERANCE = 3
+CLUSTER_THETA_TOLERANCE = np.pi / 90
+
+class HoughAccumulator(object):
+
+    def __init__(self, gray: np.ndarray, theta: float = np.pi/180, min_threshold: int = 150):
+        """Edges and Hough vote space of a grayscale image, from which the
+        lines detected at any threshold can be retrieved without running the
+        Canny edge detector and the Hough Transform again.
+
+        The peaks of the vote space are computed once for `min_threshold`
+        along with their number of votes. The lines detected at a higher
+        threshold are the subset of those peaks with more votes than the
+        threshold, in the same order as `cv2.HoughLines` returns them. The
+        peaks are only recomputed if a lower threshold is requested.
+
+        Parameters
+        ----------
+        gray : np.ndarray
+        The grayscale image (None for an accumulator restored with `from_peaks`).
+        theta : float
+        The angular resolution (in radians) of the accumulator (default: 1 degree).
+        min_threshold : int
+        The lowest threshold expected to be requested (default: 150).
+        """
+        self.edges = cv2.Canny(gray, 150, 300, apertureSize=3) if gray is not None else None
+        self.theta = theta
+        self.min_threshold = None
+        self.peaks = np.zeros((0, 3), dtype=np.float32)
+        if self.edges is not None:
+            self._compute_peaks(min_threshold)
+
+    @classmethod
+    def from_peaks(cls, peaks: np.ndarray, min_threshold: int, theta: float = np.pi/180) -> "HoughAccumulator":
+        """Restores an accumulator from its peaks (e.g. cached with `to_dict`),
+        without the image. Lines can then only be retrieved for thresholds of
+        at least `min_threshold`.
+
+        Parameters
+        ----------
+        peaks : np.ndarray
+        An array of shape (N, 3) of (rho, theta, votes), in decreasing order of votes.
+        min_threshold : int
+        The threshold at which the peaks were computed.
+        theta : float
+        The angular resolution (in radians) of the accumulator (default: 1 degree).
+
+        Returns
+        -------
+        HoughAccumulator
+        The accumulator.
+        """
+        accumulator = cls(None, theta=theta)
+        accumulator.peaks = np.asarray(peaks, dtype=np.float32).reshape(-1, 3)
+        accumulator.min_threshold = min_threshold
+        return accumulator
+
+    def to_dict(self) -> HoughAccumulatorDict:
+        """Serializes the peaks of the accumulator (see `from_dict`).
+
+        Returns
+        -------
+        HoughAccumulatorDict
+        A (JSON-serializable) dictionary representing the accumulator.
+        """
+        return {
+            "minThreshold": self.min_threshold,
+            "theta": self.theta,
+            "peaks": self.peaks.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, accumulator_dict: HoughAccumulatorDict) -> "HoughAccumulator":
+        """Restores an accumulator serialized with `to_dict`."""
+        return cls.from_peaks(accumulator_dict["peaks"], accumulator_dict["minThreshold"], accumulator_dict["theta"])
+
+    def _compute_peaks(self, threshold: int):
+        if self.edges is None:
+            raise ValueError(f"The lines were only kept above a threshold of {self.min_threshold}, not {threshold}.")
+        peaks = cv2.HoughLinesWithAccumulator(self.edges, 1, self.theta, threshold)
+        self.peaks = np.zeros((0, 3), dtype=np.float32) if peaks is None else peaks.reshape(-1, 3)
+        self.min_threshold = threshold
+
+    def get_polar_lines(self, threshold: int, max_lines: Optional[int] = None, cluster: bool = False) -> np.ndarray:
+        """Returns the lines detected at the given threshold.
+
+        Parameters
+        ----------
+        threshold : int
+        Only the lines with more votes than the threshold are returned.
+        max_lines : Optional[int]
+        If provided, only the `max_lines` lines with the most votes are returned (default: None).
+        cluster : bool
+        Whether near-duplicate lines are merged (see `cluster_polar_lines`)
+        once the `max_lines` strongest are selected (default: False).
+
+        Returns
+        -------
+        np.ndarray
+        An array of shape (N, 3) of (rho, theta, votes), in decreasing order of votes.
+        """
+        if threshold < self.min_threshold:
+            self._compute_peaks(threshold)
+        peaks = self.peaks[self.peaks[:, 2] > threshold][:max_lines]
+        if cluster:
+            peaks = cluster_polar_lines(peaks)
+        return peaks
+
+    def get_lines(self, threshold: int, max_lines: Optional[int] = None, cluster: bool = False) -> List[Line]:
+        """Returns the lines detected at the given threshold (see `get_polar_lines`).
+
+        Returns
+        -------
+        List[Line]
+        The lines, in decreasing order of votes, weighted by their votes
+        when they are clustered.
+        """
+        return polar_to_lines(self.get_polar_lines(threshold, max_lines, cluster), weighted=cluster)
+
+def cluster_polar_lines(polar_lines: np.ndarray, rho_tolerance: float = CLUSTER_RHO_TOLERANCE,
+        theta_tolerance: float = CLUSTER_THETA_TOLERANCE) -> np.ndarray:
+    """Merges the near-identical lines that the Hough Transform returns for
+    a thick or anti-aliased stroke.
+
+    The lines are visited in decreasing order of votes: a line within
+    `rho_tolerance` and `theta_tolerance` of a stronger line is merged into
+    it, otherwise it starts a new cluster. Each cluster is represented by
+    its strongest line, with the votes of all its lines.
+
+    Parameters
+    ----------
+    polar_lines : np.ndarray
+    An array of shape (N, 3) of (rho, theta, votes), in decreasing order of votes.
+    rho_tolerance : float
+    The largest distance (in pixels) between two lines of a cluster (default: CLUSTER_RHO_TOLERANCE).
+    theta_tolerance : float
+    The largest angle (in radians) between two lines of a cluster (default: CLUSTER_THETA_TOLERANCE).
+
+    Returns
+    -------
+    np.ndarray
+    An array of shape (M, 3) of (rho, theta, summed votes) with M <= N,
+    in decreasing order of votes of the representative lines.
+    """
+    polar_lines = np.array(polar_lines, dtype=np.float32).reshape(-1, 3)
+    clusters = []
+    for i, (rho, theta, _) in enumerate(polar_lines):
+        if len(clusters) > 0:
+            representatives = polar_lines[clusters, :2]
+            d_rho = np.abs(representatives[:, 0] - rho)
+            d_theta = np.abs(representatives[:, 1] - theta)
+            # (rho, theta) and (-rho, theta - pi) are the same line, which
+            # matters for the lines close to the vertical
+            same = (d_rho <= rho_tolerance) & (d_theta <= theta_tolerance)
+            same |= (np.abs(representatives[:, 0] + rho) <= rho_tolerance) & (np.abs(d_theta - np.pi) <= theta_tolerance)
+            matches = np.flatnonzero(same)
+            if len(matches) > 0:
+                polar_lines[clusters[matches[0]], 2] += polar_lines[i, 2]
+                continue
+        clusters.append(i)
+    return polar_lines[clusters]
+
+def polar_to_lines(polar_lines: np.ndarray, weighted: bool = False) -> List[Line]:
+    """Converts lines in polar coordinates (as returned by the Hough
+    Transform) to line segments.
+
+    Parameters
+    ----------
+    polar_lines : np.ndarray
+    An array of shape (N, 2) or more columns, the first two being rho and theta.
+    weighted : bool
+    Whether the third column (the votes) is used as the weight of the lines (default: False).
+
+    Returns
+    -------
+    List[Line]
+    The lines.
+    """
+    polar_lines = np.asarray(polar_lines)
+    weights = polar_lines[..., 2].reshape(-1) if weighted else np.ones(polar_lines.size // polar_lines.shape[-1])
+    lines_list = []
+    for (rho, theta), weight in zip(polar_lines[..., :2].reshape(-1, 2), weights):
+        a = np.cos(theta)
+        b = np.sin(theta)
+        x0 = a*rho
+        y0 = b*rho
+        x1 = int(x0 + 1000*(-b))
+        y1 = int(y0 + 1000*(a))
+        x2 = int(x0 - 1000*(-b))
+        y2 = int(y0 - 1000*(a))
+        lines_list.append(Line(x1, y1, x2, y2, weight=float(weight)))
+    return lines_list
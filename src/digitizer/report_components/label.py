@@ -5,36 +5,82 @@ Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
 This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
-from typing import List, Optional, Type
+from typing import List, Optional, Tuple, Type, Union
+from enum import Enum
 import PIL.ImageDraw
 import numpy as np
 
 from interfaces import LabelDict
+from digitizer.report_components.line import Line, LineIndex
 from utils.geometry import get_bounding_box_relative_to_original_report
 import utils.audiology as Audiology
 
-class Label(object):
+class LabelType(Enum):
+    FREQUENCY = "frequency"
+    THRESHOLD = "threshold"
+    OTHER = "other"
+
+def parse_label_text(text: str) -> Tuple[LabelType, Optional[float]]:
+    """Parses the text of a label into its type and numerical value.
+
+    Parameters
+    ----------
+    text : str
+    The text of the label, e.g. `2K`, `500Hz` or `40`.
+
+    Returns
+    -------
+    Tuple[LabelType, Optional[float]]
+    The type of the label and its numerical value (in dB if threshold, or in
+    Hz if frequency), or (LabelType.OTHER, None) if the label is neither a
+    frequency nor a threshold.
+    """
+    if not isinstance(text, str):
+        return LabelType.OTHER, None
+
+    try:
+        raw_value = float(text.lower()\
+                .rstrip("hz")\
+                .rstrip("h")\
+                .rstrip("khz")\
+                .rstrip("k"))
+        if raw_value in Audiology.OCTAVE_FREQS_HZ or raw_value in Audiology.OCTAVE_FREQS_KHZ:
+            # If the value extracted is < 100 and corresponds to one of the
+            # standard frequency values, the value is in kHz, which we can
+            # convert to Hz.
+            return LabelType.FREQUENCY, raw_value * 1000 if raw_value < 100 else raw_value
+    except ValueError:
+        pass # label cannot be converted to a float
+
+    try:
+        if int(text) in Audiology.THRESHOLDS:
+            return LabelType.THRESHOLD, float(text)
+    except ValueError:
+        pass
+
+    return LabelType.OTHER, None
 
-    def __init__(self, label_dict: dict, audiogram_coordinates: dict, correction_angle: float):
-        bbox = label_dict["boundingBox"]
-        self.p1 = { 
-            "x": bbox["x"],
-            "y": bbox["y"]
-        }
+class Label(object):
 
-        self.p2 = { 
-            "x": bbox["x"] + bbox["width"],
-            "y": bbox["y"] + bbox["height"]
-        }
+    __slots__ = ("x1", "y1", "x2", "y2", "width", "height", "text", "type", "value", "confidence", "absolute_bounding_box")
 
-        self.dimensions = { 
-            "width": bbox["width"],
-            "height": bbox["height"]
-        }
+    def __init__(self, label_dict: dict, audiogram_coordinates: dict, correction_angle: float, absolute_bounding_box: Optional[dict] = None):
+        bbox = label_dict["boundingBox"]
+        self.x1 = bbox["x"]
+        self.y1 = bbox["y"]
+        self.x2 = bbox["x"] + bbox["width"]
+        self.y2 = bbox["y"] + bbox["height"]
+        self.width = bbox["width"]
+        self.height = bbox["height"]
 
         self.text = label_dict["text"]
+        self.type, self.value = parse_label_text(self.text)
+        self.confidence = label_dict.get("confidence")
 
-        self.absolute_bounding_box = get_bounding_box_relative_to_original_report(bbox, audiogram_coordinates, correction_angle)
+        # The bounding box relative to the original report may be precomputed
+        # for all the detections at once (see `get_bounding_boxes_relative_to_original_report`)
+        self.absolute_bounding_box = absolute_bounding_box if absolute_bounding_box is not None \
+            else get_bounding_box_relative_to_original_report(bbox, audiogram_coordinates, correction_angle)
 
     def draw(self, canvas: PIL.ImageDraw):
         """Draws the label on the canvas (image) passed.
@@ -46,11 +92,11 @@ class Label(object):
         """
         color = "rgb(255,0,0)" if self.is_frequency() else "rgb(0,0,255)"
         canvas.rectangle(
-            (self.p1["x"], self.p1["y"], self.p2["x"], self.p2["y"]),
+            (self.x1, self.y1, self.x2, self.y2),
             outline=color,
             width=3
         )
-        canvas.text((self.p1["x"], self.p1["y"] - 10), str(self.get_value()), fill=color)
+        canvas.text((self.x1, self.y1 - 10), str(self.get_value()), fill=color)
 
     def get_type(self) -> str:
         """Returns the type of label.
@@ -60,13 +106,7 @@ class Label(object):
         str
         The type of label (`threshold` or `frequency`).
         """
-
-        if self.is_frequency():
-            return "frequency"
-        elif self.is_threshold():
-            return "threshold"
-        else:
-            return None
+        return None if self.type is LabelType.OTHER else self.type.value
 
     def get_value(self) -> int:
         """Returns the numerical value of the label.
@@ -76,22 +116,10 @@ class Label(object):
         int
         The numerical value of the label (in dB if threshold, or in Hz if frequency). 
         """
-        if not self.is_frequency() and not self.is_threshold():
+        if self.type is LabelType.OTHER:
             raise "Attempted to get the value of a label which is not a frequency or threshold."
 
-        raw_value = float(self.text.lower()\
-                .rstrip("hz")\
-                .rstrip("h")\
-                .rstrip("khz")\
-                .rstrip("k"))
-
-        # If the value extracted is < 100 and corresponds to one of the
-        # standard frequency values, the value is in kHz, which we can
-        # convert to Hz.
-        if self.is_frequency() and raw_value < 100:
-            return raw_value * 1000
-
-        return raw_value
+        return self.value
 
 
     def is_frequency(self) -> bool:
@@ -102,20 +130,7 @@ class Label(object):
         bool
         True if the label corresponds to a frequency, False otherwise.
         """
-        if not isinstance(self.text, str):
-            return False
-
-        try:
-            stripped_label = self.text.lower()\
-                    .rstrip("hz")\
-                    .rstrip("h")\
-                    .rstrip("khz")\
-                    .rstrip("k")
-            frequency_label = float(stripped_label)
-            return frequency_label in Audiology.OCTAVE_FREQS_HZ \
-                    or frequency_label in Audiology.OCTAVE_FREQS_KHZ
-        except ValueError:
-            return False # label cannot be converted to a float
+        return self.type is LabelType.FREQUENCY
 
     def is_threshold(self) -> bool:
         """Checks if the label corresponds to a threshold.
@@ -125,11 +140,7 @@ class Label(object):
         bool
         True if the label corresponds to a threshold, False otherwise.
         """
-        try:
-            value = int(self.text)
-            return value in list(range(-10, 130, 10))
-        except ValueError:
-            return False
+        return self.type is LabelType.THRESHOLD
 
     def get_area(self) -> int:
         """Computes the area of the label's bounding box.
@@ -139,7 +150,7 @@ class Label(object):
         int
         The area of the label's bounding box in pixels squared.
         """
-        return self.dimensions["height"] * self.dimensions["width"]
+        return self.height * self.width
 
     def overlaps_vertically_with(self, label: "Label") -> bool:
         """Checks of the label overlaps vertically with the label passed.
@@ -149,10 +160,10 @@ class Label(object):
         bool
         True if the labels overlap and False otherwise.
         """
-        return (self.p1["y"] >= label.p1["y"] and self.p1["y"] <= label.p2["y"]) \
-                or (self.p2["y"] >= label.p1["y"] and self.p2["y"] <= label.p2["y"]) \
-                or (label.p1["y"] >= self.p1["y"] and label.p1["y"] <= self.p2["y"]) \
-                or (label.p2["y"] >= self.p1["y"] and label.p2["y"] <= self.p2["y"])
+        return (self.y1 >= label.y1 and self.y1 <= label.y2) \
+                or (self.y2 >= label.y1 and self.y2 <= label.y2) \
+                or (label.y1 >= self.y1 and label.y1 <= self.y2) \
+                or (label.y2 >= self.y1 and label.y2 <= self.y2)
 
     def overlaps_horizontally_with(self, label: "Label") -> bool:
         """Checks of the label overlaps horizontally with the label passed.
@@ -162,10 +173,10 @@ class Label(object):
         bool
         True if the labels overlap and False otherwise.
         """
-        return (self.p1["x"] >= label.p1["x"] and self.p1["x"] <= label.p2["x"]) \
-                or (self.p2["x"] >= label.p1["x"] and self.p2["x"] <= label.p2["x"]) \
-                or (label.p1["x"] >= self.p1["x"] and label.p1["x"] <= self.p2["x"]) \
-                or (label.p2["x"] >= self.p1["x"] and label.p2["x"] <= self.p2["x"])
+        return (self.x1 >= label.x1 and self.x1 <= label.x2) \
+                or (self.x2 >= label.x1 and self.x2 <= label.x2) \
+                or (label.x1 >= self.x1 and label.x1 <= self.x2) \
+                or (label.x2 >= self.x1 and label.x2 <= self.x2)
 
     def overlaps_with(self, label: "Label") -> bool:
         """Checks of the label overlaps vertically OR horizontally with the label passed.
@@ -185,7 +196,7 @@ class Label(object):
         bool
         True if x is in the label's x range and False otherwise.
         """
-        return x >= self.p1["x"] and x <= self.p2["x"]
+        return x >= self.x1 and x <= self.x2
 
     def encompasses_y_value(self, y: int) -> bool:
         """Checks of the the pixel value of y pass is encompassed in the label's y range.
@@ -195,7 +206,7 @@ class Label(object):
         bool
         True if y is in the label's y range and False otherwise.
         """
-        return y >= self.p1["y"] and y <= self.p2["y"]
+        return y >= self.y1 and y <= self.y2
 
     def get_center(self) -> dict:
         """Returns the center of the label's bounding box.
@@ -207,13 +218,13 @@ class Label(object):
         of the form { "x": int, "y": int }.
         """
         center = {
-            "x": int((self.p1["x"] + self.p2["x"]) / 2),
-            "y": int((self.p1["y"] + self.p2["y"]) / 2)
+            "x": int((self.x1 + self.x2) / 2),
+            "y": int((self.y1 + self.y2) / 2)
         }
         return center
         
 
-    def find_closest_line(self, lines: List["Line"]) -> "Line":
+    def find_closest_line(self, lines: Union[List["Line"], "LineIndex"]) -> Tuple["Line", float]:
         """Find the closest line to the label.
 
         If the label corresponds to a frequency, the line is vertical,
@@ -221,39 +232,22 @@ class Label(object):
 
         Parameters
         ----------
-        lines : List[Line]
-        The set of lines detected in the audiogram image.
+        lines : Union[List[Line], LineIndex]
+        The set of lines detected in the audiogram image, or an index
+        of these lines (preferable when looking up several labels).
 
         Returns
         -------
-        Line
-        The closest line.
+        Tuple[Line, float]
+        The closest line and its distance to the label.
         """
-        if self.is_threshold():
-            lines = [line for line in lines if line.is_horizontal()]
-            closest_line_distance = 100000
-            closest_line_index = None
-            distances = []
-            for i, line in enumerate(lines):
-                distance = abs(line.get_y() - self.get_center()["y"])
-                distances.append(distance)
-                if distance < closest_line_distance:
-                    closest_line_index = i
-                    closest_line_distance = distance
-            return lines[closest_line_index], distances[closest_line_index]
+        if not isinstance(lines, LineIndex):
+            lines = LineIndex(lines)
 
+        if self.is_threshold():
+            return lines.find_closest_horizontal_line(self.get_center()["y"])
         elif self.is_frequency():
-            lines = [line for line in lines if line.is_vertical()]
-            closest_line_distance = 100000
-            closest_line_index = None
-            distances = []
-            for i, line in enumerate(lines):
-                distance = abs(line.get_x() - self.get_center()["x"])
-                distances.append(distance)
-                if distance < closest_line_distance:
-                    closest_line_index = i
-                    closest_line_distance = distance
-            return lines[closest_line_index], distances[closest_line_index]
+            return lines.find_closest_vertical_line(self.get_center()["x"])
         else:
             raise "Error: Tried to find the closest line to a label that corresponds neither to a frequency nor a threshold."
 
@@ -275,7 +269,7 @@ class Label(object):
 
 
     def __str__(self):
-        return f"Textbox(x={self.p1['x']}, y={self.p1['y']}, text={self.text})"
+        return f"Textbox(x={self.x1}, y={self.y1}, text={self.text})"
 
     def __repr__(self):
         return self.__str__()
@@ -6,18 +6,32 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import List
+from typing import List, Tuple
+import bisect
+import math
 
 import PIL.ImageDraw
 import numpy as np
 
 class Line(object):
 
-    def __init__(self, x1, y1, x2, y2, color="rgb(255,0,0)", label=None):
-        self.p1 = { "x": x1, "y": y1 }
-        self.p2 = { "x": x2, "y": y2 }
+    __slots__ = ("x1", "y1", "x2", "y2", "angle", "color", "label", "weight")
+
+    def __init__(self, x1, y1, x2, y2, color="rgb(255,0,0)", label=None, weight=1):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
         self.color = color
         self.label = label
+        # The number of Hough votes of the detections merged into this line
+        # (see `cluster_polar_lines`), 1 for a line that was not clustered
+        self.weight = weight
+
+        # The angle is needed by every orientation check, so compute it once
+        self.angle = math.degrees(math.atan2(abs(y2 - y1), abs(x2 - x1)))
+        if y2 - y1 < 0:
+            self.angle = 180 - self.angle
 
     def get_angle(self) -> float:
         """Returns the angle of the line in degrees in the range [0, 180[.
@@ -27,12 +41,7 @@ class Line(object):
         float
         The angle of the line in degrees.
         """
-        dx = self.p2["x"] - self.p1["x"]
-        dy = self.p2["y"] - self.p1["y"]
-        angle = np.degrees(np.arctan2(abs(dy), abs(dx)))
-        if self.p2["y"] - self.p1["y"] < 0:
-            angle = 180 - angle
-        return angle
+        return self.angle
 
 
     def has_a_perpendicular_line(self, lines: List["Line"], tolerance: float = 1) -> bool:
@@ -75,7 +84,7 @@ class Line(object):
         The middle x coordinate of a vertical line.
         """
         assert self.is_vertical() 
-        return int((self.p1["x"] + self.p2["x"]) / 2)
+        return int((self.x1 + self.x2) / 2)
 
     def get_y(self) -> int:
         """Return the middle y pixel coordinate of a horizontal line.
@@ -88,7 +97,7 @@ class Line(object):
         The middle y coordinate of a horizontal line.
         """
         assert self.is_horizontal() 
-        return (self.p1["y"] + self.p2["y"]) / 2
+        return (self.y1 + self.y2) / 2
 
     def is_vertical(self, tolerance: float = 1) -> bool:
         """Returns true if the line is vertical.
@@ -144,12 +153,12 @@ class Line(object):
         """
         for label in labels:
             if self.is_vertical():
-                x = (self.p1["x"] + self.p2["x"]) / 2
-                if x >= label.p1["x"] and x <= label.p2["x"]:
+                x = (self.x1 + self.x2) / 2
+                if x >= label.x1 and x <= label.x2:
                     return True
             elif self.is_horizontal():
-                y = (self.p1["y"] + self.p2["y"]) / 2
-                if y >= label.p1["y"] and y <= label.p2["y"]:
+                y = (self.y1 + self.y2) / 2
+                if y >= label.y1 and y <= label.y2:
                     return True
         return False
 
@@ -164,9 +173,117 @@ class Line(object):
         """
 
         canvas.line([
-            (self.p1["x"], self.p1["y"]),
-            (self.p2["x"], self.p2["y"])
+            (self.x1, self.y1),
+            (self.x2, self.y2)
         ], width=3, fill=self.color)
 
         if self.label:
-            canvas.text((self.p1["x"] + 5, self.p1["y"]), str(self.label), fill=self.color)
+            canvas.text((self.x1 + 5, self.y1), str(self.label), fill=self.color)
+
+
+class LineIndex(object):
+
+    def __init__(self, lines: List[Line], tolerance: float = 1):
+        """An index of the vertical lines sorted by x position and of the
+        horizontal lines sorted by y position, for fast nearest-line lookups.
+
+        Parameters
+        ----------
+        lines : List[Line]
+        The lines detected in an audiogram. Lines that are neither vertical
+        nor horizontal are ignored.
+        tolerance : float
+        A deviation of `tolerance` degrees from the vertical or horizontal
+        is still considered vertical or horizontal (default: 1).
+        """
+        vertical_lines = sorted([line for line in lines if line.is_vertical(tolerance)], key=lambda line: line.get_x())
+        horizontal_lines = sorted([line for line in lines if line.is_horizontal(tolerance)], key=lambda line: line.get_y())
+
+        self.vertical_lines = vertical_lines
+        self.horizontal_lines = horizontal_lines
+        self.xs = np.array([line.get_x() for line in vertical_lines], dtype=float)
+        self.ys = np.array([line.get_y() for line in horizontal_lines], dtype=float)
+
+    def find_closest_vertical_line(self, x: float) -> Tuple[Line, float]:
+        """Finds the vertical line closest to an x pixel coordinate.
+
+        Parameters
+        ----------
+        x : float
+        The x pixel coordinate.
+
+        Returns
+        -------
+        Tuple[Line, float]
+        The closest vertical line and its distance to `x`.
+        """
+        i = closest_position(self.xs, x)
+        return self.vertical_lines[i], abs(self.xs[i] - x)
+
+    def find_closest_horizontal_line(self, y: float) -> Tuple[Line, float]:
+        """Finds the horizontal line closest to a y pixel coordinate.
+
+        Parameters
+        ----------
+        y : float
+        The y pixel coordinate.
+
+        Returns
+        -------
+        Tuple[Line, float]
+        The closest horizontal line and its distance to `y`.
+        """
+        i = closest_position(self.ys, y)
+        return self.horizontal_lines[i], abs(self.ys[i] - y)
+
+    def find_closest_xs(self, xs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the x positions of the vertical lines closest to every
+        x pixel coordinate passed, in a single vectorized lookup.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+        The x pixel coordinates.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+        The x positions of the closest vertical lines and their distances.
+        """
+        return closest_positions(self.xs, xs)
+
+    def find_closest_ys(self, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the y positions of the horizontal lines closest to every
+        y pixel coordinate passed, in a single vectorized lookup.
+
+        Parameters
+        ----------
+        ys : np.ndarray
+        The y pixel coordinates.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+        The y positions of the closest horizontal lines and their distances.
+        """
+        return closest_positions(self.ys, ys)
+
+
+def closest_position(positions: np.ndarray, value: float) -> int:
+    """Returns the index of the position closest to `value` in a sorted
+    array of positions (the lower one in case of a tie).
+    """
+    i = bisect.bisect_left(positions, value)
+    if i == len(positions) or (i > 0 and value - positions[i - 1] <= positions[i] - value):
+        return i - 1
+    return i
+
+def closest_positions(positions: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the positions closest to each of the values in a sorted array
+    of positions (the lower one in case of a tie), and their distances.
+    """
+    values = np.asarray(values, dtype=float)
+    right = np.clip(np.searchsorted(positions, values), 0, len(positions) - 1)
+    left = np.clip(right - 1, 0, len(positions) - 1)
+    closest = np.where(np.abs(values - positions[left]) <= np.abs(positions[right] - values), left, right)
+    return positions[closest], np.abs(positions[closest] - values)
@@ -5,7 +5,7 @@ Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
 This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
-from typing import Optional, List
+from typing import Optional, List, Union
 import os
 
 from PIL import Image, ImageDraw, ImageFont
@@ -14,18 +14,99 @@ import cv2
 
 from .label import Label
 from .line import Line
+from .hough import HoughAccumulator
 from .grid import Grid
+from utils.geometry import compute_rotation_angle
+
+# Rotations (in degrees) smaller than this are not applied by `crop_rotated`
+ROTATION_EPSILON = 0.05
+
+# The correction angle can be estimated on a copy of the audiogram downsampled
+# (by factors of 2) as long as its largest side remains at least this many
+# pixels. Lower values are faster but less accurate. None (the default) uses
+# the full resolution; DESKEW_FAST_MAX_SIZE is the suggested opt-in value
+# (see benchmark_deskew.py).
+DESKEW_MAX_SIZE = None
+DESKEW_FAST_MAX_SIZE = 512
+
+# On the downsampled audiogram, a line needs at least this fraction of the
+# smallest side of the audiogram in Hough votes ...
+DESKEW_THRESHOLD_FRACTION = 0.1
+
+# ... and only this many lines (those with the most votes) are kept
+DESKEW_MAX_LINES = 64
+
+# Angular resolution (in radians) of the Hough accumulator on the downsampled audiogram
+DESKEW_THETA = np.pi / 360
 
 class Report(object):
 
-    def __init__(self, filename: Optional[str] = None, image: Optional[Image.Image] = None):
-        assert not (filename and image) and bool(filename) != bool(image)
+    def __init__(self, filename: Optional[str] = None, image: Optional[Union[Image.Image, np.ndarray]] = None, grayscale: bool = True, transform: Optional[np.ndarray] = None):
+        """A report (or a region of a report) backed by a uint8 NumPy array.
+
+        By default, the array is a single-channel grayscale buffer, which is
+        all that the grid and line analyses need. Color reports (BGR, as
+        returned by OpenCV) are only kept when `grayscale` is False, e.g. when
+        the report is to be saved and fed to an object detector.
+
+        Parameters
+        ----------
+        filename : Optional[str]
+        Path to the image of the report.
+        image : Optional[Union[PIL.Image, np.ndarray]]
+        The image of the report. NumPy arrays are used as is (no copy).
+        grayscale : bool
+        Whether the report should be converted to grayscale (default: True).
+        transform : Optional[np.ndarray]
+        The 3x3 affine matrix mapping the coordinates of the original report
+        to the coordinates of this report (default: identity).
+        """
+        assert (filename is None) != (image is None)
+        self.filename = filename
         if filename:
-            self.filename = filename
-            self.pil_image = Image.open(filename)
-        else:
-            self.filename = None
-            self.pil_image = image
+            image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+            if image is None: # format not supported by OpenCV
+                image = Image.open(filename)
+
+        if isinstance(image, Image.Image):
+            image = np.asarray(image.convert("L")) if grayscale \
+                else cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        elif grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        self.image = image
+        self.transform = np.eye(3) if transform is None else transform
+
+    @property
+    def width(self) -> int:
+        return self.image.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.image.shape[0]
+
+    def is_grayscale(self) -> bool:
+        """Checks if the report is backed by a single-channel buffer.
+
+        Returns
+        -------
+        bool
+        True if the report is grayscale, False if it is a BGR image.
+        """
+        return self.image.ndim == 2
+
+    def get_grayscale(self) -> np.ndarray:
+        """Returns the report as a grayscale array.
+
+        Returns
+        -------
+        np.ndarray
+        The grayscale (uint8) array of the report. It is the buffer backing
+        the report (not a copy) if the report is already grayscale.
+        """
+        if self.is_grayscale():
+            return self.image
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
     def rescale(self, factor: float) -> "Report":
         """Creates a new Report that has been resized.
@@ -40,7 +121,13 @@ class Report(object):
         Report
         A new Report that has be rescaled.
         """
-        return Report(image=self.pil_image.resize(int(self.pil_image.width * factor), int(self.pil_image.height * factor)))
+        size = (int(self.width * factor), int(self.height * factor))
+        scaling = np.diag([size[0] / self.width, size[1] / self.height, 1])
+        return Report(
+            image=cv2.resize(self.image, size, interpolation=cv2.INTER_AREA),
+            grayscale=self.is_grayscale(),
+            transform=scaling @ self.transform
+        )
 
     def rotate(self, angle: float) -> "Report":
         """Creates a new Report that has been rotated.
@@ -55,11 +142,26 @@ class Report(object):
         Report
         A new Report that has be rotated.
         """
-        return Report(image=self.pil_image.rotate(angle, center=(0,0), fillcolor="rgb(255,255,255)"))
+        rotation_matrix = cv2.getRotationMatrix2D((0, 0), angle, 1)
+        rotated = cv2.warpAffine(
+            self.image,
+            rotation_matrix,
+            (self.width, self.height),
+            flags=cv2.INTER_NEAREST,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(255, 255, 255)
+        )
+        return Report(
+            image=rotated,
+            grayscale=self.is_grayscale(),
+            transform=np.vstack([rotation_matrix, [0, 0, 1]]) @ self.transform
+        )
 
     def crop(self, x1: int, y1: int, x2: int, y2: int) -> "Report":
         """Creates a new cropped Report.
 
+        The new Report is a view of this report: no pixel is copied.
+
         Parameters
         ----------
         x1: int
@@ -76,7 +178,97 @@ class Report(object):
         Report
         A new cropped Report.
         """
-        return Report(image=self.pil_image.crop((x1, y1, x2, y2)))
+        x1, y1 = max(int(round(x1)), 0), max(int(round(y1)), 0)
+        x2, y2 = int(round(x2)), int(round(y2))
+        translation = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]])
+        return Report(
+            image=self.image[y1:y2, x1:x2],
+            grayscale=self.is_grayscale(),
+            transform=translation @ self.transform
+        )
+
+    def crop_rotated(self, bounding_box: dict, angle: float, epsilon: float = ROTATION_EPSILON) -> "Report":
+        """Creates a new Report for the region of the report within the bounding
+        box, rotated about the top-left corner of the bounding box.
+
+        Since the crop is a view, the region is resampled exactly once (by
+        a single affine warp over the region only), and not at all if the
+        angle is smaller than `epsilon`. The affine matrix of the whole
+        operation is kept in the `transform` attribute of the new Report
+        so that coordinates can be mapped back to the original report.
+
+        Parameters
+        ----------
+        bounding_box : dict
+        The bounding box of the region, of the form
+        { "x": int, "y": int, "width": int, "height": int }.
+        angle : float
+        The rotation (in degrees) to apply (CCW).
+        epsilon : float
+        Rotations smaller than `epsilon` degrees are not applied
+        (default: ROTATION_EPSILON).
+
+        Returns
+        -------
+        Report
+        A new cropped and rotated Report.
+        """
+        cropped = self.crop(
+            bounding_box["x"],
+            bounding_box["y"],
+            bounding_box["x"] + bounding_box["width"],
+            bounding_box["y"] + bounding_box["height"]
+        )
+        if abs(angle) < epsilon:
+            return cropped
+        return cropped.rotate(angle)
+
+    def get_rotation_angle(self) -> float:
+        """Returns the rotation (in degrees, CCW) that was applied to the
+        original report to obtain this report.
+
+        Returns
+        -------
+        float
+        The rotation angle in degrees.
+        """
+        return float(np.degrees(np.arctan2(self.transform[0, 1], self.transform[0, 0])))
+
+    def to_original_coordinates(self, points: np.ndarray) -> np.ndarray:
+        """Maps points of this report back to the coordinates of the
+        original report.
+
+        Parameters
+        ----------
+        points : np.ndarray
+        An (N, 2) array of (x, y) pixel coordinates in this report.
+
+        Returns
+        -------
+        np.ndarray
+        An (N, 2) array of the corresponding (x, y) coordinates in the
+        original report.
+        """
+        inverse = np.linalg.inv(self.transform)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return points @ inverse[:2, :2].T + inverse[:2, 2]
+
+    def to_pil(self, mode: str = "RGB") -> Image.Image:
+        """Returns a copy of the report as a PIL image.
+
+        Parameters
+        ----------
+        mode : str
+        The mode of the PIL image (default: `RGB`).
+
+        Returns
+        -------
+        PIL.Image
+        The report as a PIL image.
+        """
+        if self.is_grayscale():
+            return Image.fromarray(self.image, mode="L").convert(mode)
+        return Image.fromarray(cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)).convert(mode)
 
     def show(
         self,
@@ -106,7 +298,7 @@ class Report(object):
         The path to where the image should be save. Image is not saved
         if no filename is provided (default: None).
         """
-        labeled_copy = self.pil_image.copy().convert("RGB")
+        labeled_copy = self.to_pil("RGB")
         drawing = ImageDraw.Draw(labeled_copy)
         fontpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "assets", "fonts", "Arial.ttf")
         font = None
@@ -129,7 +321,7 @@ class Report(object):
             drawing.ellipse([(point[0] - r, point[1] - r), (point[0] + r, point[1] + r)], fill="rgb(0,0,255)")
 
         if title:
-            drawing.text((self.pil_image.size[0]/2, 50), title, font=font, align="center", fill="rgb(53,155,232)")
+            drawing.text((self.width/2, 50), title, font=font, align="center", fill="rgb(53,155,232)")
 
         if filename:
             labeled_copy.save(filename)
@@ -160,7 +352,12 @@ class Report(object):
         title: str
         The title of the plot
         """
-        labeled_copy = self.pil_image.copy().convert("RGB")
+        # Nothing to draw: write the buffer directly
+        if not (labels or lines or grids or title):
+            cv2.imwrite(filename, self.image)
+            return
+
+        labeled_copy = self.to_pil("RGB")
         drawing = ImageDraw.Draw(labeled_copy)
         fontpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "assets", "Arial.ttf")
         font = None
@@ -180,12 +377,12 @@ class Report(object):
             grid.draw(drawing)
 
         if title:
-            drawing.text((self.pil_image.size[0]/2, 50), title, font=font, align="center", fill="rgb(53,155,232)")
+            drawing.text((self.width/2, 50), title, font=font, align="center", fill="rgb(53,155,232)")
 
         labeled_copy.save(filename)
 
     def get_image(self, resize_factor: float = 1) -> Image:
-        """Returns a copy of the PIL image representing the report.
+        """Returns a copy of the report as a PIL image.
 
         Parameters
         ----------
@@ -198,12 +395,11 @@ class Report(object):
         A copy of the image at the resize factor provided.
         """
 
-        return self.pil_image.resize(
-            (int(self.pil_image.size[0] * resize_factor),
-             int(self.pil_image.size[1] * resize_factor))
-        )
+        if resize_factor == 1:
+            return self.to_pil(mode="L" if self.is_grayscale() else "RGB")
+        return self.rescale(resize_factor).get_image()
 
-    def detect_lines(self, threshold=250) -> List[Line]:
+    def detect_lines(self, threshold=250, theta: float = np.pi/180, max_lines: Optional[int] = None, cluster: bool = False) -> List[Line]:
         """Detects lines in the report using the Hough Transform.
 
         For details, see: https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_imgproc/py_houghlines/py_houghlines.html
@@ -212,33 +408,163 @@ class Report(object):
         ----------
         threshold : int
         The threshold above which a line is detected. See documentation for OpenCV's HoughLine function for details.
+        theta : float
+        The angular resolution (in radians) of the accumulator (default: 1 degree).
+        max_lines : Optional[int]
+        If provided, only the `max_lines` lines with the most votes are returned (default: None).
+        cluster : bool
+        Whether the near-duplicate lines of each stroke are merged into one
+        line weighted by their votes (default: False).
 
         Returns
         -------
         List[Line]
         A list of lines detected in the report.
         """
-        gray = np.array(self.get_image())
-        edges = cv2.Canny(gray, 150, 300, apertureSize = 3)
-        lines = cv2.HoughLines(edges, 1, np.pi/180, threshold, None, 0, 0)
+        return self.hough_accumulator(theta, min_threshold=threshold).get_lines(threshold, max_lines, cluster)
+
+    def hough_accumulator(self, theta: float = np.pi/180, min_threshold: int = 150) -> HoughAccumulator:
+        """Computes the edges and the Hough vote space of the report once, so
+        that the lines can be retrieved at several thresholds.
+
+        Parameters
+        ----------
+        theta : float
+        The angular resolution (in radians) of the accumulator (default: 1 degree).
+        min_threshold : int
+        The lowest threshold expected to be requested (default: 150).
 
-        if lines is None:
-            return []
+        Returns
+        -------
+        HoughAccumulator
+        The accumulator of the report.
+        """
+        return HoughAccumulator(self.get_grayscale(), theta=theta, min_threshold=min_threshold)
 
-        lines_list = []
+    def estimate_correction_angle(self, threshold: int = 200, max_size: Optional[int] = DESKEW_MAX_SIZE) -> float:
+        """Estimates the rotation that must be applied to the report (an
+        audiogram) so that its grid lines are vertical or horizontal.
 
-        for line in lines:
-            for l in (line[0],):
-                rho = l[0]
-                theta = l[1]
-                a = np.cos(theta)
-                b = np.sin(theta)
-                x0 = a*rho
-                y0 = b*rho
-                x1 = int(x0 + 1000*(-b))
-                y1 = int(y0 + 1000*(a))
-                x2 = int(x0 - 1000*(-b))
-                y2 = int(y0 - 1000*(a))
-                lines_list.append(Line(x1, y1, x2, y2))
+        Only the orientation of the lines matters, so unless `max_size` is
+        None, the lines are detected on a pyramid-downsampled copy of the
+        report, with a Hough threshold proportional to the size of the copy,
+        a finer angular resolution, and only the DESKEW_MAX_LINES strongest
+        lines kept, their near-duplicates merged (see `cluster_polar_lines`).
+        The full-resolution path is unchanged: its lines are not clustered.
+
+        Parameters
+        ----------
+        threshold : int
+        The Hough threshold used at full resolution (default: 200).
+        max_size : Optional[int]
+        The report is halved as long as its largest side remains at least
+        `max_size` pixels. The full resolution is used if None
+        (default: DESKEW_MAX_SIZE).
+
+        Returns
+        -------
+        float
+        The correction angle in degrees.
+        """
+        if max_size:
+            gray = self.get_grayscale()
+            while max(gray.shape) >= 2 * max_size:
+                gray = cv2.pyrDown(gray)
+            lines = Report(image=gray).detect_lines(
+                threshold=int(DESKEW_THRESHOLD_FRACTION * min(gray.shape)),
+                theta=DESKEW_THETA,
+                max_lines=DESKEW_MAX_LINES,
+                cluster=True
+            )
+        else:
+            lines = self.detect_lines(threshold=threshold)
+
+        perpendicular_lines = [
+            line for line in lines
+            if line.has_a_perpendicular_line(lines)
+            and (abs(line.get_angle() - 90) < 10
+            or  abs(line.get_angle()) < 10)
+        ]
+        return compute_rotation_angle(perpendicular_lines)
+
+    def detect_lines_projection(self, threshold: int = 250, binarization_threshold: Optional[int] = None, max_gap: int = 1) -> List[Line]:
+        """Detects axis-aligned lines in the report from the peaks of its
+        projection profiles.
+
+        The dark pixels of the (deskewed) report are summed along every column
+        and every row. Runs of consecutive columns (rows) whose sum exceeds
+        `threshold` are merged into a single vertical (horizontal) line placed
+        at the profile-weighted center of the run. This runs in O(pixels) and
+        is a fast alternative to `detect_lines` for grids that have already
+        been straightened.
+
+        Parameters
+        ----------
+        threshold : int
+        The minimum number of dark pixels in a column (row) for it to be
+        considered part of a vertical (horizontal) line (default: 250).
+        binarization_threshold : Optional[int]
+        The gray level below which a pixel is considered dark. If not provided,
+        it is found with Otsu's method (default: None).
+        max_gap : int
+        The maximum number of columns (rows) below the threshold tolerated
+        inside a single line (default: 1).
+
+        Returns
+        -------
+        List[Line]
+        A list of the vertical and horizontal lines detected in the report.
+        """
+        gray = self.get_grayscale()
+        height, width = gray.shape
+
+        if binarization_threshold is None:
+            _, dark = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        else:
+            dark = (gray < binarization_threshold).astype(np.uint8)
+
+        column_profile = dark.sum(axis=0, dtype=np.int64)
+        row_profile = dark.sum(axis=1, dtype=np.int64)
+
+        lines_list = [
+            Line(x, 0, x, height - 1)
+            for x in find_projection_peaks(column_profile, threshold, max_gap)
+        ]
+        lines_list += [
+            Line(0, y, width - 1, y)
+            for y in find_projection_peaks(row_profile, threshold, max_gap)
+        ]
 
         return lines_list
+
+
+def find_projection_peaks(profile: np.ndarray, threshold: int, max_gap: int = 1) -> List[int]:
+    """Finds the positions of the peaks in a projection profile.
+
+    Parameters
+    ----------
+    profile : np.ndarray
+    The number of dark pixels in every column (or row) of an image.
+    threshold : int
+    The value above which a position of the profile belongs to a peak.
+    max_gap : int
+    The maximum number of consecutive positions below the threshold
+    tolerated inside a single peak (default: 1).
+
+    Returns
+    -------
+    List[int]
+    The profile-weighted center of every peak.
+    """
+    above = np.flatnonzero(profile >= threshold)
+    if len(above) == 0:
+        return []
+
+    # Split the positions above the threshold into runs separated by more
+    # than `max_gap` positions; every run corresponds to one (thick) line.
+    runs = np.split(above, np.flatnonzero(np.diff(above) > max_gap + 1) + 1)
+
+    return [
+        int(round(np.average(run, weights=profile[run])))
+        for run in runs
+    ]
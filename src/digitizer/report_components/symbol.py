@@ -17,28 +17,27 @@ from utils.geometry import get_bounding_box_relative_to_original_report
 
 class Symbol(object):
 
-    def __init__(self, symbol_dict: dict, audiogram_coordinates: dict, correction_angle: float):
-        bbox = symbol_dict["boundingBox"]
-        self.p1 = { 
-            "x": bbox["x"],
-            "y": bbox["y"]
-        }
-
-        self.p2 = { 
-            "x": bbox["x"] + bbox["width"],
-            "y": bbox["y"] + bbox["height"]
-        }
+    __slots__ = ("x1", "y1", "x2", "y2", "width", "height", "absolute_bounding_box",
+                 "ear", "masking", "conduction", "measurement_type", "confidence")
 
-        self.dimensions = { 
-            "width": bbox["width"],
-            "height": bbox["height"]
-        }
-
-        self.absolute_bounding_box = get_bounding_box_relative_to_original_report(bbox, audiogram_coordinates, correction_angle)
-
-        self.ear = "left" if "left" in symbol_dict["measurementType"].lower() else "right"
-        self.masking = False if "unmasked" in symbol_dict["measurementType"].lower() else True
-        self.conduction = "air" if "air" in symbol_dict["measurementType"].lower() else "bone"
+    def __init__(self, symbol_dict: dict, audiogram_coordinates: dict, correction_angle: float, absolute_bounding_box: Optional[dict] = None):
+        bbox = symbol_dict["boundingBox"]
+        self.x1 = bbox["x"]
+        self.y1 = bbox["y"]
+        self.x2 = bbox["x"] + bbox["width"]
+        self.y2 = bbox["y"] + bbox["height"]
+        self.width = bbox["width"]
+        self.height = bbox["height"]
+
+        # The bounding box relative to the original report may be precomputed
+        # for all the detections at once (see `get_bounding_boxes_relative_to_original_report`)
+        self.absolute_bounding_box = absolute_bounding_box if absolute_bounding_box is not None \
+            else get_bounding_box_relative_to_original_report(bbox, audiogram_coordinates, correction_angle)
+
+        measurement_type = symbol_dict["measurementType"].lower()
+        self.ear = "left" if "left" in measurement_type else "right"
+        self.masking = False if "unmasked" in measurement_type else True
+        self.conduction = "air" if "air" in measurement_type else "bone"
         self.measurement_type = symbol_dict["measurementType"]
         self.confidence = symbol_dict["confidence"]
 
@@ -52,11 +51,11 @@ class Symbol(object):
         """
         color = "rgb(255,0,0)" if self.is_frequency() else "rgb(0,0,255)"
         canvas.rectangle(
-            (self.p1["x"], self.p1["y"], self.p2["x"], self.p2["y"]),
+            (self.x1, self.y1, self.x2, self.y2),
             outline=color,
             width=3
         )
-        canvas.text((self.p1["x"], self.p1["y"] - 10), str(self.get_value()), fill=color)
+        canvas.text((self.x1, self.y1 - 10), str(self.get_value()), fill=color)
 
     def get_center(self):
         """Returns the center of the symbol's bounding box.
@@ -68,8 +67,8 @@ class Symbol(object):
         of the form { "x": int, "y": int }.
         """
         center = {
-            "x": (self.p1["x"] + self.p2["x"]) / 2,
-            "y": (self.p1["y"] + self.p2["y"]) / 2
+            "x": (self.x1 + self.x2) / 2,
+            "y": (self.y1 + self.y2) / 2
         }
         return center
 
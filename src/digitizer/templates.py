@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+Cache of the layout of known report templates (forms), keyed by a perceptual
+fingerprint of the downsampled page, so that the audiograms of a report
+matching a known template can be located without the audiogram detector nor
+the estimation of their correction angle, and their grids calibrated without
+the label detector.
+"""
+
+from typing import List, Optional
+import json
+import os
+
+import numpy as np
+import cv2
+
+from interfaces import AudiogramDict, TemplateAudiogramDict, TemplateDict
+from digitizer.report_components.calibration import GridCalibration
+from digitizer.report_components.report import Report
+
+# Size of the thumbnail that is fingerprinted (FINGERPRINT_SIZE x FINGERPRINT_SIZE bits)
+FINGERPRINT_SIZE = 16
+
+# Largest number of differing bits between the fingerprints of two pages of
+# the same template ...
+TEMPLATE_MAX_DISTANCE = 24
+
+# ... and between the fingerprints of the audiograms of a template and of the
+# same regions of the page being matched
+AUDIOGRAM_MAX_DISTANCE = 32
+
+# The correction angle of a template is only reused if it aligns the audiogram
+# of the page (downsampled to about ALIGNMENT_MAX_SIZE pixels) at least as well
+# as the angles ALIGNMENT_STEP degrees away from it
+ALIGNMENT_MAX_SIZE = 256
+ALIGNMENT_STEP = 0.5
+
+# At most TEMPLATE_MAX_COUNT templates are kept: beyond, the template matched
+# by the fewest pages (the oldest of them) is evicted
+TEMPLATE_MAX_COUNT = 256
+
+# The templates are only written to their file every TEMPLATE_SAVE_INTERVAL
+# changes (and by `save`, once all the reports are processed)
+TEMPLATE_SAVE_INTERVAL = 16
+
+def compute_fingerprint(image: np.ndarray) -> np.ndarray:
+    """Computes the difference hash (dHash) of an image: whether each pixel
+    of a FINGERPRINT_SIZE x (FINGERPRINT_SIZE + 1) grayscale thumbnail is
+    brighter than its left neighbour. It is insensitive to the resolution,
+    the compression and small changes of the content (e.g. handwriting)
+    but not to the layout of the page.
+
+    Parameters
+    ----------
+    image : np.ndarray
+    A grayscale or BGR image.
+
+    Returns
+    -------
+    np.ndarray
+    A boolean array of FINGERPRINT_SIZE * FINGERPRINT_SIZE bits.
+    """
+    thumbnail = cv2.resize(image, (FINGERPRINT_SIZE + 1, FINGERPRINT_SIZE), interpolation=cv2.INTER_AREA)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    return (thumbnail[:, 1:] > thumbnail[:, :-1]).reshape(-1)
+
+def fingerprint_to_hex(fingerprint: np.ndarray) -> str:
+    return np.packbits(fingerprint).tobytes().hex()
+
+def hex_to_fingerprint(fingerprint: str) -> np.ndarray:
+    return np.unpackbits(np.frombuffer(bytes.fromhex(fingerprint), dtype=np.uint8)).astype(bool)
+
+def alignment_score(gray: np.ndarray, angle: float) -> float:
+    """Returns the sharpness of the row and column projection profiles of
+    the ink of a grayscale image rotated by `angle` degrees, which is
+    highest when the grid lines are horizontal and vertical.
+    """
+    ink = 255 - Report(image=gray).rotate(angle).image.astype(np.float32)
+    return float(np.sum(np.square(ink.sum(axis=0))) + np.sum(np.square(ink.sum(axis=1))))
+
+def is_aligned(report: Report, angle: float, step: float = ALIGNMENT_STEP) -> bool:
+    """Checks that the correction angle of an audiogram aligns its grid at
+    least as well as the angles `step` degrees away from it.
+
+    Parameters
+    ----------
+    report : Report
+    The audiogram (not deskewed).
+    angle : float
+    The correction angle (in degrees).
+    step : float
+    The difference (in degrees) with the angles it is compared to (default: ALIGNMENT_STEP).
+
+    Returns
+    -------
+    bool
+    True if `angle` aligns the grid of the audiogram.
+    """
+    gray = report.get_grayscale()
+    while max(gray.shape) >= 2 * ALIGNMENT_MAX_SIZE:
+        gray = cv2.pyrDown(gray)
+    score = alignment_score(gray, angle)
+    return score >= alignment_score(gray, angle - step) and score >= alignment_score(gray, angle + step)
+
+# The grid lines predicted by a cached calibration are looked for within
+# CALIBRATION_CHECK_TOLERANCE pixels, and must be at least
+# CALIBRATION_CHECK_CONTRAST gray levels darker than the background of the
+# grid for CALIBRATION_CHECK_MIN_FRACTION of them
+CALIBRATION_CHECK_TOLERANCE = 5
+CALIBRATION_CHECK_CONTRAST = 32
+CALIBRATION_CHECK_MIN_FRACTION = 0.75
+CALIBRATION_CHECK_FREQUENCIES = (250, 500, 1000, 2000, 4000, 8000)
+CALIBRATION_CHECK_THRESHOLDS = (0, 20, 40, 60, 80, 100)
+
+def check_calibration(gray: np.ndarray, calibration: GridCalibration, tolerance: int = CALIBRATION_CHECK_TOLERANCE) -> bool:
+    """Checks that the grid lines of the usual octave frequencies and of
+    every 20 dB, as predicted by a calibration, land on dark pixels of the
+    deskewed audiogram.
+
+    Parameters
+    ----------
+    gray : np.ndarray
+    The deskewed audiogram (grayscale).
+    calibration : GridCalibration
+    The calibration of its grid.
+    tolerance : int
+    Distance (in pixels) within which the lines are looked for (default: CALIBRATION_CHECK_TOLERANCE).
+
+    Returns
+    -------
+    bool
+    True if enough of the predicted grid lines are found.
+    """
+    height, width = gray.shape[:2]
+    xs, ys = calibration.inverse(np.array(CALIBRATION_CHECK_FREQUENCIES), np.array(CALIBRATION_CHECK_THRESHOLDS))
+    xs = np.round(xs[(xs >= tolerance) & (xs < width - tolerance)]).astype(int)
+    ys = np.round(ys[(ys >= tolerance) & (ys < height - tolerance)]).astype(int)
+    if len(xs) < 2 or len(ys) < 2:
+        return False
+
+    # Only the extent of the grid is considered
+    grid = gray[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+    background = float(np.median(grid))
+    x_offset, y_offset = xs.min(), ys.min()
+    found = [
+        np.median(grid[:, max(x - x_offset - tolerance, 0):x - x_offset + tolerance + 1].min(axis=1)) <= background - CALIBRATION_CHECK_CONTRAST
+        for x in xs
+    ] + [
+        np.median(grid[max(y - y_offset - tolerance, 0):y - y_offset + tolerance + 1, :].min(axis=0)) <= background - CALIBRATION_CHECK_CONTRAST
+        for y in ys
+    ]
+    return float(np.mean(found)) >= CALIBRATION_CHECK_MIN_FRACTION
+
+def get_crop(report: Report, bounding_box: dict) -> Report:
+    return report.crop(
+        bounding_box["x"],
+        bounding_box["y"],
+        bounding_box["x"] + bounding_box["width"],
+        bounding_box["y"] + bounding_box["height"]
+    )
+
+class TemplateCache(object):
+
+    def __init__(self, filename: Optional[str] = None, max_distance: int = TEMPLATE_MAX_DISTANCE,
+            audiogram_max_distance: int = AUDIOGRAM_MAX_DISTANCE, max_count: int = TEMPLATE_MAX_COUNT,
+            save_interval: int = TEMPLATE_SAVE_INTERVAL):
+        """The layouts of the report templates seen so far.
+
+        Parameters
+        ----------
+        filename : Optional[str]
+        The JSON file in which the templates are persisted. It is read if it
+        exists and written every `save_interval` changes and by `save`
+        (default: None, i.e. the templates are only kept in memory).
+        max_distance : int
+        Largest Hamming distance between the fingerprints of two pages of
+        the same template (default: TEMPLATE_MAX_DISTANCE).
+        audiogram_max_distance : int
+        Largest Hamming distance between the fingerprint of an audiogram of
+        the template and the same region of a matching page (default:
+        AUDIOGRAM_MAX_DISTANCE).
+        max_count : int
+        Largest number of templates kept (default: TEMPLATE_MAX_COUNT).
+        save_interval : int
+        Number of changes after which the templates are written to
+        `filename` (default: TEMPLATE_SAVE_INTERVAL).
+        """
+        self.filename = filename
+        self.max_distance = max_distance
+        self.audiogram_max_distance = audiogram_max_distance
+        self.max_count = max_count
+        self.save_interval = save_interval
+        self.templates: List[TemplateDict] = []
+        if filename and os.path.exists(filename):
+            with open(filename) as ifile:
+                self.templates = json.load(ifile)
+        self._fingerprints = [hex_to_fingerprint(template["fingerprint"]) for template in self.templates]
+        self._changes = 0
+
+    def __len__(self):
+        return len(self.templates)
+
+    def match(self, report: Report) -> Optional[TemplateDict]:
+        """Finds the template of the page, if it is known and its audiograms
+        are where they are expected (see `verify`).
+
+        Parameters
+        ----------
+        report : Report
+        The (full) report.
+
+        Returns
+        -------
+        Optional[TemplateDict]
+        The template, or None if no known template matches the report.
+        """
+        for i in self._find_similar(compute_fingerprint(report.image), report.width, report.height):
+            template = self.templates[i]
+            if self.verify(template, report):
+                template["matches"] = template.get("matches", 0) + 1
+                self._changed()
+                return template
+        return None
+
+    def _find_similar(self, fingerprint: np.ndarray, width: int, height: int) -> List[int]:
+        """Returns the indices of the templates of the given size whose
+        fingerprint is within `max_distance` of `fingerprint`, nearest first.
+        """
+        if len(self.templates) == 0:
+            return []
+        distances = np.array([np.count_nonzero(fingerprint != other) for other in self._fingerprints])
+        return [
+            i for i in np.argsort(distances, kind="stable")
+            if distances[i] <= self.max_distance and (self.templates[i]["width"], self.templates[i]["height"]) == (width, height)
+        ]
+
+    def verify(self, template: TemplateDict, report: Report) -> bool:
+        """Checks that the regions of the report where the template expects
+        its audiograms look like the audiograms of the template, and that
+        the correction angles of the template align them (see `is_aligned`).
+
+        Parameters
+        ----------
+        template : TemplateDict
+        The template.
+        report : Report
+        The (full) report.
+
+        Returns
+        -------
+        bool
+        True if all the audiograms of the template are found in the report.
+        """
+        for audiogram in template["audiograms"]:
+            crop = get_crop(report, audiogram["boundingBox"])
+            distance = np.count_nonzero(compute_fingerprint(crop.image) != hex_to_fingerprint(audiogram["fingerprint"]))
+            if distance > self.audiogram_max_distance or not is_aligned(crop, audiogram["correctionAngle"]):
+                return False
+        return True
+
+    def add(self, report: Report, audiograms: List[AudiogramDict]) -> TemplateDict:
+        """Adds the layout of a report to the cache.
+
+        If the page is similar to a known template but did not match it
+        (see `verify`), e.g. because it was scanned with another skew, its
+        layout replaces that of the template rather than adding a
+        near-duplicate. Otherwise, when the cache is full, the template
+        matched by the fewest pages is evicted.
+
+        Parameters
+        ----------
+        report : Report
+        The (full) report.
+        audiograms : List[AudiogramDict]
+        The audiograms detected in the report, with their `correctionAngle`.
+
+        Returns
+        -------
+        TemplateDict
+        The new (or updated) template.
+        """
+        fingerprint = compute_fingerprint(report.image)
+        layout = [{
+            "boundingBox": audiogram["boundingBox"],
+            "confidence": audiogram.get("confidence"),
+            "correctionAngle": audiogram["correctionAngle"],
+            "fingerprint": fingerprint_to_hex(compute_fingerprint(get_crop(report, audiogram["boundingBox"]).image)),
+            "calibration": None
+        } for audiogram in audiograms]
+
+        similar = self._find_similar(fingerprint, report.width, report.height)
+        if len(similar) > 0:
+            template = self.templates[similar[0]]
+            template["fingerprint"] = fingerprint_to_hex(fingerprint)
+            template["audiograms"] = layout
+            self._fingerprints[similar[0]] = fingerprint
+        else:
+            if len(self.templates) >= self.max_count:
+                evicted = int(np.argmin([t.get("matches", 0) for t in self.templates]))
+                del self.templates[evicted]
+                del self._fingerprints[evicted]
+            template: TemplateDict = {
+                "fingerprint": fingerprint_to_hex(fingerprint),
+                "width": report.width,
+                "height": report.height,
+                "audiograms": layout,
+                "matches": 0
+            }
+            self.templates.append(template)
+            self._fingerprints.append(fingerprint)
+        self._changed()
+        return template
+
+    def set_calibration(self, template_audiogram: TemplateAudiogramDict, calibration: GridCalibration):
+        """Stores the grid calibration of an audiogram of a template, so that
+        the labels of the audiograms of the reports matching the template do
+        not need to be detected.
+
+        Parameters
+        ----------
+        template_audiogram : TemplateAudiogramDict
+        The audiogram of the template.
+        calibration : GridCalibration
+        The calibration of its grid.
+        """
+        template_audiogram["calibration"] = calibration.to_dict()
+        self._changed()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """Writes the templates to `filename`, if any and if they changed
+        since they were last written.
+        """
+        if self.filename and self._changes > 0:
+            with open(self.filename, "w") as ofile:
+                json.dump(self.templates, ofile, indent=4, separators=(',', ': '))
+        self._changes = 0
@@ -9,13 +9,15 @@ from pathlib import Path
 import cv2
 import torch
 import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
 from numpy import random
 
 from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from models.yolo import Detect
+from utils.datasets import LoadStreams, LoadImages, tile_image
 from utils.general import (
-    check_img_size, non_max_suppression, apply_classifier, scale_coords,
-    xyxy2xywh, plot_one_box, strip_optimizer, set_logging)
+    check_img_size, nms_candidates, non_max_suppression, apply_classifier, scale_coords, clip_coords,
+    xyxy2xywh, plot_one_box, strip_optimizer, set_logging, merge_tile_predictions)
 from utils.torch_utils import select_device, load_classifier, time_synchronized
 
 
@@ -33,8 +35,16 @@ def detect(save_img=False):
     # Load model
     model = attempt_load(weights, map_location=device)  # load FP32 model
     imgsz = check_img_size(imgsz, s=model.stride.max())  # check img_size
+    img_size_range = [check_img_size(x, s=model.stride.max()) for x in opt.img_size_range] if opt.img_size_range else None
+    tile_size = check_img_size(opt.tile_size, s=model.stride.max()) if opt.tile_size else 0  # check tile_size
+    if 0 < tile_size <= opt.tile_overlap:
+        raise ValueError('tile-size %g must exceed tile-overlap %g' % (tile_size, opt.tile_overlap))
     if half:
         model.half()  # to FP16
+    if not opt.dense_decode:
+        for m in model.modules():
+            if isinstance(m, Detect):
+                m.conf_thres = opt.conf_thres  # only decode the anchors whose objectness exceeds conf_thres
 
     # Second-stage classifier
     classify = False
@@ -51,7 +61,7 @@ def detect(save_img=False):
         dataset = LoadStreams(source, img_size=imgsz)
     else:
         save_img = True
-        dataset = LoadImages(source, img_size=imgsz)
+        dataset = LoadImages(source, img_size=imgsz, img_size_range=img_size_range, stride=int(model.stride.max()))
 
     # Get names and colors
     names = model.module.names if hasattr(model, 'module') else model.names
@@ -70,10 +80,25 @@ def detect(save_img=False):
 
         # Inference
         t1 = time_synchronized()
-        pred = model(img, augment=opt.augment)[0]
+        if tile_size:  # native resolution tiles, batched, with boxes in im0 coordinates
+            tiles, offsets = tile_image(im0s, tile_size, opt.tile_overlap)
+            pred = []
+            for j in range(0, len(tiles), opt.tile_batch):
+                batch = torch.from_numpy(tiles[j:j + opt.tile_batch]).to(device)
+                batch = (batch.half() if half else batch.float()) / 255.0  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+                pred.append(model(batch, augment=opt.augment)[0])
+            n = max(p.shape[1] for p in pred)  # sparse decode rows differ per batch, pad with zero objectness rows
+            pred = torch.cat([F.pad(p, (0, 0, 0, n - p.shape[1])) for p in pred], 0)
+            pred = merge_tile_predictions(pred, offsets, tile_size, im0s.shape)
+        else:
+            pred = model(img, augment=opt.augment)[0]
 
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        # Apply NMS, or only select its candidates
+        if opt.candidates:
+            pred = nms_candidates(pred, opt.conf_thres, classes=opt.classes)
+        else:
+            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes,
+                                       agnostic=opt.agnostic_nms, max_det=opt.max_det)
         t2 = time_synchronized()
 
         # Apply Classifier
@@ -91,9 +116,20 @@ def detect(save_img=False):
             txt_path = str(Path(out) / Path(p).stem) + ('_%g' % dataset.frame if dataset.mode == 'video' else '')
             s += '%gx%g ' % img.shape[2:]  # print string
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            if opt.candidates:  # im0 coordinates, neither clipped nor rounded (as the detections, after the NMS)
+                if det is not None and not tile_size:
+                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape, clip=False)
+                results.append({'imageShape': list(im0.shape[:2]),
+                                'candidates': [[*xyxy, conf, names[int(cls)]]
+                                               for *xyxy, conf, cls in (det.tolist() if det is not None else [])]})
+                continue
             if det is not None and len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                if tile_size:
+                    clip_coords(det, im0.shape)
+                    det[:, :4] = det[:, :4].round()
+                else:
+                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, -1].unique():
@@ -132,16 +168,25 @@ if __name__ == '__main__':
     parser.add_argument('--source', type=str, default='inference/images', help='source')  # file/folder, 0 for webcam
     parser.add_argument('--output', type=str, default='inference/output', help='output folder')  # output folder
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--img-size-range', nargs=2, type=int, help='inference size relative to the image: its longest side clipped to [min, max] (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.4, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.5, help='IOU threshold for NMS')
+    parser.add_argument('--max-det', type=int, default=100, help='maximum number of symbols per image (a warning is logged beyond)')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--view-img', action='store_true', help='display results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --class 0, or --class 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--dense-decode', action='store_true', help='decode every anchor, not only those above conf-thres')
+    parser.add_argument('--candidates', action='store_true', help='print the NMS candidates (xyxy, conf, class) of each image')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--update', action='store_true', help='update all models')
+    parser.add_argument('--tile-size', type=int, default=0, help='tiled inference at native resolution (pixels), 0 to resize the image to img-size')
+    parser.add_argument('--tile-overlap', type=int, default=128, help='overlap between tiles (pixels), larger than the largest object')
+    parser.add_argument('--tile-batch', type=int, default=8, help='number of tiles per forward pass')
     opt = parser.parse_args()
+    if opt.img_size_range and opt.img_size_range[0] > opt.img_size_range[1]:
+        parser.error('--img-size-range: min must not exceed max')
     print(opt)
 
     with torch.no_grad():
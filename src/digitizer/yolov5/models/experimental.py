@@ -1,5 +1,9 @@
 # This file contains experimental modules
 
+import json
+import os
+from copy import deepcopy
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -129,10 +133,71 @@ class Ensemble(nn.ModuleList):
         return y, None  # inference, train output
 
 
+def save_fused(model, f, source=None):
+    # Saves a fused FP32 model for inference: manifest f (*.json) of the architecture and tensors, raw tensors f[:-5] + '.bin'
+    # The size and modification time of the source checkpoint, if given, are recorded so that stale exports are detected
+    model.float()
+    if any(type(m) is Conv and hasattr(m, 'bn') for m in model.modules()):
+        model.fuse()
+    tensors, offset = {}, 0
+    bin_file = os.path.splitext(f)[0] + '.bin'
+    with open(bin_file, 'wb') as fb:
+        for k, v in model.state_dict().items():
+            a = v.detach().cpu().contiguous().numpy()
+            offset += -offset % 64  # align
+            fb.seek(offset)
+            fb.write(a.tobytes())
+            tensors[k] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+            offset += a.nbytes
+    manifest = {'yaml': model.yaml, 'names': list(model.names), 'stride': model.stride.tolist(),
+                'data': os.path.basename(bin_file), 'tensors': tensors}
+    if source:
+        st = os.stat(source)
+        manifest['source'] = {'file': os.path.basename(source), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    with open(f, 'w') as fm:
+        json.dump(manifest, fm)
+
+
+def load_fused(f):
+    # Loads a model saved by save_fused, its tensors memory-mapped (copy-on-write) so that processes share their pages
+    from models.yolo import Model, parse_model
+
+    with open(f) as fm:
+        manifest = json.load(fm)
+    model = Model.__new__(Model)  # architecture only, no stride computation, weight init nor fusion
+    nn.Module.__init__(model)
+    model.yaml = manifest['yaml']
+    model.model, model.save = parse_model(deepcopy(model.yaml), ch=[model.yaml.get('ch', 3)])
+    for m in model.modules():
+        if type(m) is Conv:  # fused layout, conv with bias and no batchnorm
+            delattr(m, 'bn')
+            m.forward = m.fuseforward
+
+    data = np.memmap(os.path.join(os.path.dirname(f), manifest['data']), dtype=np.uint8, mode='c')
+    modules = dict(model.named_modules())
+    expected = set(model.state_dict().keys()) | {k + '.conv.bias' for k, m in modules.items() if type(m) is Conv}
+    assert expected == set(manifest['tensors']), 'Fused model %s does not match its architecture' % f
+    for k, t in manifest['tensors'].items():
+        dtype = np.dtype(t['dtype'])
+        a = data[t['offset']:t['offset'] + int(np.prod(t['shape'])) * dtype.itemsize].view(dtype).reshape(t['shape'])
+        m, name = modules[k.rpartition('.')[0]], k.rpartition('.')[2]
+        if name in m._buffers:
+            m._buffers[name] = torch.from_numpy(a)
+        else:
+            m._parameters[name] = nn.Parameter(torch.from_numpy(a), requires_grad=False)
+
+    model.names = manifest['names']
+    model.stride = model.model[-1].stride = torch.tensor(manifest['stride'])
+    return model
+
+
 def attempt_load(weights, map_location=None):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
+        if str(w).endswith('.json'):  # fused model, see save_fused
+            model.append(load_fused(w).to(map_location).eval())
+            continue
         attempt_download(w)
         model.append(torch.load(w, map_location=map_location)['model'].float().fuse().eval())  # load FP32 model
 
@@ -1,4 +1,4 @@
-"""Exports a YOLOv5 *.pt model to ONNX and TorchScript formats
+"""Exports a YOLOv5 *.pt model to fused inference (*.fused.json), ONNX and TorchScript formats
 
 Usage:
     $ export PYTHONPATH="$PWD" && python models/export.py --weights ./weights/yolov5s.pt --img 640 --batch 1
@@ -10,7 +10,7 @@ import torch
 import torch.nn as nn
 
 from models.common import Conv
-from models.experimental import attempt_load
+from models.experimental import attempt_load, save_fused
 from utils.activations import Hardswish
 from utils.general import set_logging
 
@@ -30,6 +30,15 @@ if __name__ == '__main__':
     # Load PyTorch model
     model = attempt_load(opt.weights, map_location=torch.device('cpu'))  # load FP32 model
 
+    # Fused inference export (memory-mapped by attempt_load)
+    try:
+        print('\nStarting fused inference export...')
+        f = opt.weights.replace('.pt', '.fused.json')  # filename
+        save_fused(model, f, source=opt.weights)
+        print('Fused inference export success, saved as %s' % f)
+    except Exception as e:
+        print('Fused inference export failure: %s' % e)
+
     # Update model
     for k, m in model.named_modules():
         m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatability
@@ -19,6 +19,7 @@ logger = logging.getLogger(__name__)
 class Detect(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
+    conf_thres = None  # inference only decodes the anchors whose objectness exceeds it, if set
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(Detect, self).__init__()
@@ -36,22 +37,52 @@ class Detect(nn.Module):
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
+        gated = self.conf_thres is not None and not self.training
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
+            if gated:  # inference, sparse decode
+                z.append(self._decode_gated(x[i], i))
+            elif not self.training:  # inference
                 y = x[i].sigmoid()
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i].to(x[i].device)) * self.stride[i]  # xy
+                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self._get_grid(nx, ny, x[i].device)) * self.stride[i]  # xy
                 y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
                 z.append(y.view(bs, -1, self.no))
 
+        if gated:
+            return self._pad_gated(z, x[0].shape[0]), x
         return x if self.training else (torch.cat(z, 1), x)
 
+    def _get_grid(self, nx, ny, device):
+        # Grids cached per resolution (models unpickled from older checkpoints have no cache yet)
+        grids = self.__dict__.setdefault('grids', {})
+        key = (nx, ny, device)
+        if key not in grids:
+            grids[key] = self._make_grid(nx, ny).to(device)
+        return grids[key]
+
+    def _decode_gated(self, xi, i):
+        # Thresholds the objectness logits, sigmoid(o) > conf_thres <=> o > logit(conf_thres), and decodes the survivors
+        c = min(max(self.conf_thres, 1E-6), 1 - 1E-6)
+        t = math.log(c / (1 - c)) - 1E-5  # margin for the rounding of sigmoid, NMS applies the exact threshold
+        b, a, gy, gx = (xi[..., 4] > t).nonzero(as_tuple=True)
+        y = xi[b, a, gy, gx].sigmoid()  # (n,no)
+        y[:, 0:2] = (y[:, 0:2] * 2. - 0.5 + torch.stack((gx, gy), 1).to(y.dtype)) * self.stride[i]  # xy
+        y[:, 2:4] = (y[:, 2:4] * 2) ** 2 * self.anchor_grid[i].view(self.na, 2)[a]  # wh
+        return b, y
+
+    def _pad_gated(self, z, bs):
+        # Gathers the survivors of each image into an output of shape (bs,n,no), padded with zero objectness rows
+        b = torch.cat([bi for bi, _ in z])
+        y = torch.cat([yi for _, yi in z])
+        n = torch.bincount(b, minlength=bs) if len(b) else b.new_zeros(bs)
+        out = y.new_zeros((bs, int(n.max()), self.no))
+        for k in range(bs):
+            out[k, :n[k]] = y[b == k]
+        return out
+
     @staticmethod
     def _make_grid(nx=20, ny=20):
         yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
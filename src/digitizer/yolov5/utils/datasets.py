@@ -12,9 +12,8 @@ import numpy as np
 import torch
 from PIL import Image, ExifTags
 from torch.utils.data import Dataset
-from tqdm import tqdm
 
-from utils.general import xyxy2xywh, xywh2xyxy, torch_distributed_zero_first
+from utils.general import xyxy2xywh, xywh2xyxy, torch_distributed_zero_first, make_divisible
 
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.dng']
@@ -72,8 +71,26 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
     return dataloader, dataset
 
 
+def load_image_reduced(path, min_size):
+    # Decodes a JPEG image at 1/8, 1/4 or 1/2 of its resolution (DCT scaling), the largest reduction whose longest
+    # side is still >= min_size. Other formats are decoded at full resolution. Returns img (BGR), original (h, w)
+    if os.path.splitext(path)[-1].lower() not in ['.jpg', '.jpeg']:
+        img = cv2.imread(path)
+        return img, (img.shape[:2] if img is not None else None)
+    try:
+        with Image.open(path) as img:  # only reads the header
+            w0, h0 = exif_size(img)
+    except:
+        img = cv2.imread(path)
+        return img, (img.shape[:2] if img is not None else None)
+    for f, flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if max(h0, w0) >= f * min_size:
+            return cv2.imread(path, flags), (h0, w0)
+    return cv2.imread(path), (h0, w0)
+
+
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640):
+    def __init__(self, path, img_size=640, reduced_decode=False, img_size_range=None, stride=64):
         p = str(Path(path))  # os-agnostic
         p = os.path.abspath(p)  # absolute path
         if '*' in p:
@@ -90,6 +107,11 @@ class LoadImages:  # for inference
         ni, nv = len(images), len(videos)
 
         self.img_size = img_size
+        self.img_size_range = img_size_range  # (min, max) inference size relative to the image, instead of img_size
+        self.stride = stride  # with img_size_range, inference sizes and letterbox padding are multiples of stride
+        self.buffers = {}  # letterbox output buffers of the last shapes, see letterbox_chw()
+        self.reduced_decode = reduced_decode  # decode images at a reduced resolution, see load_image_reduced()
+        self.shape0 = None  # original (h, w) of the last image, img0 may be smaller with reduced_decode
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
@@ -130,16 +152,23 @@ class LoadImages:  # for inference
         else:
             # Read image
             self.count += 1
-            img0 = cv2.imread(path)  # BGR
+            if self.reduced_decode:
+                img0, self.shape0 = load_image_reduced(path, self.img_size_range[1] if self.img_size_range else self.img_size)  # BGR
+            else:
+                img0 = cv2.imread(path)  # BGR
+                self.shape0 = img0.shape[:2] if img0 is not None else None
             assert img0 is not None, 'Image Not Found ' + path
             print('image %g/%g %s: ' % (self.count, self.nf, path), end='')
 
-        # Padded resize
-        img = letterbox(img0, new_shape=self.img_size)[0]
-
-        # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
+        # Padded resize, with img_size_range to the longest side of the original image clipped to the range
+        # and padded to a multiple of stride (a fixed img_size is padded to a multiple of 64)
+        img_size, stride = self.img_size, 64
+        if self.img_size_range:
+            shape0 = self.shape0 if self.mode == 'images' else img0.shape[:2]
+            img_size = make_divisible(min(max(max(shape0), self.img_size_range[0]), self.img_size_range[1]), self.stride)
+            stride = self.stride
+        # Convert BGR to RGB, to 3x416x416 in the same pass (img is overwritten by the next image of the same shape)
+        img = letterbox_chw(img0, new_shape=img_size, stride=stride, buffers=self.buffers)[0]
 
         # cv2.imwrite(path + '.letterbox.jpg', 255 * img.transpose((1, 2, 0))[:, :, ::-1])  # save letterbox image
         return path, img, img0, self.cap
@@ -294,6 +323,7 @@ class LoadStreams:  # multiple IP or RTSP cameras
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0, rank=-1):
+        from tqdm import tqdm
         try:
             f = []  # image files
             for p in path if isinstance(path, list) else [path]:
@@ -444,6 +474,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
     def cache_labels(self, path='labels.cache'):
         # Cache dataset labels, check images and read shapes
+        from tqdm import tqdm
         x = {}  # dict
         pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
         for (img, label) in pbar:
@@ -684,8 +715,8 @@ def replicate(img, labels):
     return img, labels
 
 
-def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True):
-    # Resize image to a 32-pixel-multiple rectangle https://github.com/ultralytics/yolov3/issues/232
+def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=64):
+    # Resize image to a stride-multiple rectangle https://github.com/ultralytics/yolov3/issues/232
     shape = img.shape[:2]  # current shape [height, width]
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
@@ -700,7 +731,7 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
     dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
     if auto:  # minimum rectangle
-        dw, dh = np.mod(dw, 64), np.mod(dh, 64)  # wh padding
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)  # wh padding
     elif scaleFill:  # stretch
         dw, dh = 0.0, 0.0
         new_unpad = (new_shape[1], new_shape[0])
@@ -717,6 +748,61 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+def letterbox_chw(img, new_shape=(640, 640), color=(114, 114, 114), stride=64, buffers=None, max_buffers=2):
+    # letterbox() (auto=True, scaleup=True) of a BGR image to an RGB CHW image, converted in the same pass as it is
+    # written into a uint8 buffer, without the img[:, :, ::-1].transpose(2, 0, 1) and ascontiguousarray() copies.
+    # The output buffers of the last max_buffers shapes are kept in buffers (dict, least recently used first), if
+    # provided, and reused by the next calls
+    shape = img.shape[:2]  # current shape [height, width]
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = np.mod(new_shape[1] - new_unpad[0], stride) / 2, np.mod(new_shape[0] - new_unpad[1], stride) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    h, w = new_unpad[1] + top + bottom, new_unpad[0] + left + right
+
+    if shape[::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+    out = buffers.pop((3, h, w), None) if buffers is not None else None
+    if out is None:
+        out = np.empty((3, h, w), dtype=np.uint8)
+    if buffers is not None:
+        buffers[(3, h, w)] = out  # most recently used
+        while len(buffers) > max_buffers:
+            del buffers[next(iter(buffers))]
+    y1, y2, x1, x2 = top, top + new_unpad[1], left, left + new_unpad[0]
+    for c in range(3):  # RGB channel c is BGR channel 2 - c
+        plane = out[c]
+        plane[:y1], plane[y2:], plane[y1:y2, :x1], plane[y1:y2, x2:] = (color[2 - c],) * 4  # border
+        plane[y1:y2, x1:x2] = img[:, :, 2 - c]
+    return out, (r, r), (dw, dh)
+
+
+def tile_image(img, tile_size=640, overlap=128, color=(114, 114, 114)):
+    # Splits an image into overlapping tile_size x tile_size tiles at native resolution, the last row and column
+    # flush with the image edges (the tiles of smaller images are padded). Returns tiles (n, 3, tile_size, tile_size)
+    # RGB, offsets (n, 2) of the (x, y) of the top-left corner of each tile in the image
+    h, w = img.shape[:2]
+    assert tile_size > overlap, 'tile_size %g must exceed overlap %g' % (tile_size, overlap)
+    step = tile_size - overlap
+
+    def origins(size):
+        o = list(range(0, max(size - tile_size, 0) + 1, step))
+        if o[-1] + tile_size < size:
+            o.append(size - tile_size)
+        return o
+
+    offsets = [(x, y) for y in origins(h) for x in origins(w)]
+    tiles = np.empty((len(offsets), 3, tile_size, tile_size), dtype=np.uint8)
+    tiles[:] = np.array(color[::-1], dtype=np.uint8)[None, :, None, None]  # padding, BGR to RGB
+    for i, (x, y) in enumerate(offsets):
+        tile = img[y:y + tile_size, x:x + tile_size, ::-1].transpose(2, 0, 1)  # BGR to RGB, HWC to CHW
+        tiles[i, :, :tile.shape[1], :tile.shape[2]] = tile
+    return tiles, np.array(offsets)
+
+
 def random_perspective(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
     # targets = [cls, xyxy]
@@ -860,6 +946,7 @@ def cutout(image, labels):
 
 def reduce_img_size(path='path/images', img_size=1024):  # from utils.datasets import *; reduce_img_size()
     # creates a new ./images_reduced folder with reduced size images of maximum size img_size
+    from tqdm import tqdm
     path_new = path + '_reduced'  # reduced images path
     create_folder(path_new)
     for f in tqdm(glob.glob('%s/*.*' % path)):
@@ -877,6 +964,7 @@ def reduce_img_size(path='path/images', img_size=1024):  # from utils.datasets i
 
 def recursive_dataset2bmp(dataset='path/dataset_bmp'):  # from utils.datasets import *; recursive_dataset2bmp()
     # Converts dataset to bmp (for faster training)
+    from tqdm import tqdm
     formats = [x.lower() for x in img_formats] + [x.upper() for x in img_formats]
     for a, b, files in os.walk(dataset):
         for file in tqdm(files, desc=a):
@@ -6,29 +6,24 @@ import platform
 import random
 import shutil
 import subprocess
-import time
 from contextlib import contextmanager
 from copy import copy
 from pathlib import Path
 
 import cv2
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
-import yaml
-from scipy.cluster.vq import kmeans
-from scipy.signal import butter, filtfilt
-from tqdm import tqdm
+import torchvision
 
 from utils.torch_utils import init_seeds as init_torch_seeds
 from utils.torch_utils import is_parallel
 
+logger = logging.getLogger(__name__)
+
 # Set printoptions
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-matplotlib.rc('font', **{'size': 11})
 
 # Prevent OpenCV from multithreading (to use PyTorch DataLoader)
 cv2.setNumThreads(0)
@@ -224,8 +219,8 @@ def xywh2xyxy(x):
     return y
 
 
-def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
-    # Rescale coords (xyxy) from img1_shape to img0_shape
+def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None, clip=True):
+    # Rescale coords (xyxy) from img1_shape to img0_shape, clipped to img0_shape if clip
     if ratio_pad is None:  # calculate from img0_shape
         gain = min(img1_shape[0] / img0_shape[0], img1_shape[1] / img0_shape[1])  # gain  = old / new
         pad = (img1_shape[1] - img0_shape[1] * gain) / 2, (img1_shape[0] - img0_shape[0] * gain) / 2  # wh padding
@@ -236,7 +231,8 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     coords[:, [0, 2]] -= pad[0]  # x padding
     coords[:, [1, 3]] -= pad[1]  # y padding
     coords[:, :4] /= gain
-    clip_coords(coords, img0_shape)
+    if clip:
+        clip_coords(coords, img0_shape)
     return coords
 
 
@@ -590,30 +586,48 @@ def build_targets(p, targets, model):
     return tcls, tbox, indices, anch
 
 
-def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False):
-    """Performs Non-Maximum Suppression (NMS) on inference results
+def merge_tile_predictions(prediction, offsets, tile_size, img_shape, margin=2):
+    # Maps the raw predictions (n, anchors, 5 + nc) of n tiles of tile_size x tile_size at offsets (n, 2) (x, y) of
+    # an image of img_shape (h, w) to the image, as a single prediction (1, n * anchors, 5 + nc) for one NMS over all
+    # the tiles. Boxes reaching within margin pixels of an edge shared with another tile are cut by the tile and
+    # discarded: the overlap between the tiles must exceed the size of the largest object
+    offsets = torch.as_tensor(offsets, dtype=prediction.dtype, device=prediction.device)[:, None, :]  # (n, 1, 2)
+    size = torch.tensor(img_shape[:2][::-1], dtype=prediction.dtype, device=prediction.device)  # (w, h)
+    x1y1 = prediction[..., :2] - prediction[..., 2:4] / 2
+    x2y2 = prediction[..., :2] + prediction[..., 2:4] / 2
+    cut = ((x1y1 < margin) & (offsets > 0)) | ((x2y2 > tile_size - margin) & (offsets + tile_size < size))
+    prediction = prediction.clone()
+    prediction[..., 4][cut.any(-1)] = 0  # objectness
+    prediction[..., :2] += offsets  # tile to image xy
+    return prediction.view(1, -1, prediction.shape[-1])
+
+
+def nms_candidates(prediction, conf_thres=0.1, classes=None, max_nms=3000):
+    """Selects the candidates of non_max_suppression(): the boxes of each image whose confidence (objectness times
+    class score) exceeds conf_thres, once per such class with several classes, among the max_nms boxes of highest
+    objectness (with a warning when this limit is hit)
 
     Returns:
-         detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
+         candidates of each image with shape: nx6 (x1, y1, x2, y2, conf, cls), None when there are none
     """
 
     nc = prediction[0].shape[1] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
     # Settings
-    min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
-    time_limit = 10.0  # seconds to quit after
-    redundant = True  # require redundant detections
     multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
 
-    t = time.time()
     output = [None] * prediction.shape[0]
     for xi, x in enumerate(prediction):  # image index, image inference
         # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
+        # x[((x[..., 2:4] < 2) | (x[..., 2:4] > 4096)).any(1), 4] = 0  # width-height (pixels)
         x = x[xc[xi]]  # confidence
 
+        # Keep the max_nms candidates of highest objectness, before their class scores are expanded
+        if x.shape[0] > max_nms:
+            logger.warning('NMS candidates limit of %g exceeded (%g candidates)' % (max_nms, x.shape[0]))
+            x = x[x[:, 4].topk(max_nms).indices]
+
         # If none remain process next image
         if not x.shape[0]:
             continue
@@ -636,38 +650,64 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
         if classes:
             x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
 
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
+        if x.shape[0]:
+            output[xi] = x
 
-        # If none remain process next image
-        n = x.shape[0]  # number of boxes
-        if not n:
-            continue
+    return output
+
+
+def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False,
+                        max_det=300, max_nms=3000):
+    """Performs Non-Maximum Suppression (NMS) on inference results, with a single batched NMS over all the images
+    and classes of the batch. Only the max_nms candidates of highest objectness of each image are considered (see
+    nms_candidates()), and the max_det detections of highest confidence of each image are kept, with a warning when
+    either limit is hit
 
-        # Sort by confidence
-        # x = x[x[:, 4].argsort(descending=True)]
+    Returns:
+         detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
+    """
 
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torch.ops.torchvision.nms(boxes, scores, iou_thres)
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
+    nc = prediction[0].shape[1] - 5  # number of classes
+
+    # Settings
+    redundant = True  # require redundant detections
+
+    output = [None] * prediction.shape[0]
+    candidates, images = [], []
+    for xi, x in enumerate(nms_candidates(prediction, conf_thres, classes=classes, max_nms=max_nms)):
+        if x is not None:
+            candidates.append(x)
+            images.append(torch.full((x.shape[0],), xi, dtype=torch.long, device=x.device))
+
+    # If none remain in any image
+    if not candidates:
+        return output
+
+    # Batched NMS, over the boxes grouped by image and class
+    x, xi = torch.cat(candidates, 0), torch.cat(images, 0)
+    groups = xi if agnostic else xi * nc + x[:, 5].long()
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], groups, iou_thres)  # sorted by decreasing confidence
+    if merge:  # boxes offset by group, as in batched_nms
+        boxes, scores = x[:, :4] + groups[:, None].to(x) * (x[:, :4].max() + 1), x[:, 4]
+
+    for k in xi[i].unique().tolist():
+        ik = i[xi[i] == k]
+        if ik.shape[0] > max_det:  # limit detections
+            logger.warning('NMS detections limit of %g exceeded (%g detections)' % (max_det, ik.shape[0]))
+            ik = ik[:max_det]
+        n = int((xi == k).sum())  # number of boxes
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
             try:  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-                iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
+                iou = box_iou(boxes[ik], boxes) > iou_thres  # iou matrix
                 weights = iou * scores[None]  # box weights
-                x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+                x[ik, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
                 if redundant:
-                    i = i[iou.sum(1) > 1]  # require redundancy
+                    ik = ik[iou.sum(1) > 1]  # require redundancy
             except:  # possible CUDA error https://github.com/ultralytics/yolov3/issues/1139
-                print(x, i, x.shape, i.shape)
+                print(x, ik, x.shape, ik.shape)
                 pass
 
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            break  # time limit exceeded
+        output[k] = x[ik]
 
     return output
 
@@ -709,6 +749,7 @@ def coco_only_people(path='../coco/labels/train2017/'):  # from utils.general im
 def crop_images_random(path='../images/', scale=0.50):  # from utils.general import *; crop_images_random()
     # crops images into random squares up to scale fraction
     # WARNING: overwrites images!
+    from tqdm import tqdm
     for file in tqdm(sorted(glob.glob('%s/*.*' % path))):
         img = cv2.imread(file)  # BGR
         if img is not None:
@@ -731,6 +772,7 @@ def crop_images_random(path='../images/', scale=0.50):  # from utils.general imp
 
 def coco_single_class_labels(path='../coco/labels/train2014/', label_class=43):
     # Makes single-class coco datasets. from utils.general import *; coco_single_class_labels()
+    from tqdm import tqdm
     if os.path.exists('new/'):
         shutil.rmtree('new/')  # delete output folder
     os.makedirs('new/')  # make new output folder
@@ -767,6 +809,9 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
         Usage:
             from utils.general import *; _ = kmean_anchors()
     """
+    import yaml
+    from scipy.cluster.vq import kmeans
+    from tqdm import tqdm
     thr = 1. / thr
 
     def metric(k, wh):  # compute metrics
@@ -852,6 +897,7 @@ def kmean_anchors(path='./data/coco128.yaml', n=9, img_size=640, thr=4.0, gen=10
 
 def print_mutation(hyp, results, yaml_file='hyp_evolved.yaml', bucket=''):
     # Print mutation results to evolve.txt (for use with train.py --evolve)
+    import yaml
     a = '%10s' * len(hyp) % tuple(hyp.keys())  # hyperparam keys
     b = '%10.3g' * len(hyp) % tuple(hyp.values())  # hyperparam values
     c = '%10.4g' * len(results) % results  # results (P, R, mAP@0.5, mAP@0.5:0.95, val_losses x 3)
@@ -964,6 +1010,7 @@ def hist2d(x, y, n=100):
 
 def butter_lowpass_filtfilt(data, cutoff=1500, fs=50000, order=5):
     # https://stackoverflow.com/questions/28536191/how-to-filter-smooth-with-scipy-numpy
+    from scipy.signal import butter, filtfilt
     def butter_lowpass(cutoff, fs, order):
         nyq = 0.5 * fs
         normal_cutoff = cutoff / nyq
@@ -974,6 +1021,14 @@ def butter_lowpass_filtfilt(data, cutoff=1500, fs=50000, order=5):
     return filtfilt(b, a, data)  # forward-backward filter
 
 
+def import_pyplot():
+    # Imports matplotlib on first use, only training and plotting need it (not the detectors)
+    import matplotlib
+    import matplotlib.pyplot as plt
+    matplotlib.rc('font', **{'size': 11})
+    return plt
+
+
 def plot_one_box(x, img, color=None, label=None, line_thickness=None):
     # Plots one bounding box on image img
     tl = line_thickness or round(0.002 * (img.shape[0] + img.shape[1]) / 2) + 1  # line/font thickness
@@ -991,6 +1046,7 @@ def plot_one_box(x, img, color=None, label=None, line_thickness=None):
 def plot_wh_methods():  # from utils.general import *; plot_wh_methods()
     # Compares the two methods for width-height anchor multiplication
     # https://github.com/ultralytics/yolov3/issues/168
+    plt = import_pyplot()
     x = np.arange(-4.0, 4.0, .1)
     ya = np.exp(x)
     yb = torch.sigmoid(torch.from_numpy(x)).numpy() * 2
@@ -1010,6 +1066,7 @@ def plot_wh_methods():  # from utils.general import *; plot_wh_methods()
 
 
 def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max_size=640, max_subplots=16):
+    plt = import_pyplot()
     tl = 3  # line thickness
     tf = max(tl - 1, 1)  # font thickness
     if os.path.isfile(fname):  # do not overwrite
@@ -1094,6 +1151,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
 
 def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     # Plot LR simulating training for full epochs
+    plt = import_pyplot()
     optimizer, scheduler = copy(optimizer), copy(scheduler)  # do not modify originals
     y = []
     for _ in range(epochs):
@@ -1111,6 +1169,7 @@ def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
 
 def plot_test_txt():  # from utils.general import *; plot_test()
     # Plot test.txt histograms
+    plt = import_pyplot()
     x = np.loadtxt('test.txt', dtype=np.float32)
     box = xyxy2xywh(x[:, :4])
     cx, cy = box[:, 0], box[:, 1]
@@ -1128,6 +1187,7 @@ def plot_test_txt():  # from utils.general import *; plot_test()
 
 def plot_targets_txt():  # from utils.general import *; plot_targets_txt()
     # Plot targets.txt histograms
+    plt = import_pyplot()
     x = np.loadtxt('targets.txt', dtype=np.float32).T
     s = ['x targets', 'y targets', 'width targets', 'height targets']
     fig, ax = plt.subplots(2, 2, figsize=(8, 8), tight_layout=True)
@@ -1141,6 +1201,7 @@ def plot_targets_txt():  # from utils.general import *; plot_targets_txt()
 
 def plot_study_txt(f='study.txt', x=None):  # from utils.general import *; plot_study_txt()
     # Plot study.txt generated by test.py
+    plt = import_pyplot()
     fig, ax = plt.subplots(2, 4, figsize=(10, 6), tight_layout=True)
     ax = ax.ravel()
 
@@ -1173,6 +1234,7 @@ def plot_study_txt(f='study.txt', x=None):  # from utils.general import *; plot_
 
 def plot_labels(labels, save_dir=''):
     # plot dataset labels
+    plt = import_pyplot()
     c, b = labels[:, 0], labels[:, 1:].transpose()  # classes, boxes
     nc = int(c.max() + 1)  # number of classes
 
@@ -1205,6 +1267,9 @@ def plot_labels(labels, save_dir=''):
 
 def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.general import *; plot_evolution()
     # Plot hyperparameter evolution results in evolve.txt
+    import matplotlib
+    import yaml
+    plt = import_pyplot()
     with open(yaml_file) as f:
         hyp = yaml.load(f, Loader=yaml.FullLoader)
     x = np.loadtxt('evolve.txt', ndmin=2)
@@ -1229,6 +1294,7 @@ def plot_evolution(yaml_file='data/hyp.finetune.yaml'):  # from utils.general im
 
 def plot_results_overlay(start=0, stop=0):  # from utils.general import *; plot_results_overlay()
     # Plot training 'results*.txt', overlaying train and val losses
+    plt = import_pyplot()
     s = ['train', 'train', 'train', 'Precision', 'mAP@0.5', 'val', 'val', 'val', 'Recall', 'mAP@0.5:0.95']  # legends
     t = ['GIoU', 'Objectness', 'Classification', 'P-R', 'mAP-F1']  # titles
     for f in sorted(glob.glob('results*.txt') + glob.glob('../../Downloads/results*.txt')):
@@ -1253,6 +1319,7 @@ def plot_results_overlay(start=0, stop=0):  # from utils.general import *; plot_
 def plot_results(start=0, stop=0, bucket='', id=(), labels=(),
                  save_dir=''):  # from utils.general import *; plot_results()
     # Plot training 'results*.txt' as seen in https://github.com/ultralytics/yolov5#reproduce-our-training
+    plt = import_pyplot()
     fig, ax = plt.subplots(2, 5, figsize=(12, 6))
     ax = ax.ravel()
     s = ['GIoU', 'Objectness', 'Classification', 'Precision', 'Recall',
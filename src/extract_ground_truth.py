@@ -1,16 +1,92 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from typing import List
 import json
 import os
 
+from tqdm import tqdm
+
 from digitizer.digitization import annotation_to_thresholds
 
+COLUMNS = ["ear", "conduction", "masking", "frequency", "threshold"]
+
+def extract_rows(annotation_file: str) -> List[list]:
+    """Extracts the ground truth thresholds of an annotation file.
+
+    Parameters
+    ----------
+    annotation_file : str
+    Path to the JSON annotation of a report.
+
+    Returns
+    -------
+    List[list]
+    One row (in the order of `COLUMNS`) per threshold.
+    """
+    with open(annotation_file) as ifile:
+        thresholds = annotation_to_thresholds(json.load(ifile))
+    return [[threshold[column] for column in COLUMNS] for threshold in thresholds]
+
+def write_csv(rows: List[list], output_file: str, columns: List[str] = COLUMNS):
+    with open(output_file, "w") as ofile:
+        ofile.write(",".join(columns) + "\n")
+        for row in rows:
+            ofile.write(",".join(str(value) for value in row) + "\n")
+
+def process_file(task: tuple) -> tuple:
+    """Extracts the ground truth of one report, writing it to its own CSV
+    when `output_dir` is given and returning the rows otherwise.
+    """
+    annotation_file, output_dir = task
+    report_id = os.path.basename(annotation_file).split(".")[0]
+    rows = extract_rows(annotation_file)
+    if output_dir is not None:
+        write_csv(rows, os.path.join(output_dir, f"{report_id}.csv"))
+        return report_id, len(rows)
+    return report_id, rows
+
+def main(args):
+    annotation_files = [
+        os.path.join(args.annotations_dir, filename)
+        for filename in sorted(os.listdir(args.annotations_dir))
+        if filename.endswith(".json")
+    ]
+
+    # Write one CSV per report from the workers, unless all the thresholds
+    # are gathered in a single file
+    output_dir = None if args.output_file else args.output_dir
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    tasks = [(annotation_file, output_dir) for annotation_file in annotation_files]
+    chunksize = max(1, len(tasks) // (4 * (args.workers or os.cpu_count() or 1)))
+    with Pool(args.workers) as pool:
+        results = dict(tqdm(pool.imap_unordered(process_file, tasks, chunksize=chunksize), total=len(tasks)))
+
+    if args.output_file:
+        rows = [
+            [report_id] + row
+            for report_id in sorted(results)
+            for row in results[report_id]
+        ]
+        write_csv(rows, args.output_file, columns=["report"] + COLUMNS)
+
 if __name__ == "__main__":
-    for filename in os.listdir("../data/annotations_test"):
-        thresholds = annotation_to_thresholds(json.load(open(f"../data/annotations_test/{filename}")))
-        thresholds_list = []
-        for threshold in thresholds:
-            thresholds_list.append([threshold["ear"], threshold["conduction"], threshold["masking"], threshold["frequency"], threshold["threshold"]])
-        
-        with open(f"../data/ground_truth/{filename.split('.')[0]}.csv", "w") as ofile:
-            ofile.write(f"ear,conduction,masking,frequency,threshold\n")
-            for t in thresholds_list:
-                ofile.write(f"{t[0]},{t[1]},{t[2]},{t[3]},{t[4]}\n")
\ No newline at end of file
+    parser = ArgumentParser(description="Extracts the ground truth thresholds from the annotations of a corpus of reports.")
+    parser.add_argument("-a", "--annotations_dir", type=str, default="../data/annotations_test",
+            help="Directory containing the JSON annotations (default: ../data/annotations_test).")
+    parser.add_argument("-o", "--output_dir", type=str, default="../data/ground_truth",
+            help="Directory where one CSV per report is written (default: ../data/ground_truth).")
+    parser.add_argument("-f", "--output_file", type=str, default=None,
+            help="Write the thresholds of all the reports to this single CSV (with a `report` column) instead of one CSV per report.")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+            help="Number of worker processes (default: the number of CPUs).")
+    args = parser.parse_args()
+    main(args)
@@ -6,7 +6,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from typing_extensions import TypedDict
 
 class ThresholdDict(TypedDict):
@@ -71,6 +71,74 @@ class AudiogramAnnotationDict(TypedDict):
     labels: List[LabelDict]
     symbols: List[SymbolDict]
 
+class GridCalibrationDict(TypedDict):
+    """Represents the affine calibration of an audiogram grid, i.e.
+    octave = octaveScale * x + octaveOffset and
+    threshold = thresholdScale * y + thresholdOffset, in the
+    audiogram rotated by `rotation` degrees.
+    """
+    octaveScale: float
+    octaveOffset: float
+    thresholdScale: float
+    thresholdOffset: float
+    rotation: float
+
+class HoughAccumulatorDict(TypedDict):
+    """Represents the peaks of the Hough vote space of an audiogram,
+    i.e. its lines with more than `minThreshold` votes.
+    """
+    minThreshold: int
+    theta: float
+    peaks: List[List[float]] # [rho, theta, votes]
+
+class DetectionCandidatesDict(TypedDict):
+    """Represents the candidates of the non-maximum suppression of the
+    label or symbol detector in an image, from which its detections are
+    selected (see `select_detections`). Their boxes are in the coordinates
+    of the image (of shape `imageShape`, i.e. (height, width)), offset by
+    `offset` once selected.
+    """
+    confThreshold: float
+    imageShape: List[int]
+    offset: TypedDict("OffsetDict", { "x": int, "y": int })
+    candidates: List[list] # [x1, y1, x2, y2, confidence, class]
+
+class CachedComponentsDict(TypedDict):
+    """Represents the detections made in one audiogram of a report, as
+    stored in the cache of `detect_components`. The bounding boxes of the
+    labels and symbols are relative to the deskewed audiogram. The labels
+    are None when they were not detected because the calibration of the
+    grid is known from a template (see `extract_thresholds`), which is then
+    the calibration. The candidates of the "labels" and "symbols" detectors
+    are the detections before their non-maximum suppression.
+    """
+    audiogram: AudiogramAnnotationDict
+    labels: Optional[List[dict]]
+    symbols: List[dict]
+    candidates: Dict[str, Optional[DetectionCandidatesDict]]
+    lines: Optional[HoughAccumulatorDict]
+    calibration: Optional[GridCalibrationDict]
+
+class TemplateAudiogramDict(TypedDict):
+    """Represents an audiogram of a report template, with the fingerprint
+    of its region of the page.
+    """
+    boundingBox: BoundingBox
+    confidence: Optional[float]
+    correctionAngle: float
+    fingerprint: str
+    calibration: Optional[GridCalibrationDict]
+
+class TemplateDict(TypedDict):
+    """Represents the layout of a report template, keyed by the
+    fingerprint of the page.
+    """
+    fingerprint: str
+    width: int
+    height: int
+    audiograms: List[TemplateAudiogramDict]
+    matches: int
+
 class ClaimantProfileDict(TypedDict):
     """Profile of the claimant.
     """
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2020, Carleton University Biomedical Informatics Collaboratory
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import Pool
+from typing import List
+import itertools
+import json
+import os
+import time
+
+from tqdm import tqdm
+
+from interfaces import CachedComponentsDict, ThresholdDict
+from digitizer.cache import get_report_id, load_component_dicts
+from digitizer.digitization import (annotation_to_thresholds, detections_to_labels, detections_to_symbols, get_snapped_thresholds,
+        select_detections, DETECTION_CONF_THRESHOLD, DETECTION_IOU_THRESHOLD, MAX_DETECTIONS)
+from digitizer.report_components.grid import Grid, GRID_THRESHOLDS
+from digitizer.report_components.hough import HoughAccumulator
+from utils.exceptions import InsufficientLabelsException, InsufficientLinesException
+
+PARAMETERS = ["epsilon", "hough_thresholds", "line_tolerance", "conf_threshold", "iou_threshold"]
+
+# The cached detections and the ground truth of every report (keyed by its
+# cache file), loaded once per worker process (see `load_corpus`)
+CORPUS = {}
+
+def load_corpus(cache_dir: str, annotations_dir: str, cache_files: List[str]):
+    for cache_file in cache_files:
+        with open(os.path.join(annotations_dir, f"{get_report_id(cache_file)}.json")) as ifile:
+            ground_truth = annotation_to_thresholds(json.load(ifile))
+        CORPUS[cache_file] = (
+            load_component_dicts(os.path.join(cache_dir, cache_file)),
+            ground_truth
+        )
+
+def extract_cached_thresholds(component_dicts: List[CachedComponentsDict], config: dict) -> tuple:
+    """Extracts the thresholds of a report from its cached detections and
+    lines, with the post-processing parameters of `config`. The labels and
+    symbols are selected from the cached candidates of their detectors as
+    the detectors would with the confidence and IoU thresholds of `config`.
+
+    Returns
+    -------
+    tuple
+    A tuple of the form (thresholds, number of audiograms whose grid could not be fitted).
+    """
+    thresholds: List[ThresholdDict] = []
+    failures = 0
+    for component_dict in component_dicts:
+        audiogram = component_dict["audiogram"]
+        audiogram_coordinates = { "x": audiogram["boundingBox"]["x"], "y": audiogram["boundingBox"]["y"] }
+        correction_angle = audiogram["correctionAngle"]
+
+        candidates = component_dict["candidates"]
+        symbols = detections_to_symbols(
+            select_detections(candidates["symbols"], "measurementType", config["conf_threshold"], config["iou_threshold"], MAX_DETECTIONS["symbols"]),
+            audiogram_coordinates,
+            correction_angle
+        )
+
+        if component_dict.get("calibration") is not None:
+            # The grid was calibrated during the detection with a template
+            thresholds += get_snapped_thresholds(Grid.from_dict(component_dict["calibration"]), symbols, epsilon=config["epsilon"])
+            continue
+        if component_dict.get("lines") is None:
+            failures += 1
+            continue
+
+        labels = detections_to_labels(
+            select_detections(candidates["labels"], "text", config["conf_threshold"], config["iou_threshold"], MAX_DETECTIONS["labels"]),
+            audiogram_coordinates,
+            correction_angle
+        )
+
+        try:
+            grid = Grid.from_accumulator(
+                HoughAccumulator.from_dict(component_dict["lines"]),
+                labels,
+                threshold=config["hough_thresholds"],
+                rotation=correction_angle,
+                line_tolerance=config["line_tolerance"]
+            )
+        except (InsufficientLabelsException, InsufficientLinesException):
+            failures += 1
+            continue
+
+        thresholds += get_snapped_thresholds(grid, symbols, epsilon=config["epsilon"])
+    return thresholds, failures
+
+def as_keys(thresholds: List[ThresholdDict]) -> Counter:
+    return Counter(
+        (t["ear"], t["conduction"], t["masking"], t["frequency"], t["threshold"])
+        for t in thresholds
+    )
+
+def evaluate(config: dict) -> dict:
+    """Evaluates one configuration on the whole corpus of the worker.
+
+    Returns
+    -------
+    dict
+    The configuration with its precision, recall and F1 score (over all the
+    thresholds of the corpus), the number of audiograms whose grid could not
+    be fitted, and the latency.
+    """
+    true_positives, predicted, expected, failures = 0, 0, 0, 0
+    start = time.perf_counter()
+    predictions = {
+        report_id: extract_cached_thresholds(component_dicts, config)
+        for report_id, (component_dicts, _) in CORPUS.items()
+    }
+    elapsed = time.perf_counter() - start
+
+    for report_id, (thresholds, report_failures) in predictions.items():
+        prediction_keys, ground_truth_keys = as_keys(thresholds), as_keys(CORPUS[report_id][1])
+        true_positives += sum((prediction_keys & ground_truth_keys).values())
+        predicted += sum(prediction_keys.values())
+        expected += sum(ground_truth_keys.values())
+        failures += report_failures
+
+    precision = true_positives / predicted if predicted > 0 else 0.0
+    recall = true_positives / expected if expected > 0 else 0.0
+    return {
+        **config,
+        "hough_thresholds": "/".join(str(t) for t in config["hough_thresholds"]),
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+        "failed_audiograms": failures,
+        "ms_per_report": 1000 * elapsed / max(len(CORPUS), 1)
+    }
+
+def main(args, parser: ArgumentParser):
+    cache_files = [
+        filename
+        for filename in sorted(os.listdir(args.cache_dir))
+        if filename.endswith(".json.gz")
+        and os.path.exists(os.path.join(args.annotations_dir, get_report_id(filename) + ".json"))
+    ]
+    hough_thresholds = [[int(t) for t in thresholds.split(",")] for thresholds in args.hough_thresholds]
+
+    # The cached lines and candidates only go down to the thresholds at
+    # which they were kept
+    component_dicts = [
+        component_dict
+        for cache_file in cache_files
+        for component_dict in load_component_dicts(os.path.join(args.cache_dir, cache_file))
+    ]
+    min_thresholds = [component_dict["lines"]["minThreshold"] for component_dict in component_dicts if component_dict.get("lines")]
+    for thresholds in hough_thresholds:
+        if min_thresholds and min(thresholds) < max(min_thresholds):
+            parser.error(f"The Hough thresholds {','.join(str(t) for t in thresholds)} go below {max(min_thresholds)}, "
+                    "the lowest threshold of the cached lines.")
+    conf_thresholds = [
+        candidates["confThreshold"]
+        for component_dict in component_dicts
+        for candidates in component_dict["candidates"].values()
+        if candidates is not None
+    ]
+    if conf_thresholds and min(args.conf_thresholds) < max(conf_thresholds):
+        parser.error(f"The confidence threshold {min(args.conf_thresholds)} is below {max(conf_thresholds)}, "
+                "the lowest confidence of the cached candidates.")
+
+    configs = [
+        dict(zip(PARAMETERS, values))
+        for values in itertools.product(
+            args.epsilons,
+            hough_thresholds,
+            args.line_tolerances,
+            args.conf_thresholds,
+            args.iou_thresholds
+        )
+    ]
+
+    with Pool(args.workers, initializer=load_corpus, initargs=(args.cache_dir, args.annotations_dir, cache_files)) as pool:
+        results = list(tqdm(pool.imap(evaluate, configs), total=len(configs)))
+
+    results = sorted(results, key=lambda result: -result["f1"])
+    columns = PARAMETERS + ["precision", "recall", "f1", "failed_audiograms", "ms_per_report"]
+
+    if args.output_file:
+        with open(args.output_file, "w") as ofile:
+            ofile.write(",".join(columns) + "\n")
+            for result in results:
+                ofile.write(",".join(str(result[column]) for column in columns) + "\n")
+
+    print(f"Reports: {len(cache_files)}, configurations: {len(configs)}")
+    print(" ".join(f"{column:>17}" for column in columns))
+    for result in results:
+        print(" ".join(
+            f"{result[column]:>17.3f}" if isinstance(result[column], float) else f"{result[column]:>17}"
+            for column in columns
+        ))
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=("Evaluates grids of post-processing parameters against the ground truth "
+            "extracted from the annotations, on the detections cached by `digitize_report.py --cache_dir`."))
+    parser.add_argument("-c", "--cache_dir", type=str, required=True,
+            help="Cache directory populated by `digitize_report.py --cache_dir` (in the default, threshold extraction, mode).")
+    parser.add_argument("-a", "--annotations_dir", type=str, required=True, help="Directory containing the JSON annotations.")
+    parser.add_argument("-o", "--output_file", type=str, default=None, help="CSV file to which the results are written.")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes (default: the number of CPUs).")
+    parser.add_argument("--epsilons", type=float, nargs="+", default=[0.15],
+            help="Values of the bone conduction snapping epsilon, in octaves (default: 0.15).")
+    parser.add_argument("--hough_thresholds", type=str, nargs="+", default=[",".join(str(t) for t in GRID_THRESHOLDS)],
+            help=(f"Sequences of comma-separated Hough thresholds tried in turn to fit the grid (default: {','.join(str(t) for t in GRID_THRESHOLDS)}). "
+                  f"The cached lines only go down to the lowest threshold used when the cache was written."))
+    parser.add_argument("--line_tolerances", type=float, nargs="+", default=[1],
+            help="Values of the deviation (in degrees) from the vertical/horizontal tolerated for grid lines (default: 1).")
+    parser.add_argument("--conf_thresholds", type=float, nargs="+", default=[DETECTION_CONF_THRESHOLD],
+            help=(f"Confidence thresholds of the label and symbol detectors, applied to their cached NMS candidates (default: {DETECTION_CONF_THRESHOLD}). "
+                  f"The candidates only go down to the confidence at which they were cached."))
+    parser.add_argument("--iou_thresholds", type=float, nargs="+", default=[DETECTION_IOU_THRESHOLD],
+            help=f"NMS IoU thresholds of the label and symbol detectors, applied to their cached NMS candidates (default: {DETECTION_IOU_THRESHOLD}).")
+    args = parser.parse_args()
+    main(args, parser)
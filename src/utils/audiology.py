@@ -6,7 +6,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import List
+from typing import List, Union
 import numpy as np
 
 VALID_FREQUENCIES = [125, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000]
@@ -17,6 +17,47 @@ INTEROCTAVE_FREQS_HZ = [750, 1500, 3000, 6000]
 OCTAVE_FREQS_KHZ = [0.125, 0.25, 0.5, 1, 2, 4, 8]
 INTEROCTAVE_FREQS_KHZ = [0.750, 1.5, 3, 6]
 
+# Array versions of the valid values used by the vectorized snapping functions
+VALID_FREQUENCIES_ARRAY = np.array(VALID_FREQUENCIES)
+VALID_OCTAVES_ARRAY = np.log(VALID_FREQUENCIES_ARRAY / 125) / np.log(2)
+VALID_THRESHOLDS_ARRAY = np.array(VALID_THRESHOLDS)
+
+def nearest_indices(values: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """Returns the index of the nearest grid value for every value
+    (the lower one in case of a tie).
+
+    Parameters
+    ----------
+    values : np.ndarray
+    The values to be snapped.
+    grid : np.ndarray
+    The sorted grid values.
+
+    Returns
+    -------
+    np.ndarray
+    The indices of the nearest grid values.
+    """
+    values = np.asarray(values, dtype=float)
+    right = np.clip(np.searchsorted(grid, values), 0, len(grid) - 1)
+    left = np.clip(right - 1, 0, len(grid) - 1)
+    return np.where(np.abs(values - grid[left]) <= np.abs(grid[right] - values), left, right)
+
+def round_thresholds(thresholds: np.ndarray) -> np.ndarray:
+    """Returns the nearest multiple of 5 for every threshold input.
+
+    Parameters
+    ----------
+    thresholds : np.ndarray
+    The thresholds to be snapped to the nearest multiple of 5.
+
+    Returns
+    -------
+    np.ndarray
+    The ``snapped`` threshold values.
+    """
+    return VALID_THRESHOLDS_ARRAY[nearest_indices(thresholds, VALID_THRESHOLDS_ARRAY)]
+
 def round_threshold(threshold: float) -> int:
     """Returns the nearest multiple of 5 for the threshold input.
 
@@ -30,7 +71,23 @@ def round_threshold(threshold: float) -> int:
     float
     A ``snapped`` threshold value.
     """
-    return VALID_THRESHOLDS[np.argmin([abs(threshold - t) for t in VALID_THRESHOLDS])]
+    return int(round_thresholds([threshold])[0])
+
+def round_frequencies(frequencies: np.ndarray) -> np.ndarray:
+    """Returns the nearest audiologically meaningful frequency for every
+    frequency input.
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+    The frequencies to be snapped to the nearest clinically meaningful frequency.
+
+    Returns
+    -------
+    np.ndarray
+    The ``snapped`` frequency values.
+    """
+    return VALID_FREQUENCIES_ARRAY[nearest_indices(frequencies, VALID_FREQUENCIES_ARRAY)]
 
 def round_frequency(frequency: float) -> int:
     """Returns the nearest audiologically meaningful frequency.
@@ -43,7 +100,47 @@ def round_frequency(frequency: float) -> int:
     float
     A ``snapped`` frequency value.
     """
-    return VALID_FREQUENCIES[np.argmin([abs(frequency - f) for f in VALID_FREQUENCIES])]
+    return int(round_frequencies([frequency])[0])
+
+def round_frequencies_bone(frequencies: np.ndarray, directions: Union[str, np.ndarray], epsilon: float = 0.15) -> np.ndarray:
+    """Returns the nearest audiologically meaningful frequency for every
+    frequency input, following the snapping rule of `round_frequency_bone`.
+
+    Parameters
+    ----------
+    frequencies : np.ndarray
+    The frequencies to be snapped to the nearest clinically meaningful frequency.
+
+    directions : Union[str, np.ndarray]
+    The direction (`left` or `right`) in which each frequency is snapped, or
+    a single direction for all of them.
+
+    epsilon: float
+    Distance (in octaves) below which a frequency is considered to be
+    exactly on the nearest valid frequency. (default: 0.15 octaves)
+
+    Returns
+    -------
+    np.ndarray
+    The ``snapped`` frequency values.
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    directions = np.asarray(directions)
+    assert np.all((directions == "left") | (directions == "right"))
+
+    octaves = frequency_to_octave(frequencies)
+    nearest = nearest_indices(octaves, VALID_OCTAVES_ARRAY)
+    above = VALID_FREQUENCIES_ARRAY[nearest] > frequencies
+    last = len(VALID_FREQUENCIES_ARRAY) - 1
+
+    shifted = np.where(
+        directions == "left",
+        np.where(above, np.maximum(nearest - 1, 0), nearest),
+        np.where(above, nearest, np.minimum(nearest + 1, last))
+    )
+    snapped = np.where(np.abs(octaves - VALID_OCTAVES_ARRAY[nearest]) < epsilon, nearest, shifted)
+
+    return VALID_FREQUENCIES_ARRAY[snapped]
 
 def round_frequency_bone(frequency: float, direction: str, epsilon: float = 0.15) -> int:
     """Returns the nearest audiologically meaningful frequency.
@@ -97,24 +194,7 @@ def round_frequency_bone(frequency: float, direction: str, epsilon: float = 0.15
     """
     assert direction == "left" or direction == "right"
 
-    distances = [abs(frequency_to_octave(frequency) - frequency_to_octave(f)) for f in VALID_FREQUENCIES]
-    nearest_frequency_index = np.argmin(distances)
-
-    snapped = None
-    if distances[nearest_frequency_index] < epsilon:
-        snapped = VALID_FREQUENCIES[nearest_frequency_index]
-    elif direction == "left":
-        if VALID_FREQUENCIES[nearest_frequency_index] > frequency:
-            snapped = VALID_FREQUENCIES[nearest_frequency_index - 1] if nearest_frequency_index > 0 else VALID_FREQUENCIES[nearest_frequency_index]
-        else:
-            snapped = VALID_FREQUENCIES[nearest_frequency_index]
-    else:
-        if VALID_FREQUENCIES[nearest_frequency_index] > frequency:
-            snapped = VALID_FREQUENCIES[nearest_frequency_index]
-        else:
-            snapped = VALID_FREQUENCIES[nearest_frequency_index + 1] if nearest_frequency_index < len(VALID_FREQUENCIES) - 1 else VALID_FREQUENCIES[nearest_frequency_index]
-
-    return snapped
+    return int(round_frequencies_bone([frequency], direction, epsilon=epsilon)[0])
 
 def frequency_to_octave(frequency: float) -> float:
     """Converts a frequency (in Hz) to an octave value (linear units).
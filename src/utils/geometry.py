@@ -6,7 +6,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import List
+from typing import List, Union
 
 import numpy as np
 
@@ -21,7 +21,8 @@ def compute_deviation_sum(angle: float, lines: List[Line]) -> float:
     angle : float
     The candidate angle in degrees.
     lines : List[Line]
-    All the lines used in computing the sum of deviation.
+    All the lines used in computing the sum of deviation, each weighted by
+    its `weight`.
 
     Returns
     -------
@@ -33,10 +34,10 @@ def compute_deviation_sum(angle: float, lines: List[Line]) -> float:
     for line in lines:
         if line.get_angle() > -45  and line.get_angle() < 45:
             residual = abs((line.get_angle() - angle))
-            residual_angle_sum += residual
+            residual_angle_sum += line.weight * residual
         else:
             residual = 90 - abs(line.get_angle() - angle)
-            residual_angle_sum += residual
+            residual_angle_sum += line.weight * residual
     return abs(residual_angle_sum)
 
 def compute_rotation_angle(perpendicular_lines: List[Line]) -> float:
@@ -73,36 +74,112 @@ def compute_rotation_angle(perpendicular_lines: List[Line]) -> float:
 
     return correction_angle
 
-def apply_rotation(point: dict, rotation_angle: float) -> dict:
-    new_x = (np.cos(rotation_angle) * point["x"]
-                - np.sin(rotation_angle) * -point["y"])
-    new_y = (np.sin(rotation_angle) * point["x"]
-                + np.cos(rotation_angle) * -point["y"])
-    return { **point, "x": new_x, "y": -new_y }
+def apply_rotation(point: Union[dict, np.ndarray], rotation_angle: float) -> Union[dict, np.ndarray]:
+    """Rotates a point (or points) about the origin.
 
+    Parameters
+    ----------
+    point : Union[dict, np.ndarray]
+    A point of the form { "x": float, "y": float } or an (N, 2) array
+    of (x, y) points.
+    rotation_angle : float
+    The rotation angle (in radians).
 
-def get_bounding_box_relative_to_original_report(bounding_box, audiogram_coordinates, correction_angle):
+    Returns
+    -------
+    Union[dict, np.ndarray]
+    The rotated point(s), in the same format as the input.
+    """
+    if isinstance(point, dict):
+        new_x = (np.cos(rotation_angle) * point["x"]
+                    - np.sin(rotation_angle) * -point["y"])
+        new_y = (np.sin(rotation_angle) * point["x"]
+                    + np.cos(rotation_angle) * -point["y"])
+        return { **point, "x": new_x, "y": -new_y }
+
+    # Same transformation as above, applied to all points in a single
+    # matrix multiplication
+    cos, sin = np.cos(rotation_angle), np.sin(rotation_angle)
+    rotation_matrix = np.array([[cos, sin], [-sin, cos]])
+    return np.asarray(point, dtype=float).reshape(-1, 2) @ rotation_matrix.T
+
+def get_bounding_boxes_relative_to_original_report(bounding_boxes: np.ndarray, audiogram_coordinates: dict, correction_angle: float) -> np.ndarray:
+    """Converts bounding boxes detected in a (rotated) audiogram to bounding
+    boxes relative to the top-left corner of the original report.
 
-    absolute_corrected_coordinates = {
-        "x": bounding_box["x"] + audiogram_coordinates["x"],
-        "y": bounding_box["y"] + audiogram_coordinates["y"]
-    }
+    Parameters
+    ----------
+    bounding_boxes : np.ndarray
+    An (N, 4) array of (x, y, width, height) bounding boxes relative to the
+    top-left corner of the audiogram.
+    audiogram_coordinates : dict
+    The coordinates of the audiogram in the report, { "x": int, "y": int }.
+    correction_angle : float
+    The correction angle (in degrees) that was applied to the audiogram.
+
+    Returns
+    -------
+    np.ndarray
+    An (N, 4) array of (x, y, width, height) bounding boxes relative to the
+    top-left corner of the original report.
+    """
+    bounding_boxes = np.asarray(bounding_boxes, dtype=float).reshape(-1, 4)
+    x = bounding_boxes[:, 0] + audiogram_coordinates["x"]
+    y = bounding_boxes[:, 1] + audiogram_coordinates["y"]
+    width, height = bounding_boxes[:, 2], bounding_boxes[:, 3]
 
-    raw_coordinates = apply_rotation(absolute_corrected_coordinates, -correction_angle)
     correction_angle_rad = np.radians(correction_angle)
+    sin, cos = np.sin(correction_angle_rad), np.cos(correction_angle_rad)
 
-    side_length = bounding_box["width"] * np.sin(correction_angle_rad) + bounding_box["width"] * np.cos(correction_angle_rad)
+    side_length = width * sin + width * cos
     if correction_angle_rad <= 0:
-        return {
-            "x": absolute_corrected_coordinates["x"] - bounding_box["width"] * np.sin(correction_angle_rad),
-            "y": absolute_corrected_coordinates["y"],
-            "width": side_length,
-            "height": side_length
-        }
+        x = x - width * sin
     else:
-        return {
-            "x": absolute_corrected_coordinates["x"],
-            "y": absolute_corrected_coordinates["y"] - bounding_box["height"] * np.sin(correction_angle_rad),
-            "width": side_length,
-            "height": side_length
-        }
+        y = y - height * sin
+
+    return np.stack([x, y, side_length, side_length], axis=1)
+
+def get_bounding_box_relative_to_original_report(bounding_box, audiogram_coordinates, correction_angle):
+    x, y, width, height = get_bounding_boxes_relative_to_original_report(
+        [[bounding_box["x"], bounding_box["y"], bounding_box["width"], bounding_box["height"]]],
+        audiogram_coordinates,
+        correction_angle
+    )[0].tolist()
+    return { "x": x, "y": y, "width": width, "height": height }
+
+def non_max_suppression(bounding_boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """Greedy non-maximum suppression of (x, y, width, height) bounding
+    boxes: a box is dropped when it overlaps a box with a higher score by
+    more than `iou_threshold` (intersection over union).
+
+    Parameters
+    ----------
+    bounding_boxes : np.ndarray
+    An (N, 4) array of (x, y, width, height) bounding boxes.
+    scores : np.ndarray
+    The N scores (confidences) of the boxes.
+    iou_threshold : float
+    The largest intersection over union between two boxes that are kept.
+
+    Returns
+    -------
+    np.ndarray
+    The indices of the boxes kept, in decreasing order of score.
+    """
+    bounding_boxes = np.asarray(bounding_boxes, dtype=float).reshape(-1, 4)
+    x1, y1 = bounding_boxes[:, 0], bounding_boxes[:, 1]
+    x2, y2 = x1 + bounding_boxes[:, 2], y1 + bounding_boxes[:, 3]
+    areas = bounding_boxes[:, 2] * bounding_boxes[:, 3]
+
+    order = np.argsort(-np.asarray(scores, dtype=float), kind="stable")
+    keep = []
+    while len(order) > 0:
+        i, order = order[0], order[1:]
+        keep.append(i)
+        intersections = (
+            np.clip(np.minimum(x2[i], x2[order]) - np.maximum(x1[i], x1[order]), 0, None)
+            * np.clip(np.minimum(y2[i], y2[order]) - np.maximum(y1[i], y1[order]), 0, None)
+        )
+        ious = intersections / np.maximum(areas[i] + areas[order] - intersections, np.finfo(float).eps)
+        order = order[ious <= iou_threshold]
+    return np.array(keep, dtype=int)